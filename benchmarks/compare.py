@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Compares two result files of run.py
+
+Prints the median of every benchmark in both files and their ratio, and
+exits with status 1 if a benchmark got slower than the threshold allows.
+
+    python benchmarks/compare.py before.json after.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+from typing import Dict, List, Tuple
+
+
+def load(path: str) -> Dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(before: Dict, after: Dict, threshold: float) -> List[Tuple]:
+    """Returns (name, median before, median after, ratio, regressed) for the
+    benchmarks of both reports"""
+    rows = []
+    for name, result in after["benchmarks"].items():
+        if name not in before["benchmarks"]:
+            continue
+        old, new = before["benchmarks"][name]["median"], result["median"]
+        ratio = new / old if old else float("inf")
+        rows.append((name, old, new, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown of the median reported as a regression",
+    )
+    args = parser.parse_args(argv)
+    before, after = load(args.before), load(args.after)
+    print(f"before: {before['meta']['commit']}  after: {after['meta']['commit']}")
+    rows = compare(before, after, args.threshold)
+    width = max((len(row[0]) for row in rows), default=0)
+    for name, old, new, ratio, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(
+            f"{name:<{width}}  {old * 1000:10.2f} ms  {new * 1000:10.2f} ms  "
+            f"{ratio:6.2f}x{flag}"
+        )
+    sys.exit(1 if any(row[4] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
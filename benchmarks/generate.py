@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Fills a database with synthetic metrics for the benchmarks
+
+Two metrics are written, each as a table in the layout of the default
+configs: a `created` timestamp column, an `origin` value column and one
+column per label.
+
+- `requests_total`: a counter, increasing by a random amount at every sample
+  and reset to zero once in the middle of the time span for a tenth of the
+  series
+- `cpu_usage`: a gauge between 0 and 100
+
+Every series has an `instance` label, unique to it, and `--labels` more
+labels (`label_0`, `label_1`, ...) taking `--cardinality` values each. The
+data only depends on the arguments and `--seed`, apart from the end of the
+time span which defaults to now.
+
+    python benchmarks/generate.py --db sqlite:///bench.db --series 1000
+
+Any sqlalchemy url works, e.g. `duckdb:///bench.duckdb` with duckdb_engine.
+"""
+
+import argparse
+import datetime
+from typing import Dict, Iterator
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+TIMESTAMP_COLUMN = "created"
+VALUE_COLUMN = "origin"
+METRICS = ("requests_total", "cpu_usage")
+
+# rows written with one INSERT batch
+INSERT_CHUNK_SIZE = 10000
+
+
+def series_labels(series: int, labels: int, cardinality: int) -> pd.DataFrame:
+    """Returns the labels of every series, one row per series"""
+    columns = {"instance": [f"instance-{index}" for index in range(series)]}
+    for label in range(labels):
+        # a different stride per label, so the labels are not all correlated
+        codes = (np.arange(series) * (2 * label + 1) + label) % cardinality
+        columns[f"label_{label}"] = [f"value-{code}" for code in codes]
+    return pd.DataFrame(columns)
+
+
+def generate_frames(
+    metric: str,
+    labels: pd.DataFrame,
+    times: pd.DatetimeIndex,
+    rng: np.random.Generator,
+    series_per_frame: int,
+) -> Iterator[pd.DataFrame]:
+    """Yields the rows of a metric, a few series at a time"""
+    for first in range(0, len(labels), series_per_frame):
+        block = labels.iloc[first : first + series_per_frame]
+        shape = (len(block), len(times))
+        if metric == "requests_total":
+            values = np.cumsum(rng.random(shape) * 10, axis=1)
+            # a tenth of the series restart from zero half way
+            reset = np.arange(first, first + len(block)) % 10 == 0
+            middle = len(times) // 2
+            values[reset, middle:] -= values[reset, middle : middle + 1]
+        else:
+            values = rng.random(shape) * 100
+        frame = block.loc[block.index.repeat(len(times))].reset_index(drop=True)
+        frame[TIMESTAMP_COLUMN] = np.tile(times.values, len(block))
+        frame[VALUE_COLUMN] = values.ravel()
+        yield frame
+
+
+def generate(
+    db_url: str,
+    series: int = 100,
+    labels: int = 2,
+    cardinality: int = 10,
+    interval: float = 15,
+    span: float = 6 * 60 * 60,
+    end: datetime.datetime = None,
+    seed: int = 0,
+) -> Dict:
+    """Replaces the tables of METRICS in a database with synthetic samples
+
+    Args:
+        db_url (str): sqlalchemy url of the database
+        series (int, optional): number of series per metric. Defaults to 100.
+        labels (int, optional): number of labels besides `instance`.
+            Defaults to 2.
+        cardinality (int, optional): number of values of each of these
+            labels. Defaults to 10.
+        interval (float, optional): seconds between two samples of a series.
+            Defaults to 15.
+        span (float, optional): seconds covered by the samples. Defaults to
+            6 hours.
+        end (datetime.datetime, optional): time of the last sample. Defaults
+            to now, rounded down to the interval.
+        seed (int, optional): seed of the random values. Defaults to 0.
+
+    Returns:
+        Dict: the parameters of the data, including the number of rows
+    """
+    if end is None:
+        # naive UTC, like the default evaluation time of queries
+        end = pd.Timestamp.now("UTC").tz_localize(None)
+        end = end.floor(f"{int(interval * 1000)}ms").to_pydatetime()
+    times = pd.date_range(
+        end=end, periods=int(span // interval) + 1, freq=f"{int(interval * 1000)}ms"
+    )
+    rng = np.random.default_rng(seed)
+    label_frame = series_labels(series, labels, cardinality)
+    # about INSERT_CHUNK_SIZE rows per frame
+    series_per_frame = max(1, INSERT_CHUNK_SIZE // len(times))
+    engine = sqlalchemy.create_engine(db_url)
+    for metric in METRICS:
+        with engine.begin() as connection:
+            if_exists = "replace"
+            for frame in generate_frames(
+                metric, label_frame, times, rng, series_per_frame
+            ):
+                frame.to_sql(
+                    metric,
+                    connection,
+                    if_exists=if_exists,
+                    index=False,
+                    chunksize=INSERT_CHUNK_SIZE,
+                )
+                if_exists = "append"
+            connection.execute(
+                sqlalchemy.text(
+                    f"CREATE INDEX IF NOT EXISTS {metric}_{TIMESTAMP_COLUMN} "
+                    f"ON {metric} ({TIMESTAMP_COLUMN})"
+                )
+            )
+    engine.dispose()
+    return {
+        "db": db_url,
+        "metrics": list(METRICS),
+        "series": series,
+        "labels": labels,
+        "cardinality": cardinality,
+        "interval": interval,
+        "span": span,
+        "start": times[0].isoformat(),
+        "end": times[-1].isoformat(),
+        "seed": seed,
+        "rows_per_metric": series * len(times),
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--series", type=int, default=100, help="series per metric")
+    parser.add_argument(
+        "--labels", type=int, default=2, help="labels besides `instance`"
+    )
+    parser.add_argument(
+        "--cardinality", type=int, default=10, help="values of each label"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=15, help="seconds between samples"
+    )
+    parser.add_argument(
+        "--span", type=float, default=6 * 60 * 60, help="seconds of samples"
+    )
+    parser.add_argument(
+        "--end",
+        type=pd.Timestamp,
+        help="time of the last sample; defaults to now",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def generate_from_args(db_url: str, args: argparse.Namespace) -> Dict:
+    return generate(
+        db_url,
+        series=args.series,
+        labels=args.labels,
+        cardinality=args.cardinality,
+        interval=args.interval,
+        span=args.span,
+        end=args.end.to_pydatetime() if args.end is not None else None,
+        seed=args.seed,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="sqlite:///bench.db", help="database url")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    print(generate_from_args(args.db, args))
+
+
+if __name__ == "__main__":
+    main()
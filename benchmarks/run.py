@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""Times each stage of PromSQL over a standard set of queries
+
+The stages are timed separately:
+
+- `parse`: PromSqlParser.parse, with the query cache disabled
+- `transform`: PromSqlTransformer, building the node tree without evaluating
+- `fetch`: fetch_metric_data, for a range and for the latest samples
+- `resample`: align_to_steps of a fetched range, at every RANGE_STEP
+- `instant`: end to end evaluation of a query at the last sample
+- `range`: end to end evaluation of a range query over the last hour
+
+The caches are cleared before every repetition, so each one is a cold run.
+The results are written as JSON along with the commit and the versions of the
+dependencies; compare two result files with compare.py.
+
+    python benchmarks/run.py --generate --series 1000 --output before.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+import lark
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import promsql  # noqa: E402
+from promsql.backends import FETCH_BACKENDS  # noqa: E402
+from promsql.constants import DEFAULT_CONFIGS  # noqa: E402
+from promsql.fetch_cache import fetch_cache  # noqa: E402
+from promsql.query import query, query_range  # noqa: E402
+from promsql.range_functions import align_to_steps  # noqa: E402
+from promsql.results_cache import results_cache  # noqa: E402
+from promsql.series import SeriesSet  # noqa: E402
+from promsql.sql_miscs import fetch_metric_data  # noqa: E402
+
+import generate  # noqa: E402
+
+QUERIES = [
+    "cpu_usage",
+    'cpu_usage{label_0="value-1"}',
+    "cpu_usage > 50",
+    "sum by (label_0) (cpu_usage)",
+    "topk(5, cpu_usage)",
+    "rate(requests_total[5m])",
+    "sum by (label_0) (rate(requests_total[5m]))",
+    "avg_over_time(cpu_usage[10m])",
+    "rate(requests_total[5m]) / on(instance) cpu_usage",
+    "max_over_time(sum by (label_0) (cpu_usage)[30m:1m])",
+]
+
+# range fetched by the fetch, resample and range benchmarks
+BENCHMARK_RANGE = datetime.timedelta(hours=1)
+RANGE_STEP = 60
+
+
+def clear_caches():
+    fetch_cache.clear()
+    results_cache.clear()
+
+
+def measure(function: Callable, repeat: int, setup: Callable = None) -> Dict:
+    """Runs function repeat times and returns its durations in seconds"""
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        # the output of the nodes is not part of what is measured
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+    return {
+        "times": durations,
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.mean(durations),
+        "max": max(durations),
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe_data(db_url: str) -> Dict:
+    """Returns the number of rows and the time span of each metric table"""
+    engine = sqlalchemy.create_engine(db_url)
+    tables = dict()
+    with engine.connect() as connection:
+        for metric in generate.METRICS:
+            rows, first, last = connection.execute(
+                sqlalchemy.text(
+                    f"SELECT COUNT(*), MIN({generate.TIMESTAMP_COLUMN}), "
+                    f"MAX({generate.TIMESTAMP_COLUMN}) FROM {metric}"
+                )
+            ).one()
+            tables[metric] = {
+                "rows": rows,
+                "start": str(first),
+                "end": str(last),
+            }
+    engine.dispose()
+    return tables
+
+
+def run_benchmarks(
+    end: datetime.datetime, repeat: int, queries: List[str], stages: List[str]
+) -> Dict[str, Dict]:
+    """Times every stage of every query; see the module docstring"""
+    results = dict()
+    start = end - BENCHMARK_RANGE
+    parser = promsql.PromSqlParser(query_cache_size=0)
+
+    def add(stage: str, name: str, function: Callable, **extra):
+        if stage not in stages:
+            return
+        result = measure(function, repeat, setup=clear_caches)
+        result.update(stage=stage, **extra)
+        results[f"{stage}/{name}"] = result
+        print(f"{stage}/{name}: {result['median'] * 1000:.2f} ms", file=sys.stderr)
+
+    for text in queries:
+        add("parse", text, lambda: parser.parse(text), query=text)
+        tree = parser.parse(text)
+        transformer = promsql.PromSqlTransformer(evaluate=False)
+        add("transform", text, lambda: transformer.transform(tree), query=text)
+
+    for metric in generate.METRICS:
+        add(
+            "fetch",
+            f"{metric}[{BENCHMARK_RANGE}]",
+            lambda: fetch_metric_data(
+                metric, dict(), start_datetime=start, end_datetime=end
+            ),
+            metric=metric,
+        )
+        add(
+            "fetch",
+            f"{metric} latest",
+            lambda: fetch_metric_data(metric, dict(), end_datetime=end, latest=True),
+            metric=metric,
+        )
+    if "resample" in stages:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            df = fetch_metric_data(
+                "cpu_usage", dict(), start_datetime=start, end_datetime=end
+            )
+        series = SeriesSet.from_frame(df)
+        steps = pd.date_range(start, end, freq=f"{RANGE_STEP}s")
+        add(
+            "resample",
+            f"cpu_usage[{BENCHMARK_RANGE}]",
+            lambda: align_to_steps(
+                series, steps, DEFAULT_CONFIGS["LOOK_BEHIND_DURATION"]
+            ),
+            rows=len(df),
+        )
+
+    for text in queries:
+        add("instant", text, lambda: query(text, end), query=text)
+        add(
+            "range",
+            text,
+            lambda: query_range(text, start, end, RANGE_STEP),
+            query=text,
+            step=RANGE_STEP,
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="sqlite:///bench.db", help="database url")
+    parser.add_argument(
+        "--generate",
+        action="store_true",
+        help="fill the database first, see generate.py for the options",
+    )
+    generate.add_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--stage",
+        action="append",
+        choices=["parse", "transform", "fetch", "resample", "instant", "range"],
+        help="only run these stages; may be repeated",
+    )
+    parser.add_argument("--query", action="append", help="replaces the queries")
+    parser.add_argument(
+        "--fetch-backend",
+        choices=sorted(FETCH_BACKENDS),
+        help="FETCH_BACKEND config, see promsql/backends.py",
+    )
+    parser.add_argument("--output", default="-", help="result file, - for stdout")
+    args = parser.parse_args(argv)
+
+    data = generate.generate_from_args(args.db, args) if args.generate else None
+    DEFAULT_CONFIGS["DB"] = args.db
+    DEFAULT_CONFIGS["DIALECT"] = None
+    DEFAULT_CONFIGS["TIMESTAMP_COLUMN"] = generate.TIMESTAMP_COLUMN
+    DEFAULT_CONFIGS["VALUE_COLUMN"] = generate.VALUE_COLUMN
+    DEFAULT_CONFIGS["FETCH_BACKEND"] = args.fetch_backend
+    tables = describe_data(args.db)
+    end = pd.Timestamp(tables[generate.METRICS[0]]["end"]).to_pydatetime()
+
+    stages = args.stage or [
+        "parse",
+        "transform",
+        "fetch",
+        "resample",
+        "instant",
+        "range",
+    ]
+    results = run_benchmarks(end, args.repeat, args.query or QUERIES, stages)
+    report = {
+        "meta": {
+            "commit": get_commit(),
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "versions": {
+                "promsql": promsql.__version__,
+                "lark": lark.__version__,
+                "numpy": np.__version__,
+                "pandas": pd.__version__,
+                "sqlalchemy": sqlalchemy.__version__,
+            },
+            "db": args.db,
+            "generated": data,
+            "tables": tables,
+            "repeat": args.repeat,
+            "fetch_backend": args.fetch_backend,
+        },
+        "benchmarks": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
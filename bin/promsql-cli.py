@@ -1,15 +1,30 @@
 #!/usr/bin/env python
 
+import re
+
 from promsql import *
+from promsql.tracing import collect, trace
 from lark.exceptions import UnexpectedEOF
 
+# `EXPLAIN ANALYZE <query>` runs the query and prints the traced node tree
+EXPLAIN_ANALYZE = re.compile(r"^\s*explain\s+analyze\s+", re.IGNORECASE)
+
 if __name__ == "__main__":
     parser = PromSqlParser()
     transformer = PromSqlTransformer()
     while True:
         try:
             text = input("promsql > ")
-            tree = parser.parse(text)
-            print(transformer.transform(tree))
+            explain = EXPLAIN_ANALYZE.match(text)
+            if explain is None:
+                tree = parser.parse(text)
+                print(transformer.transform(tree))
+                continue
+            with collect() as root:
+                with trace("parse"):
+                    tree = parser.parse(text[explain.end() :])
+                result = transformer.transform(tree)
+            print(result)
+            print(root.format())
         except UnexpectedEOF as error:
             print(error)
@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+
+from promsql.server import main
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,16 @@
 from .version import __version__
 from .transformer import PromSqlTransformer
 from .parser import PromSqlParser
+from .limits import QueryLimitExceeded, QueryLimits, SampleLimitExceeded
+from .query import query_range
 
 # if somebody does "from promsql import *", this is what they will
 # be able to access:
-__all__ = ["PromSqlTransformer", "PromSqlParser"]
+__all__ = [
+    "PromSqlTransformer",
+    "PromSqlParser",
+    "QueryLimitExceeded",
+    "QueryLimits",
+    "SampleLimitExceeded",
+    "query_range",
+]
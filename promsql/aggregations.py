@@ -0,0 +1,475 @@
+"""Vectorized evaluation of PromQL aggregation operators"""
+
+import warnings
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .series import LabelSet, SeriesSet, combine_codes, factorize_label_sets
+
+GROUP_REDUCTIONS = ("sum", "avg", "min", "max", "count", "stddev", "stdvar")
+
+# average group size above which groups are reduced one at a time
+LOOP_GROUP_SIZE = 64
+
+# number of groups up to which sums are one matrix product, see group_sums
+MATMUL_GROUPS = 16
+
+# topk, bottomk and quantile narrow groups of more series than this down to
+# candidate samples, with the order statistics of this many of their series
+SAMPLE_ROWS = 4096
+
+
+def step_codes(times: np.ndarray, steps: np.ndarray) -> np.ndarray:
+    """Returns the position in steps of each timestamp, which steps holds"""
+    if len(steps) > 1:
+        interval = steps[1] - steps[0]
+        if (np.diff(steps) == interval).all():
+            return (times - steps[0]) // interval
+    return np.searchsorted(steps, times)
+
+
+def to_matrix(
+    vector: SeriesSet, steps: np.ndarray = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Spreads the samples of a vector over a series x step matrix
+
+    Args:
+        vector (SeriesSet): the instant vector
+        steps (np.ndarray, optional): sorted int64 nanosecond timestamps which
+            hold those of all the samples, e.g. the steps of a range query.
+            Defaults to the distinct timestamps of the samples.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the sorted nanosecond timestamps and
+            the values, NaN where a series has no sample at a timestamp. When
+            every series has a sample at every step, the values are a view
+            of those of the vector.
+    """
+    if steps is None:
+        time_codes, times = pd.factorize(vector.times, sort=True)
+        times = np.asarray(times, dtype=np.int64)
+    else:
+        times = np.asarray(steps, dtype=np.int64)
+        if len(vector.times) == len(vector) * len(times):
+            # the samples of a series are sorted by time, one per step
+            return times, vector.values.reshape(len(vector), len(times))
+        time_codes = step_codes(vector.times, times)
+    values = np.full((len(vector), len(times)), np.nan)
+    values[vector.sample_series(), time_codes] = vector.values
+    return times, values
+
+
+def nonzero(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the rows and columns of the True values of a matrix, like
+    np.nonzero but faster on C-contiguous matrices"""
+    return np.divmod(np.flatnonzero(mask), mask.shape[1])
+
+
+def sort_groups(group_codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the order which makes the series of each group contiguous
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: the order of the series,
+            and the start and size of each group in that order
+    """
+    order = np.argsort(group_codes, kind="stable")
+    sizes = np.bincount(group_codes)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    return order, starts, sizes
+
+
+def segment_reduce(
+    ufunc: np.ufunc,
+    values: np.ndarray,
+    order: np.ndarray,
+    starts: np.ndarray,
+    sizes: np.ndarray,
+) -> np.ndarray:
+    """Reduces the rows of each group with a ufunc
+
+    Large groups are reduced one slice at a time, which is several times
+    faster than ufunc.reduceat over axis 0; many small groups go through
+    reduceat to avoid a Python loop per group. A single group is reduced
+    without copying the rows.
+    """
+    if len(starts) == 1:
+        return ufunc.reduce(values, axis=0)[None]
+    if len(starts) * LOOP_GROUP_SIZE <= len(order):
+        return np.stack(
+            [
+                ufunc.reduce(values[order[start : start + size]], axis=0)
+                for start, size in zip(starts, sizes)
+            ]
+        )
+    return ufunc.reduceat(values[order], starts, axis=0)
+
+
+def group_sums(
+    values: np.ndarray,
+    group_codes: np.ndarray,
+    groups: Tuple[np.ndarray, np.ndarray, np.ndarray],
+) -> np.ndarray:
+    """Sums the rows of each group, like segment_reduce with np.add
+
+    Up to MATMUL_GROUPS groups are summed with one product by the indicator
+    matrix of the groups, which reads the values once without copying them.
+
+    Args:
+        values (np.ndarray): series x step matrix
+        group_codes (np.ndarray): the dense group code of each series
+        groups (Tuple[np.ndarray, np.ndarray, np.ndarray]): see sort_groups
+    """
+    if 1 < len(groups[1]) <= MATMUL_GROUPS:
+        indicator = np.zeros((len(groups[1]), len(group_codes)))
+        indicator[group_codes, np.arange(len(group_codes))] = 1.0
+        sums = indicator @ values
+        # the product spreads infinite and NaN values to every group
+        if np.isfinite(sums).all():
+            return sums
+    return segment_reduce(np.add, values, *groups)
+
+
+def reduce_groups(op: str, values: np.ndarray, group_codes: np.ndarray) -> np.ndarray:
+    """Reduces the series of each group at every step
+
+    Args:
+        op (str): one of GROUP_REDUCTIONS
+        values (np.ndarray): series x step matrix, NaN for missing samples
+        group_codes (np.ndarray): the dense group code of each series
+
+    Returns:
+        np.ndarray: group x step matrix, NaN where a group has no sample
+    """
+    groups = sort_groups(group_codes)
+    if op == "min":
+        return segment_reduce(np.fmin, values, *groups)
+    if op == "max":
+        return segment_reduce(np.fmax, values, *groups)
+    counts = np.repeat(groups[2][:, None].astype(np.float64), values.shape[1], 1)
+    missing = np.isnan(values)
+    if missing.any():
+        counts -= segment_reduce(np.add, missing, *groups)
+        if op != "count":
+            values = np.where(missing, 0.0, values)
+    else:
+        missing = None
+    if op == "count":
+        result = counts
+        result[counts == 0] = np.nan
+        return result
+    sums = group_sums(values, group_codes, groups)
+    with np.errstate(all="ignore"):
+        if op == "sum":
+            result = sums
+        elif op == "avg":
+            result = sums / counts
+        else:
+            means = sums / counts
+            deviations = values - means[group_codes]
+            if missing is not None:
+                deviations[missing] = 0.0
+            result = segment_reduce(np.add, deviations**2, *groups) / counts
+            if op == "stddev":
+                result = np.sqrt(result)
+    result[counts == 0] = np.nan
+    return result
+
+
+def sample_rows(values: np.ndarray) -> np.ndarray:
+    """Returns about SAMPLE_ROWS rows spread over a matrix, as a step x row
+    matrix"""
+    return np.ascontiguousarray(values[:: len(values) // SAMPLE_ROWS].T)
+
+
+def top_k(
+    values: np.ndarray, k: int, largest: bool = True
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Selects the k largest (or smallest) values of each column of a matrix
+    with more than k rows, leaving NaN out
+
+    With more than SAMPLE_ROWS rows, the k-th largest value of a sample of
+    the rows bounds the k-th largest of the column, so only the values
+    beyond it are sorted. The columns are partitioned with np.argpartition,
+    which runs in linear time, when there are too many of them, e.g. because
+    many rows hold the same value.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the row and the column of each
+            selected value
+    """
+    rows, width = values.shape
+    fill = -np.inf if largest else np.inf
+    if rows > SAMPLE_ROWS and k < SAMPLE_ROWS:
+        sample = sample_rows(values)
+        sample[np.isnan(sample)] = fill
+        size = sample.shape[1]
+        if largest:
+            bound = np.partition(sample, size - k, axis=1)[:, size - k]
+            candidates = np.flatnonzero(values >= bound)
+        else:
+            bound = np.partition(sample, k - 1, axis=1)[:, k - 1]
+            candidates = np.flatnonzero(values <= bound)
+        # about k * rows / size per column are expected
+        if len(candidates) <= 4 * k * width * (rows // SAMPLE_ROWS):
+            selected, steps = np.divmod(candidates, width)
+            found = values.ravel()[candidates]
+            order = np.lexsort((selected, -found if largest else found, steps))
+            steps = steps[order]
+            ranks = np.arange(len(order)) - np.searchsorted(steps, steps)
+            order = order[ranks < k]
+            return selected[order], steps[ranks < k]
+    # one contiguous row per step, so that the partition runs along rows
+    block = np.ascontiguousarray(values.T)
+    missing = np.isnan(block)
+    block[missing] = fill
+    if largest:
+        chosen = np.argpartition(block, rows - k, axis=1)[:, rows - k :]
+    else:
+        chosen = np.argpartition(block, k - 1, axis=1)[:, :k]
+    selected = chosen.ravel()
+    steps = np.repeat(np.arange(width), k)
+    present = ~missing[steps, selected]
+    return selected[present], steps[present]
+
+
+def select_k(
+    values: np.ndarray, group_codes: np.ndarray, k: int, largest: bool = True
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Selects the k largest (or smallest) samples of each group at every step
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the series and the step of each
+            selected sample
+    """
+    if k < 1:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    order, starts, sizes = sort_groups(group_codes)
+    large = sizes > k
+    series, steps = [], []
+    if not large.all():
+        # the groups of at most k series keep all their samples
+        rows = order[np.repeat(~large, sizes)]
+        small, at = nonzero(~np.isnan(values[rows]))
+        series.append(rows[small])
+        steps.append(at)
+    for start, size in zip(starts[large], sizes[large]):
+        rows = order[start : start + size]
+        block = values if size == len(values) else values[rows]
+        selected, at = top_k(block, k, largest)
+        series.append(rows[selected])
+        steps.append(at)
+    return np.concatenate(series), np.concatenate(steps)
+
+
+def column_quantiles(values: np.ndarray, phi: float) -> np.ndarray:
+    """Computes the phi-quantile of the non-NaN values of each column of a
+    matrix of more than SAMPLE_ROWS rows, as np.nanquantile does
+
+    The values of a sample of the rows bracket the two values the quantile
+    is interpolated between, within a margin of three standard deviations of
+    their rank in the sample. One pass over the rows counts the values below
+    each bracket and collects those within it, which are few enough to be
+    partitioned column by column. The columns where the bracket misses the
+    quantile, and all of them when too many values fall in the brackets, go
+    through np.nanquantile.
+
+    Returns:
+        np.ndarray: the quantile of each column, NaN for the empty ones
+    """
+    rows, width = values.shape
+    counts = np.full(width, rows)
+    if np.isnan(values.sum(axis=0)).any():
+        counts = rows - np.isnan(values).sum(axis=0)
+    position = np.maximum(counts - 1, 0) * phi
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, np.maximum(counts - 1, 0))
+    weight = position - low
+
+    sample = np.sort(sample_rows(values), axis=1)
+    present = sample.shape[1] - np.isnan(sample).sum(axis=1)
+    scale = np.maximum(present - 1, 0) / np.maximum(counts - 1, 1)
+    margin = np.ceil(3 * np.sqrt(present * phi * (1 - phi))).astype(np.int64) + 2
+    first = np.floor(low * scale).astype(np.int64) - margin
+    last = np.ceil(high * scale).astype(np.int64) + margin
+    columns = np.arange(width)
+    lower = np.where(first >= 0, sample[columns, np.clip(first, 0, None)], -np.inf)
+    upper = np.where(
+        last < present,
+        sample[columns, np.clip(last, 0, sample.shape[1] - 1)],
+        np.inf,
+    )
+
+    below = np.zeros(width, dtype=np.int64)
+    candidates = []
+    # 255 rows at a time, which are counted in uint8 and stay in cache
+    for start in range(0, rows, 255):
+        chunk = values[start : start + 255]
+        under = chunk < lower
+        below += under.view(np.uint8).sum(axis=0, dtype=np.uint8)
+        inside = chunk <= upper
+        inside &= ~under
+        candidates.append(np.flatnonzero(inside) + start * width)
+    candidates = np.concatenate(candidates)
+    if len(candidates) > rows * width // 8:
+        return np.nanquantile(values, phi, axis=0)
+    steps = candidates % width
+    # grouped by column, with a radix sort for up to 65536 columns
+    order = np.argsort(
+        steps.astype(np.uint16 if width <= 65536 else np.int64), kind="stable"
+    )
+    found = values.ravel()[candidates[order]]
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(steps, minlength=width))))
+    sizes = np.diff(bounds)
+
+    result = np.full(width, np.nan)
+    # the columns whose bracket holds both values
+    valid = (counts > 0) & (below <= low) & (below + sizes > high)
+    for column in np.flatnonzero(valid):
+        ranks = [low[column] - below[column], high[column] - below[column]]
+        bracket = np.partition(found[bounds[column] : bounds[column + 1]], ranks)
+        left, right = bracket[ranks]
+        if left == right:
+            result[column] = left
+        elif weight[column] >= 0.5:
+            result[column] = right - (right - left) * (1 - weight[column])
+        else:
+            result[column] = left + (right - left) * weight[column]
+    missed = np.flatnonzero(~valid & (counts > 0))
+    if len(missed):
+        result[missed] = np.nanquantile(values[:, missed], phi, axis=0)
+    return result
+
+
+def quantile_groups(
+    values: np.ndarray, group_codes: np.ndarray, phi: float
+) -> np.ndarray:
+    """Computes the phi-quantile of each group at every step
+
+    Returns:
+        np.ndarray: group x step matrix, NaN where a group has no sample
+    """
+    order, starts, sizes = sort_groups(group_codes)
+    result = np.full((len(starts), values.shape[1]), np.nan)
+    single = sizes == 1
+    result[single] = values[order[starts[single]]]
+    clipped = min(max(phi, 0.0), 1.0)
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        # all-NaN steps of a group
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for group in np.flatnonzero(~single):
+            rows = order[starts[group] : starts[group] + sizes[group]]
+            block = values if sizes[group] == len(values) else values[rows]
+            if sizes[group] > SAMPLE_ROWS:
+                result[group] = column_quantiles(block, clipped)
+            else:
+                result[group] = np.nanquantile(block, clipped, axis=0)
+    if phi < 0 or phi > 1:
+        result[~np.isnan(result)] = -np.inf if phi < 0 else np.inf
+    return result
+
+
+def first_positions(codes: np.ndarray, size: int) -> np.ndarray:
+    """Returns the position of the first occurrence of each of size codes"""
+    first = np.empty(size, dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes) - 1, -1, -1)
+    return first
+
+
+def format_value(value: float) -> str:
+    """Formats a sample value like Prometheus does for count_values"""
+    if np.isnan(value):
+        return "NaN"
+    if np.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return np.format_float_positional(value, trim="-")
+
+
+def aggregate(
+    op: str,
+    vector: SeriesSet,
+    grouping: Optional[List[str]] = None,
+    without: bool = False,
+    param=None,
+    steps: np.ndarray = None,
+) -> SeriesSet:
+    """Evaluates an aggregation operator
+
+    The samples are spread over a series x step matrix and every series gets
+    the code of its `by`/`without` label set, computed once per series; the
+    samples are then reduced with grouped NumPy operations. With the steps
+    the vector was evaluated at, the samples are placed by step rather than
+    by factorizing their timestamps, and a vector with a sample at every
+    step is used as the matrix as it is.
+
+    Args:
+        op (str): the aggregation operator
+        vector (SeriesSet): the instant vector to aggregate
+        grouping (List[str], optional): the `by` or `without` labels
+        without (bool, optional): whether grouping lists the labels to drop.
+            Defaults to False.
+        param (optional): the parameter of topk, bottomk, quantile and
+            count_values
+        steps (np.ndarray, optional): the sorted int64 nanosecond timestamps
+            the vector was evaluated at, e.g. the steps of a range query
+
+    Raises:
+        ValueError: for unknown operators
+
+    Returns:
+        SeriesSet: the aggregated vector
+    """
+    op = str(op)
+    grouping = frozenset(grouping or [])
+    if len(vector) == 0:
+        return SeriesSet.empty()
+    times, values = to_matrix(vector, steps)
+    if not grouping and not without:
+        # one group without labels
+        group_codes = np.zeros(len(vector), dtype=np.int64)
+        group_labels = [LabelSet.from_items(())]
+    else:
+        if without:
+            group_sets = [label_set.drop(grouping) for label_set in vector.labels]
+        else:
+            group_sets = [label_set.keep(grouping) for label_set in vector.labels]
+        group_codes = factorize_label_sets(group_sets)
+        first = first_positions(group_codes, int(group_codes.max()) + 1)
+        group_labels = [group_sets[position] for position in first]
+
+    if op in GROUP_REDUCTIONS:
+        return SeriesSet.from_matrix(
+            group_labels, times, reduce_groups(op, values, group_codes)
+        )
+    if op == "quantile":
+        return SeriesSet.from_matrix(
+            group_labels, times, quantile_groups(values, group_codes, float(param))
+        )
+    if op in ("topk", "bottomk"):
+        series, at = select_k(values, group_codes, int(param), largest=op == "topk")
+        return SeriesSet.from_samples(
+            vector.labels, series, times[at], values[series, at]
+        )
+    if op == "count_values":
+        series, at = nonzero(~np.isnan(values))
+        value_codes, uniques = pd.factorize(values[series, at])
+        groups = group_codes[series]
+        # one output series per group and value, one sample per step
+        series_codes = combine_codes([groups, value_codes], len(series))
+        keys = combine_codes([series_codes, at], len(series))
+        counts = np.bincount(keys)
+        first = first_positions(keys, len(counts))
+        first_series = first_positions(series_codes, int(series_codes.max()) + 1)
+        formatted = [format_value(value) for value in uniques]
+        labels = [
+            group_labels[group].set(str(param), formatted[value])
+            for group, value in zip(groups[first_series], value_codes[first_series])
+        ]
+        return SeriesSet.from_samples(
+            labels,
+            series_codes[first],
+            times[at[first]],
+            counts.astype(np.float64),
+        )
+    raise ValueError(f"Unknown aggregation operator: {op}")
@@ -0,0 +1,291 @@
+"""Backends which read the rows of selector statements into the long format
+
+A backend turns the rows of a selector statement into a frame with one
+column per label plus VAL_COL and TIME_COL (see fetch_metric_data), and is
+picked with the FETCH_BACKEND config:
+
+- "pandas": the rows go through sqlalchemy result rows into per-series
+  arrays (see stream_select). It is the reference the other backends are
+  checked against.
+- "numpy": the statement is compiled by sqlalchemy but run on a plain DBAPI
+  cursor, and each batch of rows is decoded column by column into typed
+  buffers (see ColumnBuffers): dictionary encoded labels, float64 values and
+  int64 nanosecond timestamps, parsed by numpy.
+- "arrow": drivers which return Arrow record batches, such as DuckDB or
+  ADBC drivers, are read without building rows at all; the Arrow columns are
+  copied into the same buffers. It needs pyarrow, and falls back to "numpy"
+  without it or for other drivers.
+
+Without the config, the databases whose drivers have server-side cursors,
+e.g. PostgreSQL and MySQL, are read by "pandas": their plain cursors hold the
+whole result in memory before the first row is fetched. The others, e.g.
+SQLite and DuckDB, whose plain cursors step through the result, are read by
+"arrow".
+
+Other backends can be added to FETCH_BACKENDS, or set as the config
+directly; see FetchBackend.
+"""
+
+import functools
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from promsql.limits import SampleLimitExceeded
+from promsql.streaming import (
+    DEFAULT_BATCH_SIZE,
+    ColumnBuffers,
+    decode_times,
+    stream_select,
+)
+
+try:
+    import pyarrow
+    import pyarrow.compute
+except ImportError:  # pyarrow is optional, see ArrowBackend
+    pyarrow = None
+
+# number of compiled selector statements kept by compile_statement
+COMPILED_CACHE_SIZE = 512
+
+
+class FetchBackend:
+    """Reads the rows of a selector statement
+
+    Subclasses implement read, which takes the arguments of stream_select
+    and returns what it does.
+    """
+
+    def read(
+        self,
+        engine: sqlalchemy.engine.Engine,
+        statement,
+        params: Dict,
+        tag_columns: List[str],
+        value_column: str,
+        timestamp_column: str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_samples: int = None,
+        on_batch: Callable[[List[Tuple], int], None] = None,
+    ) -> pd.DataFrame:
+        raise NotImplementedError()
+
+
+class PandasBackend(FetchBackend):
+    """Reads the rows through sqlalchemy; see stream_select"""
+
+    def read(self, *args, **kwargs) -> pd.DataFrame:
+        return stream_select(*args, **kwargs)
+
+
+@functools.lru_cache(maxsize=COMPILED_CACHE_SIZE)
+def get_compiled(statement, dialect: sqlalchemy.engine.Dialect):
+    """Compiles a statement for a dialect
+
+    Returns:
+        Tuple: the compiled statement, and the bind processors of the types
+            of its parameters by parameter name
+    """
+    compiled = statement.compile(dialect=dialect)
+    processors = dict()
+    for bind, name in compiled.bind_names.items():
+        processor = bind.type.dialect_impl(dialect).bind_processor(dialect)
+        if processor is not None:
+            processors[name] = processor
+    return compiled, processors
+
+
+def compile_statement(statement, params: Dict, dialect: sqlalchemy.engine.Dialect):
+    """Returns the SQL text and the DBAPI parameters of a statement
+
+    The expanding parameters, e.g. the values of `IN` lists, are rendered
+    and the parameters go through the bind processors of their types, as
+    when sqlalchemy executes the statement itself.
+
+    Returns:
+        Tuple[str, Union[Tuple, Dict]]: the SQL and its parameters, in the
+            paramstyle of the dialect
+    """
+    compiled, processors = get_compiled(statement, dialect)
+    state = compiled.construct_expanded_state(params)
+    # the parameters rendered by the expansion have processors of their own
+    processors = {**processors, **state.processors}
+    parameters = {
+        name: processors[name](value) if name in processors else value
+        for name, value in state.parameters.items()
+    }
+    if state.positiontup is not None:
+        return state.statement, tuple(parameters[name] for name in state.positiontup)
+    return state.statement, parameters
+
+
+class NumpyBackend(FetchBackend):
+    """Runs the statement on a DBAPI cursor and decodes the rows column by
+    column into ColumnBuffers
+
+    The rows are fetched `batch_size` at a time with fetchmany. Drivers such
+    as psycopg2 keep the whole result of a plain cursor in their own buffers
+    before the first batch, which is why the databases with server-side
+    cursors are read by the "pandas" backend unless FETCH_BACKEND says
+    otherwise.
+    """
+
+    def read(
+        self,
+        engine: sqlalchemy.engine.Engine,
+        statement,
+        params: Dict,
+        tag_columns: List[str],
+        value_column: str,
+        timestamp_column: str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_samples: int = None,
+        on_batch: Callable[[List[Tuple], int], None] = None,
+    ) -> pd.DataFrame:
+        sql, parameters = compile_statement(statement, params, engine.dialect)
+        buffers = ColumnBuffers(tag_columns)
+        with engine.connect() as connection:
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute(sql, parameters)
+                names = [column[0] for column in cursor.description]
+                positions = (
+                    [names.index(tag) for tag in tag_columns],
+                    names.index(value_column),
+                    names.index(timestamp_column),
+                )
+                for batch in self.batches(cursor, batch_size, positions):
+                    tags, values, times, tz = batch
+                    if (
+                        max_samples is not None
+                        and len(buffers) + len(values) > max_samples
+                    ):
+                        raise SampleLimitExceeded(
+                            max_samples, len(buffers) + len(values)
+                        )
+                    buffers.tz = buffers.tz or tz
+                    codes = buffers.append(tags, values, times)
+                    if on_batch is not None:
+                        on_batch(buffers.new_series(codes, len(values)), len(values))
+            finally:
+                cursor.close()
+        return buffers.to_frame()
+
+    def batches(self, cursor, batch_size: int, positions: Tuple):
+        """Yields the batches of rows of cursor decoded into columns
+
+        Args:
+            cursor: the DBAPI cursor, after the statement was executed
+            batch_size (int): rows per batch
+            positions (Tuple): the positions of the tag columns, of the value
+                column and of the timestamp column in the rows
+
+        Yields:
+            Tuple: for each tag column the codes and distinct values of the
+                batch, the float64 values, the int64 nanosecond timestamps
+                and their timezone
+        """
+        tag_positions, value_position, time_position = positions
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            columns = list(zip(*rows))
+            times, tz = decode_times(columns[time_position])
+            yield (
+                [
+                    pd.factorize(np.asarray(columns[position], dtype=object))
+                    for position in tag_positions
+                ],
+                np.asarray(columns[value_position], dtype=np.float64),
+                times,
+                tz,
+            )
+
+
+class ArrowBackend(NumpyBackend):
+    """Reads Arrow record batches from the drivers which return them, e.g.
+    DuckDB or ADBC drivers, instead of rows; the other drivers are read like
+    NumpyBackend does
+
+    The labels come out of Arrow dictionary encoded and the values and
+    timestamps as typed arrays, so no Python object is created per row.
+    """
+
+    def batches(self, cursor, batch_size: int, positions: Tuple):
+        if pyarrow is None or not hasattr(cursor, "fetch_record_batch"):
+            yield from super().batches(cursor, batch_size, positions)
+            return
+        try:
+            reader = cursor.fetch_record_batch(batch_size)
+        except TypeError:
+            # the ADBC cursors pick the size of their batches
+            reader = cursor.fetch_record_batch()
+        tag_positions, value_position, time_position = positions
+        for batch in reader:
+            if batch.num_rows == 0:
+                continue
+            times, tz = self.decode_times(batch.column(time_position))
+            yield (
+                [
+                    self.decode_tags(batch.column(position))
+                    for position in tag_positions
+                ],
+                pyarrow.compute.cast(
+                    batch.column(value_position), pyarrow.float64()
+                ).to_numpy(zero_copy_only=False),
+                times,
+                tz,
+            )
+
+    @staticmethod
+    def decode_tags(array) -> Tuple[np.ndarray, List]:
+        """Returns the codes and the dictionary of a label column"""
+        if not pyarrow.types.is_dictionary(array.type):
+            array = array.dictionary_encode()
+        codes = pyarrow.compute.fill_null(array.indices, -1)
+        return codes.to_numpy(zero_copy_only=False), array.dictionary.to_pylist()
+
+    @staticmethod
+    def decode_times(array) -> Tuple[np.ndarray, object]:
+        """Returns the int64 nanoseconds since the epoch of a timestamp
+        column and its timezone"""
+        if pyarrow.types.is_timestamp(array.type):
+            nanoseconds = array.cast(pyarrow.timestamp("ns", array.type.tz))
+            times = nanoseconds.cast(pyarrow.int64()).to_numpy(zero_copy_only=False)
+            return times.astype(np.int64, copy=False), array.type.tz
+        return decode_times(array.to_numpy(zero_copy_only=False))
+
+
+FETCH_BACKENDS = {
+    "pandas": PandasBackend(),
+    "numpy": NumpyBackend(),
+    "arrow": ArrowBackend(),
+}
+
+
+def get_fetch_backend(configs: Dict) -> FetchBackend:
+    """Returns the backend of the FETCH_BACKEND config: the name of one of
+    FETCH_BACKENDS, a FetchBackend, or None for "pandas" on the databases
+    with server-side cursors and "arrow" on the others
+
+    Raises:
+        ValueError: for unknown backends
+    """
+    backend = configs.get("FETCH_BACKEND")
+    if backend is None:
+        engine = configs["DB"]
+        streams = isinstance(engine, sqlalchemy.engine.Engine) and bool(
+            engine.dialect.supports_server_side_cursors
+        )
+        backend = "pandas" if streams else "arrow"
+    if isinstance(backend, FetchBackend):
+        return backend
+    if backend not in FETCH_BACKENDS:
+        raise ValueError(
+            f"unknown fetch backend {backend!r}, "
+            f"expected one of {', '.join(FETCH_BACKENDS)}"
+        )
+    return FETCH_BACKENDS[backend]
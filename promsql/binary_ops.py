@@ -0,0 +1,302 @@
+"""Vectorized evaluation of PromQL binary operators"""
+
+from typing import AbstractSet, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .series import LabelSet, SeriesSet, combine_codes, factorize_label_sets
+
+ARITHMETIC_FUNCTIONS = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+    "%": np.fmod,
+    "^": np.power,
+}
+
+COMPARISON_FUNCTIONS = {
+    "==": np.equal,
+    "!=": np.not_equal,
+    ">": np.greater,
+    "<": np.less,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+}
+
+SET_OPERATORS = ("and", "or", "unless")
+
+
+def is_scalar(value) -> bool:
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+
+
+def match_codes(
+    left: SeriesSet,
+    right: SeriesSet,
+    matching_labels: Optional[List[str]],
+    on: bool,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the codes of the match groups of the samples of both sides
+
+    Two samples are in the same group when they have the same timestamp and
+    the same values for the `on` labels, or for all labels but the `ignoring`
+    ones. The label signature is computed once per series, not per sample.
+    """
+    matching_labels = frozenset(matching_labels or [])
+    signatures = [
+        label_set.keep(matching_labels) if on else label_set.drop(matching_labels)
+        for label_set in left.labels + right.labels
+    ]
+    series_codes = factorize_label_sets(signatures)
+    series_codes = np.concatenate(
+        (
+            series_codes[: len(left)][left.sample_series()],
+            series_codes[len(left) :][right.sample_series()],
+        )
+    )
+    time_codes, _ = pd.factorize(np.concatenate((left.times, right.times)))
+    combined = combine_codes(
+        [series_codes, time_codes.astype(np.int64)], len(series_codes)
+    )
+    return combined[: len(left.values)], combined[len(left.values) :]
+
+
+def get_indexer(right_codes: np.ndarray, left_codes: np.ndarray) -> np.ndarray:
+    """Returns the position of each left code in right_codes, -1 if absent
+
+    right_codes must be unique.
+    """
+    return pd.Index(right_codes).get_indexer(left_codes)
+
+
+def result_labels(
+    label_set: LabelSet, matching_labels: AbstractSet[str], on: bool, card: str
+) -> LabelSet:
+    """Drops the labels which one-to-one matching does not keep"""
+    if card != "OneToOne":
+        return label_set
+    if on:
+        return label_set.keep(matching_labels)
+    return label_set.drop(matching_labels)
+
+
+def compute(op: str, left: np.ndarray, right: np.ndarray, return_bool: bool):
+    """Applies an arithmetic or comparison operator element-wise
+
+    Returns:
+        the values, and for comparisons without `bool` the mask of the
+        elements to keep (None otherwise)
+    """
+    with np.errstate(all="ignore"):
+        if op in ARITHMETIC_FUNCTIONS:
+            return ARITHMETIC_FUNCTIONS[op](left, right), None
+        mask = COMPARISON_FUNCTIONS[op](left, right)
+    if return_bool:
+        return mask.astype(np.float64), None
+    return left, mask
+
+
+def scalar_binary_operation(
+    op: str, left: float, right: float, return_bool: bool
+) -> float:
+    if op in SET_OPERATORS:
+        raise ValueError(f"set operator {op} not allowed in binary scalar expression")
+    if op in COMPARISON_FUNCTIONS and not return_bool:
+        raise ValueError("comparisons between scalars must use BOOL modifier")
+    values, _ = compute(op, np.float64(left), np.float64(right), return_bool)
+    return float(values)
+
+
+def vector_scalar_operation(
+    op: str,
+    vector: SeriesSet,
+    scalar: float,
+    scalar_on_left: bool,
+    return_bool: bool,
+) -> SeriesSet:
+    if op in SET_OPERATORS:
+        raise ValueError(f"set operator {op} not allowed in binary scalar expression")
+    values = vector.values
+    if scalar_on_left:
+        result, mask = compute(op, np.float64(scalar), values, return_bool)
+    else:
+        result, mask = compute(op, values, np.float64(scalar), return_bool)
+    if mask is not None:
+        # comparisons keep the value of the vector, on whichever side it is
+        return vector.filter(mask)
+    return vector.with_values(np.asarray(result, dtype=np.float64))
+
+
+def set_operation(op: str, left: SeriesSet, right: SeriesSet, matching) -> SeriesSet:
+    matching_labels = matching.matching_labels if matching else None
+    on = bool(matching.on) if matching else False
+    left_codes, right_codes = match_codes(left, right, matching_labels, on)
+    if op == "and":
+        return left.filter(np.isin(left_codes, right_codes))
+    if op == "unless":
+        return left.filter(~np.isin(left_codes, right_codes))
+    # `or` adds the right hand side series whose group is not on the left
+    extra = right.filter(~np.isin(right_codes, left_codes))
+    if len(extra) == 0:
+        return left
+    if len(left) == 0:
+        return extra
+    return SeriesSet.from_samples(
+        left.labels + extra.labels,
+        np.concatenate((left.sample_series(), extra.sample_series() + len(left))),
+        np.concatenate((left.times, extra.times)),
+        np.concatenate((left.values, extra.values)),
+    )
+
+
+def output_labels(
+    many: SeriesSet,
+    one: SeriesSet,
+    many_series: np.ndarray,
+    one_series: np.ndarray,
+    matching_labels: AbstractSet[str],
+    on: bool,
+    card: str,
+    include: List[str],
+) -> Tuple[List[LabelSet], np.ndarray]:
+    """Computes the labels of the results, once per pair of matched series
+
+    Returns:
+        Tuple[List[LabelSet], np.ndarray]: the label sets and, for each
+            result sample, the position of its label set
+    """
+    if not include:
+        labels = [
+            result_labels(label_set, matching_labels, on, card)
+            for label_set in many.labels
+        ]
+        return labels, many_series
+    _, first, positions = np.unique(
+        combine_codes([many_series, one_series], len(many_series)),
+        return_index=True,
+        return_inverse=True,
+    )
+    labels = []
+    for many_position, one_position in zip(many_series[first], one_series[first]):
+        label_set = result_labels(many.labels[many_position], matching_labels, on, card)
+        one_labels = one.labels[one_position]
+        for label in include:
+            value = one_labels.get(label, None)
+            if value is None:
+                label_set = label_set.drop({label})
+            else:
+                label_set = label_set.set(label, value)
+        labels.append(label_set)
+    return labels, positions
+
+
+def vector_vector_operation(
+    op: str,
+    left: SeriesSet,
+    right: SeriesSet,
+    matching,
+    return_bool: bool,
+) -> SeriesSet:
+    card = (matching.card if matching else None) or "OneToOne"
+    matching_labels = frozenset((matching.matching_labels if matching else None) or [])
+    on = bool(matching.on) if matching else False
+    include = list((matching.include if matching else None) or [])
+
+    # the many side is treated as the left hand side, like Prometheus does
+    swapped = card == "OneToMany"
+    left_codes, right_codes = match_codes(left, right, matching_labels, on)
+    many, one = (right, left) if swapped else (left, right)
+    many_codes, one_codes = (
+        (right_codes, left_codes) if swapped else (left_codes, right_codes)
+    )
+
+    if pd.Index(one_codes).has_duplicates:
+        side = "left" if swapped else "right"
+        raise ValueError(
+            f"found duplicate series for the match group on the {side} hand-side "
+            "of the operation; many-to-many matching not allowed"
+        )
+    if card == "OneToOne" and pd.Index(many_codes).has_duplicates:
+        raise ValueError(
+            "multiple matches for labels: many-to-one matching must be explicit "
+            "(group_left/group_right)"
+        )
+
+    positions = get_indexer(one_codes, many_codes)
+    matched = positions >= 0
+    many_rows = np.flatnonzero(matched)
+    one_rows = positions[matched]
+
+    many_values = many.values[many_rows]
+    one_values = one.values[one_rows]
+    if swapped:
+        values, mask = compute(op, one_values, many_values, return_bool)
+    else:
+        values, mask = compute(op, many_values, one_values, return_bool)
+    if mask is not None:
+        many_rows, one_rows, values = many_rows[mask], one_rows[mask], values[mask]
+
+    labels, series = output_labels(
+        many,
+        one,
+        many.sample_series()[many_rows],
+        one.sample_series()[one_rows],
+        matching_labels,
+        on,
+        card,
+        include,
+    )
+    result = SeriesSet.from_samples(labels, series, many.times[many_rows], values)
+
+    if card != "OneToOne" and len(result.values) > 1:
+        same_series = np.diff(result.sample_series()) == 0
+        if (same_series & (np.diff(result.times) == 0)).any():
+            raise ValueError(
+                "multiple matches for labels: grouping labels must ensure "
+                "unique matches"
+            )
+    return result
+
+
+def binary_operation(
+    op: str,
+    left: Union[SeriesSet, float],
+    right: Union[SeriesSet, float],
+    bin_modifier=None,
+) -> Union[SeriesSet, float]:
+    """Evaluates a binary operator between instant vectors and scalars
+
+    Vectors are matched on the codes of their label signatures (see
+    match_codes) with a hash join, so the cost does not depend on the number
+    of series beyond the factorization. Samples are matched per timestamp,
+    which lets a series set hold several evaluation steps.
+
+    Args:
+        op (str): the operator
+        left (Union[SeriesSet, float]): the left hand side
+        right (Union[SeriesSet, float]): the right hand side
+        bin_modifier (BinaryExpr, optional): the `bool` flag and the vector
+            matching of the operator
+
+    Raises:
+        ValueError: for invalid operands or matchings
+
+    Returns:
+        Union[SeriesSet, float]: the result
+    """
+    op = str(op)
+    return_bool = bool(bin_modifier.return_bool) if bin_modifier else False
+    matching = bin_modifier.vector_matching if bin_modifier else None
+    if return_bool and op not in COMPARISON_FUNCTIONS:
+        raise ValueError("bool modifier can only be used on comparison operators")
+    if is_scalar(left) and is_scalar(right):
+        return scalar_binary_operation(op, left, right, return_bool)
+    if is_scalar(left):
+        return vector_scalar_operation(op, right, left, True, return_bool)
+    if is_scalar(right):
+        return vector_scalar_operation(op, left, right, False, return_bool)
+    if op in SET_OPERATORS:
+        return set_operation(op, left, right, matching)
+    return vector_vector_operation(op, left, right, matching, return_bool)
@@ -0,0 +1,475 @@
+"""Caches the schema of the metric tables and resolves metrics to them"""
+
+import re
+import threading
+import time
+import weakref
+from typing import Callable, Dict, List, Optional, Tuple
+
+import sqlalchemy
+
+from .constants import ROLLUP_TABLE_FORMAT
+
+# the names of rollup tables, which are not metrics
+ROLLUP_TABLE_REGEX = re.compile(
+    re.escape(ROLLUP_TABLE_FORMAT)
+    .replace(re.escape("{table_name}"), ".+")
+    .replace(re.escape("{resolution}"), "[0-9]+")
+)
+
+
+class SchemaCatalog:
+    """Reads the columns of each table once through the sqlalchemy inspector
+
+    The schemas are cached per engine, so engines pointing at different
+    databases never share entries, and the entries of an engine go away with
+    it. Call `invalidate` after altering a table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schemas = weakref.WeakKeyDictionary()
+        self._table_names = weakref.WeakKeyDictionary()
+
+    def get_columns(
+        self, engine: sqlalchemy.engine.Engine, table_name: str
+    ) -> List[Dict]:
+        """Returns the columns of a table as reported by the inspector
+
+        Args:
+            engine (sqlalchemy.engine.Engine): the engine of the database
+            table_name (str): name of the table
+
+        Returns:
+            List[Dict]: one dict per column with at least `name` and `type`
+        """
+        with self._lock:
+            tables = self._schemas.setdefault(engine, dict())
+            if table_name in tables:
+                return tables[table_name]
+        columns = sqlalchemy.inspect(engine).get_columns(table_name)
+        with self._lock:
+            self._schemas.setdefault(engine, dict())[table_name] = columns
+        return columns
+
+    def get_column_names(
+        self, engine: sqlalchemy.engine.Engine, table_name: str
+    ) -> List[str]:
+        return [column["name"] for column in self.get_columns(engine, table_name)]
+
+    def get_table_names(self, engine: sqlalchemy.engine.Engine) -> List[str]:
+        """Returns the names of the tables of a database, read once"""
+        with self._lock:
+            names = self._table_names.get(engine)
+        if names is None:
+            names = sqlalchemy.inspect(engine).get_table_names()
+            with self._lock:
+                self._table_names[engine] = names
+        return names
+
+    def invalidate(
+        self,
+        engine: Optional[sqlalchemy.engine.Engine] = None,
+        table_name: Optional[str] = None,
+    ):
+        """Drops cached schemas
+
+        Args:
+            engine (sqlalchemy.engine.Engine, optional): only drop the schemas
+                of this engine. Defaults to all engines.
+            table_name (str, optional): only drop the schema of this table.
+                Defaults to all tables.
+        """
+        with self._lock:
+            engines = [engine] if engine is not None else list(self._schemas.keys())
+            if table_name is None and engine is None:
+                self._table_names.clear()
+            elif table_name is None:
+                self._table_names.pop(engine, None)
+            for key in engines:
+                tables = self._schemas.get(key)
+                if tables is None:
+                    continue
+                if table_name is None:
+                    tables.clear()
+                else:
+                    tables.pop(table_name, None)
+
+
+schema_catalog = SchemaCatalog()
+
+
+class LabelValues:
+    """The distinct values of a label column, up to a timestamp"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = set()
+        # the most recent timestamp of the rows which have been read
+        self.high_water = None
+        self.refreshed_at = None
+        # matching values of the regexes, until new values are read
+        self.matches = dict()
+
+
+class LabelIndex:
+    """Keeps the distinct values of the label columns of the metric tables
+
+    The values of a column are read once, along with the most recent
+    timestamp of the table. Afterwards, a lookup more than refresh_interval
+    seconds after the last read only reads the values of the rows with a
+    more recent timestamp, so the index grows with the new series and never
+    reads the whole table again. Values which disappear from the table stay
+    in the index until `invalidate` is called.
+
+    It resolves regex label matchers for the databases without a regex
+    operator (see get_regex_match_strategy) and lists the values of labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._columns = weakref.WeakKeyDictionary()
+
+    def get_entry(
+        self, engine: sqlalchemy.engine.Engine, table_name: str, column: str
+    ) -> LabelValues:
+        with self._lock:
+            columns = self._columns.setdefault(engine, dict())
+            entry = columns.get((table_name, column))
+            if entry is None:
+                entry = columns[(table_name, column)] = LabelValues()
+            return entry
+
+    def refresh(
+        self,
+        engine: sqlalchemy.engine.Engine,
+        table_name: str,
+        timestamp_column: str,
+        column: str,
+        entry: LabelValues,
+    ):
+        """Reads the values of the rows added since the last read of entry"""
+        table = sqlalchemy.table(
+            table_name,
+            sqlalchemy.column(timestamp_column, sqlalchemy.DateTime),
+            sqlalchemy.column(column),
+        )
+        timestamp = table.c[timestamp_column]
+        with engine.connect() as connection:
+            high_water = connection.execute(
+                sqlalchemy.select(sqlalchemy.func.max(timestamp))
+            ).scalar()
+            if high_water is not None and (
+                entry.high_water is None or high_water > entry.high_water
+            ):
+                select = sqlalchemy.select(table.c[column]).where(
+                    timestamp <= high_water
+                )
+                if entry.high_water is not None:
+                    select = select.where(timestamp > entry.high_water)
+                values = connection.execute(select.group_by(table.c[column]))
+                new_values = {value for value in values.scalars() if value is not None}
+                if not new_values.issubset(entry.values):
+                    entry.values.update(new_values)
+                    entry.matches.clear()
+                entry.high_water = high_water
+        entry.refreshed_at = time.monotonic()
+
+    def lookup(
+        self,
+        engine: sqlalchemy.engine.Engine,
+        table_name: str,
+        timestamp_column: str,
+        column: str,
+        refresh_interval: float = None,
+    ) -> LabelValues:
+        """Returns the entry of a column, read or refreshed if need be"""
+        entry = self.get_entry(engine, table_name, column)
+        with entry.lock:
+            if entry.refreshed_at is None or (
+                refresh_interval is not None
+                and time.monotonic() - entry.refreshed_at >= refresh_interval
+            ):
+                self.refresh(engine, table_name, timestamp_column, column, entry)
+        return entry
+
+    def get_values(
+        self,
+        engine: sqlalchemy.engine.Engine,
+        table_name: str,
+        timestamp_column: str,
+        column: str,
+        refresh_interval: float = None,
+    ) -> List:
+        """Returns the distinct values of a label column
+
+        Args:
+            engine (sqlalchemy.engine.Engine): the engine of the database
+            table_name (str): name of the table
+            timestamp_column (str): the timestamp column of the table
+            column (str): the label column
+            refresh_interval (float, optional): seconds after which the
+                values of new rows are read. Defaults to never.
+
+        Returns:
+            List: the values, sorted by their text
+        """
+        entry = self.lookup(
+            engine, table_name, timestamp_column, column, refresh_interval
+        )
+        with entry.lock:
+            return sorted(entry.values, key=str)
+
+    def find_values(
+        self,
+        engine: sqlalchemy.engine.Engine,
+        table_name: str,
+        timestamp_column: str,
+        column: str,
+        regex: re.Pattern,
+        refresh_interval: float = None,
+    ) -> List:
+        """Returns the values of a label column which regex matches entirely;
+        see get_values"""
+        entry = self.lookup(
+            engine, table_name, timestamp_column, column, refresh_interval
+        )
+        with entry.lock:
+            matches = entry.matches.get(regex)
+            if matches is None:
+                matches = sorted(
+                    (value for value in entry.values if regex.fullmatch(str(value))),
+                    key=str,
+                )
+                entry.matches[regex] = matches
+            return matches
+
+    def invalidate(
+        self,
+        engine: Optional[sqlalchemy.engine.Engine] = None,
+        table_name: Optional[str] = None,
+    ):
+        """Drops label values, so that they are read again from scratch
+
+        Args:
+            engine (sqlalchemy.engine.Engine, optional): only drop the values
+                of this engine. Defaults to all engines.
+            table_name (str, optional): only drop the values of this table.
+                Defaults to all tables.
+        """
+        with self._lock:
+            engines = [engine] if engine is not None else list(self._columns.keys())
+            for key in engines:
+                columns = self._columns.get(key, dict())
+                for table, column in list(columns):
+                    if table_name is None or table == table_name:
+                        del columns[(table, column)]
+
+
+label_index = LabelIndex()
+
+
+class MetricRule:
+    """A compiled entry of CUSTOM_CONFIGS
+
+    Args:
+        check: a regex matched against the start of the metric name, or a
+            function of the params of get_metric_configs
+        configs (Dict): the default configs updated with the configs of the
+            entry
+    """
+
+    def __init__(self, check, configs: Dict):
+        # regex checks only depend on the metric name, so their outcome can
+        # be cached per name
+        self.static = isinstance(check, str)
+        self.matches = re.compile(check).match if self.static else check
+        self.configs = configs
+        # configs without functions do not depend on the labels or time range
+        self.constant = not any(callable(value) for value in configs.values())
+
+
+class MetricCatalog:
+    """Resolves metric names to their configs, tables and engines
+
+    The config rules are compiled the first time a metric is resolved: the
+    regexes once, and each rule merged once with the default configs. For
+    every metric name, the rules which can apply are then listed once, so
+    resolving a metric takes a dictionary lookup plus a call per function
+    check which comes before the first matching regex. The templates of the
+    configs are filled once per metric and rule; only the config values given
+    by functions are computed on every call, from its params.
+
+    The metrics themselves are listed by introspecting the tables of every
+    database the configs point at, and matching the table names against the
+    TABLE_NAME templates, e.g. all tables for "{metric_name}". Call `reload`
+    after changing DEFAULT_CONFIGS or CUSTOM_CONFIGS, or adding tables.
+
+    Args:
+        default_configs (Dict): the configs of metrics no rule matches
+        custom_configs (List[Dict]): the rules, with a `check` and `configs`
+        get_engine (Callable): returns the engine of a database url; called
+            with the url and the pool configs
+    """
+
+    def __init__(
+        self,
+        default_configs: Dict,
+        custom_configs: List[Dict],
+        get_engine: Callable[..., sqlalchemy.engine.Engine],
+    ):
+        self.default_configs = default_configs
+        self.custom_configs = custom_configs
+        self.get_engine = get_engine
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Drops the compiled rules, the resolved configs and the metric index"""
+        with self._lock:
+            self._rules = None
+            self._candidates = dict()
+            self._resolved = dict()
+            self._index = None
+
+    def rules(self) -> List[MetricRule]:
+        if self._rules is None:
+            rules = []
+            for custom_config in self.custom_configs:
+                configs = dict(self.default_configs)
+                configs.update(custom_config["configs"])
+                rules.append(MetricRule(custom_config["check"], configs))
+            # the defaults, which apply when no rule does
+            rules.append(MetricRule(lambda params: True, dict(self.default_configs)))
+            rules[-1].static = True
+            self._rules = rules
+        return self._rules
+
+    def candidates(self, metric_name: str) -> List[int]:
+        """Returns the rules which may apply to a metric, up to the first
+        one which certainly does"""
+        candidates = self._candidates.get(metric_name)
+        if candidates is None:
+            candidates = []
+            for index, rule in enumerate(self.rules()):
+                if not rule.static:
+                    candidates.append(index)
+                elif index == len(self._rules) - 1 or rule.matches(metric_name):
+                    candidates.append(index)
+                    break
+            self._candidates[metric_name] = candidates
+        return candidates
+
+    def resolve(self, params: Dict) -> Dict:
+        """Returns the configs of a metric; see get_metric_configs"""
+        metric_name = params["metric_name"]
+        rules = self.rules()
+        for index in self.candidates(metric_name):
+            if rules[index].static or rules[index].matches(params):
+                break
+        key = (metric_name, index)
+        configs = self._resolved.get(key)
+        if configs is None:
+            configs = self.materialize(rules[index].configs, params)
+            self._resolved[key] = configs
+        if rules[index].constant:
+            return configs
+        # the functions may depend on the labels and time range of the call
+        configs = dict(configs)
+        for name, value in rules[index].configs.items():
+            if callable(value):
+                configs[name] = value(params)
+        if callable(rules[index].configs["DB"]):
+            configs["DB"] = self.get_engine(
+                configs["DB"],
+                pool_size=configs["POOL_SIZE"],
+                max_overflow=configs["POOL_MAX_OVERFLOW"],
+                pool_recycle=configs["POOL_RECYCLE"],
+            )
+        return configs
+
+    def materialize(self, configs: Dict, params: Dict) -> Dict:
+        """Fills the templates of configs with the metric name, and opens the
+        engine unless it is given by a function"""
+        configs = dict(configs)
+        for name, value in configs.items():
+            if isinstance(value, str):
+                configs[name] = value.format(**params)
+        if not callable(configs["DB"]):
+            configs["DB"] = self.get_engine(
+                configs["DB"],
+                pool_size=configs["POOL_SIZE"],
+                max_overflow=configs["POOL_MAX_OVERFLOW"],
+                pool_recycle=configs["POOL_RECYCLE"],
+            )
+        return configs
+
+    def index(self) -> Dict[str, Tuple[sqlalchemy.engine.Engine, str]]:
+        """Returns the engine and table of every metric of the databases"""
+        index = self._index
+        if index is None:
+            index = dict()
+            for rule in self.rules():
+                database, template = rule.configs["DB"], rule.configs["TABLE_NAME"]
+                if not isinstance(database, str) or not isinstance(template, str):
+                    continue
+                pattern = re.escape(template).replace(
+                    re.escape("{metric_name}"), "(?P<metric_name>.+)"
+                )
+                if "{" in pattern.replace("(?P<metric_name>.+)", ""):
+                    # the table depends on more than the metric name
+                    continue
+                engine = self.get_engine(
+                    database,
+                    pool_size=rule.configs["POOL_SIZE"],
+                    max_overflow=rule.configs["POOL_MAX_OVERFLOW"],
+                    pool_recycle=rule.configs["POOL_RECYCLE"],
+                )
+                for table in schema_catalog.get_table_names(engine):
+                    match = re.fullmatch(pattern, table)
+                    if match is None or ROLLUP_TABLE_REGEX.fullmatch(table):
+                        continue
+                    name = match.groupdict().get("metric_name", table)
+                    # the metric belongs to the table only if it resolves to it
+                    configs = self.resolve(
+                        {
+                            "metric_name": name,
+                            "labels": dict(),
+                            "start_datetime": None,
+                            "end_datetime": None,
+                        }
+                    )
+                    if configs["DB"] is engine and configs["TABLE_NAME"] == table:
+                        index[name] = (engine, table)
+            self._index = index
+        return index
+
+    def metric_names(self) -> List[str]:
+        return sorted(self.index())
+
+    def lookup(
+        self, metric_name: str
+    ) -> Optional[Tuple[sqlalchemy.engine.Engine, str]]:
+        """Returns the engine and table of a metric, None if it has no table"""
+        return self.index().get(metric_name)
+
+    def find_metrics(self, op: str, value: str) -> List[str]:
+        """Returns the metrics whose name matches a `__name__` matcher
+
+        Raises:
+            NotImplementedError: for unknown operators
+        """
+        names = self.metric_names()
+        if op == "=":
+            return [name for name in names if name == value]
+        if op == "!=":
+            return [name for name in names if name != value]
+        if op in ("=~", "!~"):
+            # PromQL regexes are anchored at both ends
+            regex = re.compile(value)
+            return [
+                name
+                for name in names
+                if (regex.fullmatch(name) is None) == (op == "!~")
+            ]
+        raise NotImplementedError(f"Operator {op} is not supported for __name__")
@@ -0,0 +1,15 @@
+"""The clock of PromSQL
+
+Timestamps without a timezone are UTC everywhere: the default evaluation
+time of queries and the end of fetches, which chunks of fetch_cache are
+complete and when results_cache entries expire, and the times of the HTTP
+API. They all read the current time from utc_now, so they agree whatever
+the timezone of the host.
+"""
+
+import datetime
+
+
+def utc_now() -> datetime.datetime:
+    """Returns the current time as a naive UTC datetime"""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,83 @@
+"""Runs the independent fetches of a query at the same time"""
+
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Sequence, Tuple, TypeVar
+
+from . import limits, tracing
+
+T = TypeVar("T")
+
+# threads shared by the fetches of all queries; the number of fetches of one
+# engine running at the same time is bounded by get_engine_semaphore
+FETCH_THREADS = 16
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Returns the thread pool on which fetches run"""
+    with get_executor.lock:
+        if get_executor.executor is None:
+            get_executor.executor = ThreadPoolExecutor(
+                max_workers=FETCH_THREADS, thread_name_prefix="promsql-fetch"
+            )
+        return get_executor.executor
+
+
+get_executor.lock = threading.Lock()
+get_executor.executor = None
+
+
+def get_fetch_limit(configs: Dict) -> int:
+    """Returns how many fetches may use the engine of configs at once"""
+    limit = configs.get("MAX_CONCURRENT_FETCHES") or configs.get("POOL_SIZE") or 1
+    return max(1, int(limit))
+
+
+def get_engine_semaphore(engine, limit: int) -> threading.BoundedSemaphore:
+    """Returns the semaphore which bounds the concurrent fetches of an engine
+
+    The semaphore is created with the limit of the first caller.
+    """
+    with get_engine_semaphore.lock:
+        if engine not in get_engine_semaphore.semaphores:
+            get_engine_semaphore.semaphores[engine] = threading.BoundedSemaphore(limit)
+        return get_engine_semaphore.semaphores[engine]
+
+
+get_engine_semaphore.lock = threading.Lock()
+get_engine_semaphore.semaphores = dict()
+
+
+def run_fetches(fetches: Sequence[Tuple[Dict, Callable[[], T]]]) -> List[T]:
+    """Runs fetches concurrently and returns their results in order
+
+    Each fetch is a pair of the configs of its metric and a function without
+    arguments. Fetches run on a shared thread pool, at most
+    get_fetch_limit(configs) of them per engine at a time, so the latency of
+    a query which reads several metrics is about the one of its slowest
+    fetch. A single fetch runs in the calling thread.
+
+    Raises:
+        the first exception raised by a fetch, once all fetches are done
+    """
+    if len(fetches) == 1:
+        return [fetches[0][1]()]
+
+    def bounded(configs: Dict, fetch: Callable[[], T]) -> T:
+        with get_engine_semaphore(configs["DB"], get_fetch_limit(configs)):
+            return fetch()
+
+    # the fetches are traced in the span of the caller and counted against
+    # the budget of its query
+    futures = [
+        get_executor().submit(
+            limits.propagate(tracing.propagate(functools.partial(bounded, *fetch)))
+        )
+        for fetch in fetches
+    ]
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [future.result() for future in futures]
@@ -0,0 +1,306 @@
+"""Estimates how much a query reads before it runs
+
+A fetch is estimated from statistics of its table: the number of rows and
+the first and last timestamps, read with COUNT, MIN and MAX, and the number
+of series, the distinct label values of the last LOOK_BEHIND_DURATION of the
+table. They are cached for TABLE_STATISTICS_REFRESH_INTERVAL seconds. The
+samples of a window are the rows of the table times the share of its time
+span the window covers, as if the rows were spread evenly. Samples and
+series are then scaled by the share of the values of each matched label
+which the matcher selects, from the label index, as if the labels were
+independent.
+
+The estimate of a query is the sum of the estimates of its planned fetches,
+see RangeEvaluator.estimate and estimate_plan; QueryBudget refuses queries
+whose estimate is over their limits.
+"""
+
+import datetime
+import math
+import threading
+import time
+from typing import Dict, Hashable, List, Optional
+
+import pandas as pd
+import sqlalchemy
+
+from .catalog import label_index
+from .limits import SAMPLE_BYTES
+from .sql_miscs import (
+    REGEX_OPS,
+    compile_label_regex,
+    get_label_values,
+    get_metric_table,
+    get_tag_columns,
+)
+
+# estimated bytes of the value of a label of a series
+LABEL_VALUE_BYTES = 16
+
+
+class TableStatistics:
+    """The size of a metric table
+
+    Args:
+        rows (int): number of rows
+        first (int): first timestamp in nanoseconds since the epoch, None if
+            the table is empty
+        last (int): last timestamp in nanoseconds since the epoch, None if
+            the table is empty
+        series (int): number of series in the last LOOK_BEHIND_DURATION
+    """
+
+    def __init__(
+        self, rows: int, first: Optional[int], last: Optional[int], series: int
+    ):
+        self.rows = rows
+        self.first = first
+        self.last = last
+        self.series = series
+
+    def rows_between(self, start: int, end: int) -> float:
+        """Returns the estimated number of rows between two timestamps in
+        nanoseconds"""
+        if not self.rows or end < self.first or start > self.last:
+            return 0.0
+        if self.last == self.first:
+            return float(self.rows)
+        covered = min(end, self.last) - max(start, self.first)
+        return self.rows * covered / (self.last - self.first)
+
+    def __str__(self):
+        return f"TableStatistics({self.rows}, {self.first}, {self.last}, {self.series})"
+
+
+def to_nanoseconds(timestamp) -> int:
+    return pd.Timestamp(timestamp).as_unit("ns").value
+
+
+def read_table_statistics(configs: Dict) -> TableStatistics:
+    """Reads the statistics of the table of a metric from the database"""
+    tags = get_tag_columns(configs)
+    table = get_metric_table(configs, tags)
+    timestamp = table.c[configs["TIMESTAMP_COLUMN"]]
+    with configs["DB"].connect() as connection:
+        rows, first, last = connection.execute(
+            sqlalchemy.select(
+                sqlalchemy.func.count(),
+                sqlalchemy.func.min(timestamp),
+                sqlalchemy.func.max(timestamp),
+            )
+        ).one()
+        if not rows:
+            return TableStatistics(0, None, None, 0)
+        series = 1
+        if tags:
+            recent = (
+                sqlalchemy.select(*[table.c[tag] for tag in tags])
+                .where(
+                    timestamp
+                    >= last
+                    - datetime.timedelta(seconds=configs["LOOK_BEHIND_DURATION"])
+                )
+                .distinct()
+                .subquery()
+            )
+            series = connection.execute(
+                sqlalchemy.select(sqlalchemy.func.count()).select_from(recent)
+            ).scalar()
+    return TableStatistics(rows, to_nanoseconds(first), to_nanoseconds(last), series)
+
+
+def get_table_statistics(configs: Dict) -> TableStatistics:
+    """Returns the statistics of the table of a metric, read again after
+    TABLE_STATISTICS_REFRESH_INTERVAL seconds"""
+    key = (
+        configs["DB"],
+        configs["TABLE_NAME"],
+        configs["TIMESTAMP_COLUMN"],
+        tuple(get_tag_columns(configs)),
+    )
+    with get_table_statistics.lock:
+        cached = get_table_statistics.statistics.get(key)
+    if cached is not None and (
+        time.monotonic() - cached[1] < configs["TABLE_STATISTICS_REFRESH_INTERVAL"]
+    ):
+        return cached[0]
+    statistics = read_table_statistics(configs)
+    with get_table_statistics.lock:
+        get_table_statistics.statistics[key] = (statistics, time.monotonic())
+    return statistics
+
+
+get_table_statistics.lock = threading.Lock()
+get_table_statistics.statistics = dict()
+
+
+def estimate_selectivity(configs: Dict, labels: Dict) -> float:
+    """Returns the share of the series of a metric which label matchers
+    select, from the values of the matched labels in the label index"""
+    share = 1.0
+    tags = set(get_tag_columns(configs))
+    for name, option in labels.items():
+        if name not in tags:
+            continue
+        values = get_label_values(configs, name)
+        if not values:
+            continue
+        if option["op"] in REGEX_OPS:
+            selected = len(
+                label_index.find_values(
+                    configs["DB"],
+                    configs["TABLE_NAME"],
+                    configs["TIMESTAMP_COLUMN"],
+                    name,
+                    compile_label_regex(option["value"]),
+                    configs["LABEL_INDEX_REFRESH_INTERVAL"],
+                )
+            )
+        else:
+            selected = sum(1 for value in values if str(value) == option["value"])
+        fraction = selected / len(values)
+        if option["op"] in ("!=", "!~"):
+            fraction = 1 - fraction
+        share *= fraction
+    return share
+
+
+class FetchEstimate:
+    """What a fetch is estimated to read
+
+    Args:
+        name (str): the table it reads
+        samples (int): number of samples
+        series (int): number of series
+        key (Hashable): identifies what it selects; fetches with the same key
+            read the same series, which are only counted once
+        label_bytes (int, optional): estimated bytes of the labels of a
+            series. Defaults to 0.
+    """
+
+    def __init__(
+        self, name: str, samples: int, series: int, key: Hashable, label_bytes: int = 0
+    ):
+        self.name = name
+        self.samples = samples
+        self.series = series
+        self.key = key
+        self.label_bytes = label_bytes
+
+    def __str__(self):
+        return f"FetchEstimate({self.name}, {self.samples}, {self.series})"
+
+
+class QueryCost:
+    """What the fetches of a query are estimated to read
+
+    Args:
+        fetches (List[FetchEstimate], optional): the estimates of the fetches
+    """
+
+    def __init__(self, fetches: List[FetchEstimate] = None):
+        self.fetches = list(fetches or ())
+
+    def add(self, estimate: FetchEstimate):
+        self.fetches.append(estimate)
+
+    def extend(self, cost: "QueryCost"):
+        self.fetches.extend(cost.fetches)
+
+    def series_by_key(self) -> Dict[Hashable, FetchEstimate]:
+        """Returns the fetch with the most series of each key"""
+        largest = dict()
+        for estimate in self.fetches:
+            known = largest.get(estimate.key)
+            if known is None or estimate.series > known.series:
+                largest[estimate.key] = estimate
+        return largest
+
+    @property
+    def samples(self) -> int:
+        return sum(estimate.samples for estimate in self.fetches)
+
+    @property
+    def series(self) -> int:
+        return sum(estimate.series for estimate in self.series_by_key().values())
+
+    @property
+    def bytes(self) -> int:
+        return self.samples * SAMPLE_BYTES + sum(
+            estimate.series * estimate.label_bytes
+            for estimate in self.series_by_key().values()
+        )
+
+    def __str__(self):
+        return (
+            f"QueryCost(samples={self.samples}, series={self.series}, "
+            f"bytes={self.bytes}, fetches={len(self.fetches)})"
+        )
+
+
+def estimate_fetch(
+    configs: Dict,
+    labels: Dict,
+    start,
+    end,
+    key: Hashable,
+    resolution: int = None,
+    latest: bool = False,
+) -> FetchEstimate:
+    """Estimates what fetch_metric_data reads
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        labels (Dict): label matchers
+        start: start of the window, offset included
+        end: end of the window, offset included
+        key (Hashable): identifies the selector, see FetchEstimate
+        resolution (int, optional): seconds of the buckets the samples are
+            aggregated into, in the database or in a rollup table. Defaults
+            to None.
+        latest (bool, optional): whether only the latest sample of each
+            series is read. Defaults to False.
+    """
+    statistics = get_table_statistics(configs)
+    share = estimate_selectivity(configs, labels) if statistics.rows else 0.0
+    start, end = to_nanoseconds(start), to_nanoseconds(end)
+    samples = statistics.rows_between(start, end) * share
+    series = min(statistics.series * share, samples)
+    if latest:
+        samples = series
+    elif resolution:
+        buckets = math.ceil((end - start) / (resolution * 1e9))
+        samples = min(samples, series * buckets)
+    return FetchEstimate(
+        configs["TABLE_NAME"],
+        math.ceil(samples),
+        math.ceil(series),
+        key,
+        len(get_tag_columns(configs)) * LABEL_VALUE_BYTES,
+    )
+
+
+def estimate_output(
+    configs: Dict, labels: List[str], key: Hashable, share: float = 1.0
+) -> FetchEstimate:
+    """Estimates what a statement pushed down to the database returns: a row
+    per combination of the values of its output labels, at most one per
+    series it selects
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        labels (List[str]): the output labels of the statement
+        key (Hashable): identifies the statement, see FetchEstimate
+        share (float, optional): the share of the series of the table which
+            the statement selects, see estimate_selectivity. Defaults to 1.0.
+    """
+    statistics = get_table_statistics(configs)
+    tags = set(get_tag_columns(configs))
+    rows = 1 if statistics.rows else 0
+    for label in labels:
+        if label in tags:
+            rows *= max(1, len(get_label_values(configs, label)))
+    rows = min(rows, math.ceil(statistics.series * share))
+    return FetchEstimate(
+        configs["TABLE_NAME"], rows, rows, key, len(labels) * LABEL_VALUE_BYTES
+    )
@@ -0,0 +1,130 @@
+"""Dialect specific SQL"""
+
+from typing import Dict, List
+
+import sqlalchemy
+
+LATEST_SAMPLE_STRATEGIES = {
+    "questdb": "latest_by",
+    "postgresql": "distinct_on",
+}
+
+ROW_NUMBER_COL = "__row_number__"
+
+REGEX_MATCH_STRATEGIES = {
+    "questdb": "regex",
+    "postgresql": "regex",
+}
+
+
+def get_dialect(configs: Dict) -> str:
+    """Returns the configured dialect or the one of the sqlalchemy engine"""
+    return configs["DIALECT"] or configs["DB"].dialect.name
+
+
+def get_latest_sample_strategy(configs: Dict) -> str:
+    """Returns how the latest sample of each series should be selected
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+
+    Returns:
+        str: one of "latest_by", "distinct_on", "window" or "pandas"
+    """
+    strategy = configs["LATEST_SAMPLE_STRATEGY"]
+    if strategy is None:
+        strategy = LATEST_SAMPLE_STRATEGIES.get(get_dialect(configs), "window")
+    return strategy
+
+
+def get_regex_match_strategy(configs: Dict) -> str:
+    """Returns how the regex label matchers `=~` and `!~` should be evaluated
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+
+    Returns:
+        str: "regex" for the regex operator of the database, or "in_list" to
+            match the values of the label index and select them with IN
+    """
+    strategy = configs["REGEX_MATCH_STRATEGY"]
+    if strategy is None:
+        strategy = REGEX_MATCH_STRATEGIES.get(get_dialect(configs), "in_list")
+    return strategy
+
+
+def regex_match(configs: Dict, column, value, negate: bool = False):
+    """Matches a column against a regex in the database
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        column: the label column
+        value: the regex, anchored at both ends (see anchor_regex)
+        negate (bool, optional): select the values which do not match.
+            Defaults to False.
+
+    Raises:
+        ValueError: if the strategy of the configs is not "regex"
+
+    Returns:
+        the condition
+    """
+    strategy = get_regex_match_strategy(configs)
+    if strategy != "regex":
+        raise ValueError(f"Regexes cannot be matched with {strategy}")
+    # QuestDB and PostgreSQL both spell it `~`
+    condition = column.op("~")(value)
+    return sqlalchemy.not_(condition) if negate else condition
+
+
+def anchor_regex(regex: str) -> str:
+    """Anchors a PromQL regex at both ends, as PromQL matches whole values"""
+    return f"^(?:{regex})$"
+
+
+def select_latest_samples(
+    configs: Dict,
+    table: sqlalchemy.sql.expression.TableClause,
+    tag_columns: List,
+    columns: List,
+    where_clauses: List,
+):
+    """Selects the most recent sample of each series in the database
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        table (sqlalchemy.sql.expression.TableClause): the metric table
+        tag_columns (List): the columns which tell the series apart
+        columns (List): the columns (or labeled expressions) to select
+        where_clauses (List): conditions on the samples to consider
+
+    Raises:
+        ValueError: if the strategy of the configs is "pandas"
+
+    Returns:
+        sqlalchemy.sql.expression.Select: the statement
+    """
+    strategy = get_latest_sample_strategy(configs)
+    timestamp = table.c[configs["TIMESTAMP_COLUMN"]]
+    statement = sqlalchemy.select(*columns).where(*where_clauses)
+    if not tag_columns and strategy != "pandas":
+        return statement.order_by(timestamp.desc()).limit(1)
+
+    if strategy == "latest_by":
+        quote = configs["DB"].dialect.identifier_preparer.quote
+        return statement.suffix_with(
+            "LATEST ON {} PARTITION BY {}".format(
+                quote(timestamp.name), ", ".join(quote(c.name) for c in tag_columns)
+            )
+        )
+    if strategy == "distinct_on":
+        return statement.distinct(*tag_columns).order_by(*tag_columns, timestamp.desc())
+    if strategy == "window":
+        row_number = sqlalchemy.func.row_number().over(
+            partition_by=tag_columns, order_by=timestamp.desc()
+        )
+        inner = statement.add_columns(row_number.label(ROW_NUMBER_COL)).subquery()
+        return sqlalchemy.select(*[inner.c[c.name] for c in columns]).where(
+            inner.c[ROW_NUMBER_COL] == 1
+        )
+    raise ValueError(f"The latest samples cannot be selected with {strategy}")
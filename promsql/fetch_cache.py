@@ -0,0 +1,209 @@
+"""Caches fetched samples in aligned time chunks"""
+
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Tuple
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from promsql.clock import utc_now
+from promsql.constants import TIME_COL
+from promsql.tracing import record
+
+# memory budget of the module level fetch_cache
+FETCH_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def align_datetime(value: datetime.datetime, seconds: int) -> datetime.datetime:
+    """Rounds a datetime down to a multiple of `seconds` since the unix epoch"""
+    epoch = EPOCH
+    if value.tzinfo is not None:
+        epoch = EPOCH.replace(tzinfo=datetime.timezone.utc)
+    return value - (value - epoch) % datetime.timedelta(seconds=seconds)
+
+
+def concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenates frames read at different times; the dictionary encoded
+    label columns of the fetch backends stay categorical, over the union of
+    the categories of the frames"""
+    for column in frames[0].columns:
+        dtypes = [frame[column].dtype for frame in frames]
+        if len(set(dtypes)) == 1 or not all(
+            isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes
+        ):
+            continue
+        categories = union_categoricals([frame[column] for frame in frames]).categories
+        frames = [
+            frame.assign(**{column: frame[column].cat.set_categories(categories)})
+            for frame in frames
+        ]
+    return pd.concat(frames, ignore_index=True)
+
+
+class FetchCache:
+    """LRU cache of sample chunks with a memory budget
+
+    The time axis is split into chunks of a fixed number of seconds, aligned
+    to the unix epoch. A fetch is served chunk by chunk: chunks which ended
+    before now are complete and are kept, so they are read from the database
+    once; the open chunk, the one still receiving samples, is read again on
+    every fetch and never stored. So is a chunk which extends past the end of
+    the fetch, as it is only read up to that end. Samples written into a
+    chunk after it was cached are not seen until the chunk is evicted or the
+    cache is cleared.
+
+    The size of a chunk is the memory usage of its DataFrame. When the cached
+    chunks exceed `max_bytes` the least recently used ones are evicted.
+
+    Args:
+        max_bytes (int, optional): memory budget. Defaults to
+            FETCH_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, max_bytes: int = FETCH_CACHE_MAX_BYTES):
+        self._lock = threading.Lock()
+        self._chunks = OrderedDict()
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fetch(
+        self,
+        key: Hashable,
+        start_datetime: datetime.datetime,
+        end_datetime: datetime.datetime,
+        chunk_duration: int,
+        read: Callable[[datetime.datetime, datetime.datetime], pd.DataFrame],
+        on_cached: Callable[[pd.DataFrame], None] = None,
+    ) -> pd.DataFrame:
+        """Returns the samples of [start_datetime, end_datetime]
+
+        Args:
+            key (Hashable): identifies the selector; it must cover everything
+                that changes the rows, e.g. the table, columns and matchers
+            start_datetime (datetime.datetime): start of the range (inclusive)
+            end_datetime (datetime.datetime): end of the range (inclusive)
+            chunk_duration (int): length of a chunk in seconds
+            read (Callable): reads the samples of a range from the database;
+                called with the start and the end (both inclusive) and must
+                return a DataFrame with a TIME_COL column
+            on_cached (Callable, optional): called with each chunk served
+                from the cache, e.g. to count it against the budget of the
+                query like the chunks read
+
+        Returns:
+            pd.DataFrame: the samples, ordered by chunk
+        """
+        if start_datetime > end_datetime:
+            return read(start_datetime, end_datetime)
+        duration = datetime.timedelta(seconds=chunk_duration)
+        now = utc_now()
+        if start_datetime.tzinfo is not None:
+            now = datetime.datetime.now(start_datetime.tzinfo)
+        complete_before = min(now, end_datetime)
+        chunk_start = align_datetime(start_datetime, chunk_duration)
+        frames = []
+        missing = []
+        while chunk_start <= end_datetime:
+            chunk_end = chunk_start + duration
+            if chunk_end <= complete_before:
+                frame = self.get((key, chunk_start))
+                if frame is not None and on_cached is not None:
+                    on_cached(frame)
+            else:
+                frame = None
+                with self._lock:
+                    self.misses += 1
+            frames.append(frame)
+            if frame is None:
+                missing.append(len(frames) - 1)
+            chunk_start = chunk_end
+
+        first_start = align_datetime(start_datetime, chunk_duration)
+        for run in self._group_runs(missing):
+            run_start = first_start + run[0] * duration
+            run_end = first_start + (run[-1] + 1) * duration
+            df = read(run_start, min(run_end, end_datetime))
+            for index in run:
+                chunk_start = first_start + index * duration
+                chunk_end = chunk_start + duration
+                times = df[TIME_COL]
+                frame = df[(times >= chunk_start) & (times < chunk_end)]
+                frames[index] = frame
+                if chunk_end <= complete_before:
+                    self.put((key, chunk_start), frame)
+
+        record(cache_hits=len(frames) - len(missing), cache_misses=len(missing))
+        non_empty = [frame for frame in frames if len(frame)]
+        df = concat_frames(non_empty) if non_empty else frames[0]
+        return df[df[TIME_COL].between(start_datetime, end_datetime)]
+
+    @staticmethod
+    def _group_runs(indexes: List[int]) -> List[List[int]]:
+        runs = []
+        for index in indexes:
+            if runs and runs[-1][-1] == index - 1:
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+        return runs
+
+    def get(self, key: Tuple):
+        with self._lock:
+            entry = self._chunks.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._chunks.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Tuple, frame: pd.DataFrame):
+        size = int(frame.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            previous = self._chunks.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            if size > self.max_bytes:
+                return
+            self._chunks[key] = (frame, size)
+            self.current_bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._chunks:
+            _, (_, size) = self._chunks.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def set_max_bytes(self, max_bytes: int):
+        """Changes the memory budget, evicting chunks if needed"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict:
+        """Returns the hit, miss and eviction counters and the memory usage"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "chunks": len(self._chunks),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+fetch_cache = FetchCache()
@@ -0,0 +1,217 @@
+"""Limits on how much a single query reads from the databases
+
+A query runs with a QueryBudget when one of MAX_QUERY_SAMPLES,
+MAX_QUERY_SERIES or MAX_QUERY_BYTES is set, or when limits are passed to
+evaluate_instant or evaluate_range. The query is estimated before it runs
+(see cost) and refused if the estimate is over a limit. Otherwise the
+samples, series and bytes are counted batch by batch as the fetches read
+them, and the query is aborted with QueryLimitExceeded at the first batch
+which goes over a limit, before the rest of the rows are read.
+
+    with enforce(QueryBudget(QueryLimits(max_samples=10_000_000))):
+        fetch_metric_data("cpu", ...)
+"""
+
+import contextlib
+import contextvars
+import functools
+import threading
+from typing import Callable, Dict, Hashable, Iterable, Iterator, Optional, Tuple
+
+import pandas as pd
+
+# bytes taken by a sample once fetched: a float64 value and an int64 timestamp
+SAMPLE_BYTES = 16
+
+_current = contextvars.ContextVar("promsql_budget", default=None)
+
+
+class QueryLimitExceeded(Exception):
+    """Raised when a query reads, or is estimated to read, more samples,
+    series or bytes than it is allowed to
+
+    Args:
+        resource (str): "samples", "series" or "bytes"
+        limit (int): the maximum
+        actual (int): what had been read when the query was aborted, None
+            when it was refused on its estimate
+        estimated (int, optional): what the query was estimated to read
+    """
+
+    def __init__(
+        self, resource: str, limit: int, actual: Optional[int], estimated: int = None
+    ):
+        self.resource = resource
+        self.limit = limit
+        self.actual = actual
+        self.estimated = estimated
+        if actual is None:
+            message = (
+                f"The query would read about {estimated} {resource}, "
+                f"more than the limit of {limit}"
+            )
+        else:
+            message = (
+                f"The query read {actual} {resource}, more than the limit of {limit}"
+            )
+            if estimated is not None:
+                message += f" (estimated {estimated} before it ran)"
+        super().__init__(message)
+
+
+class SampleLimitExceeded(QueryLimitExceeded):
+    """Raised when a fetch reads more samples than MAX_SAMPLES
+
+    Args:
+        limit (int): the maximum number of samples
+        samples (int): the number of samples read when the fetch was aborted
+    """
+
+    def __init__(self, limit: int, samples: int):
+        self.samples = samples
+        super().__init__("samples", limit, samples)
+
+
+class QueryLimits:
+    """The most a query may read from the databases; None for no limit
+
+    Args:
+        max_samples (int, optional): samples read by all fetches
+        max_series (int, optional): distinct series read
+        max_bytes (int, optional): bytes read, SAMPLE_BYTES per sample plus
+            the text of the labels of every series
+    """
+
+    def __init__(
+        self, max_samples: int = None, max_series: int = None, max_bytes: int = None
+    ):
+        self.max_samples = max_samples
+        self.max_series = max_series
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_configs(cls, configs: Dict) -> "QueryLimits":
+        """Returns the limits of MAX_QUERY_SAMPLES, MAX_QUERY_SERIES and
+        MAX_QUERY_BYTES"""
+        return cls(
+            configs.get("MAX_QUERY_SAMPLES"),
+            configs.get("MAX_QUERY_SERIES"),
+            configs.get("MAX_QUERY_BYTES"),
+        )
+
+    def items(self) -> Iterator[Tuple[str, Optional[int]]]:
+        yield "samples", self.max_samples
+        yield "series", self.max_series
+        yield "bytes", self.max_bytes
+
+    def __bool__(self):
+        return any(limit is not None for _, limit in self.items())
+
+    def __str__(self):
+        return f"QueryLimits({self.max_samples}, {self.max_series}, {self.max_bytes})"
+
+
+class QueryBudget:
+    """Counts what the fetches of a query read against its limits
+
+    Fetches may run on several threads; the counts are kept under a lock.
+    A series is counted once per source (table) however many fetches or
+    chunks read it.
+
+    Args:
+        limits (QueryLimits): the limits of the query
+        estimate (optional): the QueryCost estimated before the query ran,
+            reported along with the actual counts when a limit is exceeded
+    """
+
+    def __init__(self, limits: QueryLimits, estimate=None):
+        self.limits = limits
+        self.estimate = estimate
+        self.samples = 0
+        self.bytes = 0
+        self.series = set()
+        self._lock = threading.Lock()
+
+    def estimated(self, resource: str) -> Optional[int]:
+        if self.estimate is None:
+            return None
+        return getattr(self.estimate, resource)
+
+    def check_estimate(self):
+        """Refuses the query if its estimate is over a limit
+
+        Raises:
+            QueryLimitExceeded: with the estimate and no actual count
+        """
+        for resource, limit in self.limits.items():
+            estimated = self.estimated(resource)
+            if limit is not None and estimated is not None and estimated > limit:
+                raise QueryLimitExceeded(resource, limit, None, estimated)
+
+    def add(self, source: Hashable, keys: Iterable[Tuple], samples: int):
+        """Counts a batch of samples
+
+        Args:
+            source (Hashable): where the batch was read from, e.g. the engine
+                and table
+            keys (Iterable[Tuple]): the label values of the series of the
+                batch; series which were already counted are skipped
+            samples (int): the number of samples of the batch
+
+        Raises:
+            QueryLimitExceeded: once a count is over its limit
+        """
+        with self._lock:
+            label_bytes = 0
+            for key in keys:
+                if (source, key) not in self.series:
+                    self.series.add((source, key))
+                    label_bytes += sum(len(str(value)) for value in key)
+            self.samples += samples
+            self.bytes += samples * SAMPLE_BYTES + label_bytes
+            counts = {
+                "samples": self.samples,
+                "series": len(self.series),
+                "bytes": self.bytes,
+            }
+        for resource, limit in self.limits.items():
+            if limit is not None and counts[resource] > limit:
+                raise QueryLimitExceeded(
+                    resource, limit, counts[resource], self.estimated(resource)
+                )
+
+    def add_frame(self, source: Hashable, df: pd.DataFrame, tag_columns: Iterable):
+        """Counts the rows of a frame read at once, one sample per row
+
+        NULL labels are counted as None, as the fetch backends report them.
+        """
+        tags = [
+            df[tag].astype(object).where(df[tag].notna(), None)
+            for tag in tag_columns
+            if tag in df
+        ]
+        keys = set(zip(*tags)) if tags else {()}
+        self.add(source, keys if len(df) else (), len(df))
+
+
+def current_budget() -> Optional[QueryBudget]:
+    """Returns the budget of the query running in this context, if any"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def enforce(budget: Optional[QueryBudget]):
+    """Counts the fetches of the body against budget; None for no limits"""
+    token = _current.set(budget)
+    try:
+        yield budget
+    finally:
+        _current.reset(token)
+
+
+def propagate(function: Callable) -> Callable:
+    """Binds function to the current budget, for running it on another
+    thread"""
+    if _current.get() is None:
+        return function
+    return functools.partial(contextvars.copy_context().run, function)
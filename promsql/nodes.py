@@ -2,9 +2,14 @@ import datetime
 import pandas as pd
 from typing import List
 
+from .clock import utc_now
 from .sql_miscs import fetch_metric_data
 from .constants import VAL_COL, TIME_COL
-from .pandas_miscs import find_tags, resample
+from .binary_ops import binary_operation
+from .aggregations import aggregate
+from .range_functions import RANGE_FUNCTIONS, evaluate_range_function
+from .series import SeriesSet
+from .tracing import traced
 
 
 def list_to_str(input_list):
@@ -16,6 +21,13 @@ class ExecutableExpr:
         raise NotImplementedError()
 
 
+def eval_operand(expr):
+    """Evaluates a child expression; scalars are returned as they are"""
+    if isinstance(expr, ExecutableExpr):
+        return expr.eval()
+    return expr
+
+
 class AggregateExpr(ExecutableExpr):
     def __init__(
         self, aggregate_op=None, aggregate_modifier=None, function_call_body=None
@@ -27,8 +39,17 @@ class AggregateExpr(ExecutableExpr):
     def __str__(self):
         return f"AggregateExpr({self.aggregate_op}, {self.aggregate_modifier}, {list_to_str(self.function_call_body)})"
 
+    @traced
     def eval(self):
-        pass
+        args = [eval_operand(arg) for arg in self.function_call_body]
+        modifier = self.aggregate_modifier
+        return aggregate(
+            self.aggregate_op,
+            args[-1],
+            grouping=modifier.grouping if modifier else None,
+            without=bool(modifier.without) if modifier else False,
+            param=args[0] if len(args) > 1 else None,
+        )
 
 
 class AggregateModifier:
@@ -50,8 +71,14 @@ class BinaryExpression(ExecutableExpr):
     def __str__(self):
         return f"BinaryExpression({self.op}, {self.left_expr}, {self.right_expr}, {self.bin_modifier})"
 
+    @traced
     def eval(self):
-        pass
+        return binary_operation(
+            self.op,
+            eval_operand(self.left_expr),
+            eval_operand(self.right_expr),
+            self.bin_modifier,
+        )
 
 
 class BinaryExpr:
@@ -83,8 +110,28 @@ class Function(ExecutableExpr):
     def __str__(self):
         return f"Function({self.name}, [{list_to_str(self.args)}])"
 
+    @traced
     def eval(self):
-        pass
+        if self.name not in RANGE_FUNCTIONS:
+            raise NotImplementedError(f"Function {self.name} is not implemented!")
+        matrix = self.args[-1]
+        selector = matrix
+        if isinstance(matrix, SubqueryExpr):
+            selector = matrix.matrix_selector
+            series = matrix.eval()
+        elif isinstance(matrix, MatrixSelector):
+            series = matrix.eval()
+        else:
+            raise ValueError(f"Function {self.name} expects a range vector")
+        start_datetime, end_datetime = selector.window()
+        return evaluate_range_function(
+            self.name,
+            series,
+            [end_datetime],
+            (end_datetime - start_datetime).total_seconds(),
+            param=eval_operand(self.args[0]) if len(self.args) > 1 else None,
+            output_times=[selector.range.end_time],
+        )
 
 
 class MatrixSelector(ExecutableExpr):
@@ -92,48 +139,63 @@ class MatrixSelector(ExecutableExpr):
         self.expr = expr
         self.range = _range
         self.offset = offset
+        self.prefetched = None
 
     def __str__(self):
         return f"MatrixSelector({self.expr}, {self.range}, {self.offset})"
 
-    def eval(self, perform_resmaple=True):
-        print(f"MatrixSelector({self.expr}, {self.range}, {self.offset})")
-        if isinstance(self.expr, VectorSelector):
-            df = fetch_metric_data(
-                self.expr.name,
-                self.expr.label_matchers,
-                start_datetime=self.range.start_time,
-                end_datetime=self.range.end_time,
-                offset=self.offset,
-            )
-        else:
-            df = self.expr.eval()
-            start_datetime = self.range.start_time - datetime.timedelta(
-                seconds=self.offset
-            )
-            end_datetime = self.range.end_time - datetime.timedelta(seconds=self.offset)
-            df = df.loc[
-                (df[TIME_COL] >= start_datetime) & (df[TIME_COL] <= end_datetime)
-            ]
-        if perform_resmaple:
-            df = resample(df)
-        return df
+    def window(self):
+        """Returns the start and end of the range, shifted by the offset"""
+        offset = datetime.timedelta(seconds=self.offset)
+        return self.range.start_time - offset, self.range.end_time - offset
+
+    def fetch(self) -> pd.DataFrame:
+        """Reads the samples of the range of a vector selector"""
+        return fetch_metric_data(
+            self.expr.name,
+            self.expr.label_matchers,
+            start_datetime=self.range.start_time,
+            end_datetime=self.range.end_time,
+            offset=self.offset,
+        )
+
+    @traced
+    def eval(self):
+        """Reads the raw samples of the range, start excluded"""
+        # fetched by prefetch when the query has other fetches to overlap
+        df, self.prefetched = self.prefetched, None
+        if df is None:
+            df = self.fetch()
+        series = SeriesSet.from_frame(df)
+        start = pd.Timestamp(self.window()[0]).as_unit("ns").value
+        return series.filter(series.times > start)
 
 
 class SubqueryExpr(ExecutableExpr):
     def __init__(self, expr=None, _range=None, step=None, offset=0):
         self.matrix_selector = MatrixSelector(expr=expr, _range=_range, offset=offset)
         self.step = step
+        # the expression at each step (see query.find_subqueries)
+        self.prefetched = None
+
+    @property
+    def offset(self):
+        return self.matrix_selector.offset
+
+    @offset.setter
+    def offset(self, offset):
+        # `offset` applies to the range of the subquery
+        self.matrix_selector.offset = offset
 
     def __str__(self):
-        return f"SubqueryExpr({self.matrix_selector}, {self.offset})"
+        return f"SubqueryExpr({self.matrix_selector}, {self.step})"
 
+    @traced
     def eval(self):
-        print(f"SubqueryExpr({self.matrix_selector}, {self.step})")
-        df = self.matrix_selector.eval(perform_resmaple=self.step is None)
-        if self.step is not None:
-            df = resample(df, self.step)
-        return df
+        series, self.prefetched = self.prefetched, None
+        if series is None:
+            raise ValueError("subqueries are evaluated by evaluate_instant")
+        return series
 
 
 class UnaryExpr(ExecutableExpr):
@@ -144,29 +206,82 @@ class UnaryExpr(ExecutableExpr):
     def __str__(self):
         return f"UnaryExpr({self.op}, {self.expr})"
 
+    @traced
     def eval(self):
-        pass
+        value = eval_operand(self.expr)
+        if str(self.op) != "-":
+            return value
+        if isinstance(value, SeriesSet):
+            return value.with_values(-value.values)
+        return -value
 
 
 class VectorSelector(ExecutableExpr):
-    def __init__(self, name=None, label_matchers={}, offset=0):
+    def __init__(self, name=None, label_matchers={}, offset=0, eval_time=None):
         self.name = name
         self.label_matchers = label_matchers
         self.offset = offset
+        self.eval_time = eval_time
+        self.prefetched = None
 
     def __str__(self):
         return f"VectorSelector({self.name}, {self.label_matchers}, {self.offset})"
 
-    def eval(self):
-        print(f"VectorSelector({self.name}, {self.label_matchers}, {self.offset})")
-        df = fetch_metric_data(
+    def fetch(self, eval_time: datetime.datetime) -> pd.DataFrame:
+        """Reads the latest sample of each series at eval_time"""
+        return fetch_metric_data(
             self.name,
             self.label_matchers,
-            end_datetime=datetime.datetime.now(),
+            end_datetime=eval_time,
             offset=self.offset,
+            latest=True,
         )
-        df = df.loc[df.groupby(find_tags(df))[TIME_COL].idxmax()]
-        return df
+
+    @traced
+    def eval(self):
+        eval_time = self.eval_time or utc_now()
+        df, self.prefetched = self.prefetched, None
+        if df is None:
+            df = self.fetch(eval_time)
+        # instant vectors are stamped with the evaluation time, which is what
+        # binary operators match the samples of both sides on
+        df[TIME_COL] = eval_time
+        return SeriesSet.from_frame(df)
+
+
+class MetricUnion(ExecutableExpr):
+    """The same expression over several metrics, e.g. a selector on
+    `__name__=~"..."` expanded by the planner to the metrics which match
+
+    Args:
+        names (List[str]): the metric of each expression
+        exprs (List[ExecutableExpr]): the expression of each metric
+        name_label (bool): whether the series are given a `__name__` label
+            with their metric, which selectors do and functions do not
+    """
+
+    def __init__(self, names=None, exprs=None, name_label=True):
+        self.names = names
+        self.exprs = exprs
+        self.name_label = name_label
+
+    def __str__(self):
+        return f"MetricUnion({list_to_str(self.names)}, [{list_to_str(self.exprs)}])"
+
+    def combine(self, results: List[SeriesSet]) -> SeriesSet:
+        """Merges the results of the expressions into one series set"""
+        if self.name_label:
+            results = [
+                result.with_labels(
+                    [labels.set("__name__", name) for labels in result.labels]
+                )
+                for name, result in zip(self.names, results)
+            ]
+        return SeriesSet.concat(results)
+
+    @traced
+    def eval(self):
+        return self.combine([expr.eval() for expr in self.exprs])
 
 
 class SeriesDescription:
@@ -188,9 +303,17 @@ class SequenceValue:
 
 
 class TimeRange:
-    def __init__(self, start_time=None, end_time=None):
+    def __init__(self, start_time=None, end_time=None, duration=None):
         self.start_time = start_time
         self.end_time = end_time
+        # seconds, for ranges relative to the evaluation time (e.g. `[5m]`)
+        self.duration = duration
+
+    def anchor(self, eval_time):
+        """Moves a relative range so that it ends at eval_time"""
+        if self.duration is not None:
+            self.end_time = eval_time
+            self.start_time = eval_time - datetime.timedelta(seconds=self.duration)
 
     def __str__(self):
         return f"TimeRange({self.start_time}, {self.end_time})"
@@ -1,8 +1,7 @@
-import datetime
 from typing import List
 import pandas as pd
 
-from .constants import TIME_COL, VAL_COL, DEFAULT_INTERVAL
+from .constants import TIME_COL, VAL_COL
 
 
 def find_tags(df: pd.DataFrame) -> List[str]:
@@ -10,21 +9,11 @@ def find_tags(df: pd.DataFrame) -> List[str]:
     return list(tags)
 
 
-def resample(
-    df: pd.DataFrame,
-    interval: int = DEFAULT_INTERVAL,
-    agg_type: str = "mean",
-    start_datetime: datetime.datetime = None,
-    end_datetime: datetime.datetime = None,
-) -> pd.DataFrame:
-    df = df.set_index(TIME_COL)
-    if start_datetime is not None and start_datetime not in df.index:
-        df.loc[start_datetime] = None
-    if end_datetime is not None and end_datetime not in df.index:
-        df.loc[end_datetime] = None
-
-    df_resampled = df.groupby(find_tags(df))[VAL_COL].resample(f"{interval}S").agg(agg_type)
-    interpolated = df_resampled.interpolate(method="linear")
-    out_df = interpolated.reset_index()
-    return out_df
-
+def latest_samples(df: pd.DataFrame) -> pd.DataFrame:
+    """Keeps the row with the latest timestamp of each series"""
+    if df.empty:
+        return df
+    tags = find_tags(df)
+    if len(tags) == 0:
+        return df.loc[[df[TIME_COL].idxmax()]]
+    return df.loc[df.groupby(tags, dropna=False)[TIME_COL].idxmax()]
@@ -1,13 +1,71 @@
 import os
+from functools import lru_cache
 from pathlib import Path
 from lark import Lark
 
+GRAMMAR_PATH = os.path.join(Path(__file__).parent.absolute(), "promsql.lark")
+
+DEFAULT_QUERY_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=None)
+def read_grammar(grammar_path: str = GRAMMAR_PATH) -> str:
+    """Reads the grammar file once per process
+
+    Args:
+        grammar_path (str, optional): path of the lark grammar.
+
+    Returns:
+        str: the grammar text
+    """
+    with open(grammar_path, "r") as f:
+        return f.read()
+
 
 class PromSqlParser(Lark):
-    def __init__(self, **kwargs):
-        current_dir = Path(__file__).parent.absolute()
-        grammar = open(os.path.join(current_dir, "promsql.lark"), "r").read()
+    """PromQL parser
+
+    By default the grammar is compiled to an LALR table which lark serializes
+    to disk, so later instances (and later processes) load the table instead
+    of rebuilding it. Pass ``parser="earley"`` to fall back to the Earley
+    parser, e.g. while experimenting with grammar changes.
+
+    Parsed trees are kept in a bounded LRU cache keyed by the query text. The
+    cached trees are shared between callers and must not be mutated.
+
+    Args:
+        parser (str, optional): "lalr" or "earley". Defaults to "lalr".
+        query_cache_size (int, optional): number of parsed queries to keep;
+            0 disables the cache.
+        **kwargs: passed to lark. ``cache`` may be a file path to choose where
+            the compiled LALR parser is stored.
+    """
+
+    def __init__(
+        self,
+        parser: str = "lalr",
+        query_cache_size: int = DEFAULT_QUERY_CACHE_SIZE,
+        **kwargs,
+    ):
         kwargs["start"] = "start"
-        kwargs["parser"] = "earley"
-        super().__init__(grammar, **kwargs)
+        kwargs["parser"] = parser
+        if parser == "lalr":
+            kwargs.setdefault("lexer", "contextual")
+            kwargs.setdefault("cache", True)
+        super().__init__(read_grammar(), **kwargs)
+        if query_cache_size:
+            self._cached_parse = lru_cache(maxsize=query_cache_size)(self._parse_text)
+        else:
+            self._cached_parse = None
+
+    def _parse_text(self, text, start=None):
+        return super().parse(text, start=start)
+
+    def parse(self, text, start=None, on_error=None):
+        if self._cached_parse is None or on_error is not None:
+            return super().parse(text, start=start, on_error=on_error)
+        return self._cached_parse(text, start)
 
+    def clear_query_cache(self):
+        if self._cached_parse is not None:
+            self._cached_parse.cache_clear()
@@ -0,0 +1,1041 @@
+"""Compiles PromQL node trees into SQL queries which run inside the database"""
+
+import datetime
+import functools
+import operator
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+import sqlalchemy
+
+from .clock import utc_now
+from .concurrency import run_fetches
+from .constants import VAL_COL, TIME_COL
+from .cost import QueryCost, estimate_fetch, estimate_output, estimate_selectivity
+from .limits import current_budget
+from .nodes import (
+    AggregateExpr,
+    BinaryExpression,
+    ExecutableExpr,
+    Function,
+    MatrixSelector,
+    MetricUnion,
+    SubqueryExpr,
+    TimeRange,
+    UnaryExpr,
+    VectorSelector,
+)
+from .rollups import get_resolutions, select_rollup_aggregate
+from .series import SeriesSet
+from .tracing import trace, traced
+from .dialects import get_latest_sample_strategy, select_latest_samples
+from .sql_miscs import (
+    fetch_metric_data,
+    get_metric_configs,
+    get_metric_table,
+    get_tag_columns,
+    get_where_clauses,
+    metric_catalog,
+)
+
+SAMPLE_COUNT_COL = "__samples__"
+
+SQL_AGGREGATIONS = {
+    "sum": sqlalchemy.func.sum,
+    "avg": sqlalchemy.func.avg,
+    "min": sqlalchemy.func.min,
+    "max": sqlalchemy.func.max,
+    "count": sqlalchemy.func.count,
+}
+
+SQL_RANGE_AGGREGATIONS = {
+    "sum_over_time": sqlalchemy.func.sum,
+    "avg_over_time": sqlalchemy.func.avg,
+    "min_over_time": sqlalchemy.func.min,
+    "max_over_time": sqlalchemy.func.max,
+    "count_over_time": sqlalchemy.func.count,
+}
+
+ARITHMETIC_OPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+}
+
+COMPARISON_OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+}
+
+
+class SqlPlan:
+    """A subtree compiled into a single select statement
+
+    The statement returns one row per output series, with a column for each
+    label in `labels` and the sample value in VAL_COL. The rows are unique
+    on `labels` unless `unique` is False, e.g. when only some of the tag
+    columns of a selector are selected.
+    """
+
+    def __init__(self, configs: Dict, select, labels: List[str], unique: bool = True):
+        self.configs = configs
+        self.select = select
+        self.labels = labels
+        self.unique = unique
+
+    def __str__(self):
+        return f"SqlPlan({self.configs['TABLE_NAME']}, {self.labels})"
+
+
+class SqlQueryExpr(ExecutableExpr):
+    """Evaluates a subtree which has been pushed down to the database"""
+
+    def __init__(self, plan: SqlPlan, expr=None, eval_time=None):
+        self.plan = plan
+        self.expr = expr
+        self.eval_time = eval_time
+        self.prefetched = None
+
+    def __str__(self):
+        return f"SqlQueryExpr({self.plan}, {self.expr})"
+
+    def fetch(self) -> pd.DataFrame:
+        configs = self.plan.configs
+        with trace("fetch sql") as span:
+            df = pd.read_sql(self.plan.select, configs["DB"])
+            budget = current_budget()
+            if budget is not None:
+                budget.add_frame(
+                    (configs["DB"], configs["TABLE_NAME"]), df, self.plan.labels
+                )
+            if span is not None:
+                span.record(sql=str(self.plan.select))
+                span.record_result(df)
+        return df
+
+    @traced
+    def eval(self):
+        df, self.prefetched = self.prefetched, None
+        if df is None:
+            df = self.fetch()
+        df[TIME_COL] = self.eval_time
+        return SeriesSet.from_frame(df)
+
+
+def is_scalar(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class QueryPlanner:
+    """Rewrites a node tree so that the database does as much work as possible
+
+    Every subtree which can be expressed as one SQL statement (selectors,
+    `sum/avg/min/max/count` aggregations, `*_over_time` range aggregations,
+    arithmetic and comparisons with scalars or between two pushed down
+    vectors whose matching labels identify their series on both sides) is
+    replaced by a SqlQueryExpr. The rest of the tree is left to the pandas
+    implementation of the nodes. Range aggregations over long ranges read
+    the rollup tables of their metric when it has some; see
+    select_rollup_aggregate.
+
+    Division is only pushed down by non-zero number literals: not every
+    database has the IEEE semantics PromQL gives division by zero (+Inf,
+    -Inf or NaN), so the other divisions are evaluated in pandas.
+
+    Args:
+        eval_time (datetime.datetime, optional): the evaluation timestamp of
+            instant vectors. Defaults to now, in UTC.
+    """
+
+    def __init__(self, eval_time: datetime.datetime = None):
+        self.eval_time = eval_time or utc_now()
+
+    def plan(self, expr) -> Union[ExecutableExpr, float, str]:
+        """Returns an equivalent expression with pushed down subtrees"""
+        value = self.fold_constant(expr)
+        if value is not None:
+            return value
+        if not isinstance(expr, ExecutableExpr):
+            return expr
+        if isinstance(expr, VectorSelector):
+            # bare selectors are cheaper to evaluate through fetch_metric_data
+            return expr
+        plan = self.compile(expr)
+        if plan is not None:
+            return SqlQueryExpr(plan, expr, self.eval_time)
+        self.plan_children(expr)
+        return expr
+
+    def anchor(self, expr):
+        """Evaluates the selectors and relative ranges of expr at eval_time"""
+        if isinstance(expr, VectorSelector):
+            expr.eval_time = self.eval_time
+        elif isinstance(expr, MatrixSelector):
+            expr.range.anchor(self.eval_time)
+            self.anchor(expr.expr)
+        elif isinstance(expr, SubqueryExpr):
+            # the expression is evaluated at each step of the subquery
+            # instead, see find_subqueries
+            expr.matrix_selector.range.anchor(self.eval_time)
+        elif isinstance(expr, AggregateExpr):
+            for arg in expr.function_call_body:
+                self.anchor(arg)
+        elif isinstance(expr, BinaryExpression):
+            self.anchor(expr.left_expr)
+            self.anchor(expr.right_expr)
+        elif isinstance(expr, Function):
+            for arg in expr.args:
+                self.anchor(arg)
+        elif isinstance(expr, UnaryExpr):
+            self.anchor(expr.expr)
+        elif isinstance(expr, MetricUnion):
+            for child in expr.exprs:
+                self.anchor(child)
+
+    def plan_children(self, expr):
+        if isinstance(expr, AggregateExpr):
+            expr.function_call_body = [
+                self.plan(arg) for arg in expr.function_call_body
+            ]
+        elif isinstance(expr, BinaryExpression):
+            expr.left_expr = self.plan(expr.left_expr)
+            expr.right_expr = self.plan(expr.right_expr)
+        elif isinstance(expr, Function):
+            expr.args = [self.plan(arg) for arg in expr.args]
+        elif isinstance(expr, UnaryExpr):
+            expr.expr = self.plan(expr.expr)
+        elif isinstance(expr, MetricUnion):
+            expr.exprs = [self.plan(child) for child in expr.exprs]
+
+    def fold_constant(self, expr) -> Optional[float]:
+        """Evaluates arithmetic between number literals"""
+        if is_scalar(expr):
+            return float(expr)
+        if isinstance(expr, UnaryExpr):
+            value = self.fold_constant(expr.expr)
+            if value is not None:
+                return -value if expr.op == "-" else value
+        if isinstance(expr, BinaryExpression) and str(expr.op) in ARITHMETIC_OPS:
+            left = self.fold_constant(expr.left_expr)
+            right = self.fold_constant(expr.right_expr)
+            if left is not None and right is not None:
+                if expr.op == "/" and right == 0:
+                    return None
+                return ARITHMETIC_OPS[str(expr.op)](left, right)
+        return None
+
+    def compile(self, expr, labels: List[str] = None) -> Optional[SqlPlan]:
+        """Compiles expr into a SqlPlan; returns None if it cannot be pushed down
+
+        Args:
+            expr: the node to compile
+            labels (List[str], optional): the labels the caller needs; the
+                other label columns are not selected. Defaults to all labels.
+        """
+        if isinstance(expr, VectorSelector):
+            end_datetime = self.eval_time - datetime.timedelta(seconds=expr.offset)
+            return self.compile_selector(expr, None, end_datetime, labels=labels)
+        if isinstance(expr, AggregateExpr):
+            return self.compile_aggregate(expr)
+        if isinstance(expr, BinaryExpression):
+            return self.compile_binary(expr, labels)
+        if isinstance(expr, Function):
+            return self.compile_function(expr, labels)
+        if isinstance(expr, UnaryExpr):
+            plan = self.compile(expr.expr, labels)
+            if plan is None or expr.op == "+":
+                return plan
+            return self.map_values(plan, operator.neg)
+        return None
+
+    def compile_selector(
+        self,
+        selector: VectorSelector,
+        start_datetime: Optional[datetime.datetime],
+        end_datetime: datetime.datetime,
+        aggregation=None,
+        labels: List[str] = None,
+    ) -> Optional[SqlPlan]:
+        """Compiles the samples of a selector within a time range
+
+        The samples of each series are reduced by `aggregation`, or to the
+        most recent one when it is None.
+        Series are always told apart by all tag columns, but only the tags in
+        `labels` are selected.
+        """
+        configs = get_metric_configs(
+            {
+                "metric_name": selector.name,
+                "labels": selector.label_matchers,
+                "start_datetime": start_datetime,
+                "end_datetime": end_datetime,
+            }
+        )
+        if start_datetime is None:
+            start_datetime = end_datetime - datetime.timedelta(
+                seconds=configs["LOOK_BEHIND_DURATION"]
+            )
+        tags = get_tag_columns(configs)
+        table = get_metric_table(
+            configs, tags + [l for l in selector.label_matchers if l not in tags]
+        )
+        # windows are left-open, (start, end], as for the range functions
+        where_clauses = get_where_clauses(
+            table,
+            configs,
+            selector.label_matchers,
+            start_datetime,
+            end_datetime,
+            left_open=True,
+        )
+        tag_columns = [table.c[tag] for tag in tags]
+        output = tags if labels is None else [tag for tag in tags if tag in labels]
+        value = table.c[configs["VALUE_COLUMN"]]
+        if aggregation is not None:
+            select = sqlalchemy.select(
+                *[table.c[tag] for tag in output], aggregation(value).label(VAL_COL)
+            )
+            select = select.where(*where_clauses)
+            if tag_columns:
+                select = select.group_by(*tag_columns)
+            return SqlPlan(configs, select, output, len(output) == len(tags))
+
+        if get_latest_sample_strategy(configs) == "pandas":
+            return None
+        select = select_latest_samples(
+            configs,
+            table,
+            tag_columns,
+            [table.c[tag] for tag in output] + [value.label(VAL_COL)],
+            where_clauses,
+        )
+        return SqlPlan(configs, select, output, len(output) == len(tags))
+
+    def compile_aggregate(self, expr: AggregateExpr) -> Optional[SqlPlan]:
+        op = str(expr.aggregate_op)
+        if op not in SQL_AGGREGATIONS or len(expr.function_call_body) != 1:
+            return None
+        modifier = expr.aggregate_modifier
+        if modifier is None:
+            needed = []
+        elif modifier.without:
+            needed = None
+        else:
+            needed = modifier.grouping
+        plan = self.compile(expr.function_call_body[0], needed)
+        if plan is None:
+            return None
+        if modifier is None:
+            grouping = []
+        elif modifier.without:
+            grouping = [l for l in plan.labels if l not in modifier.grouping]
+        else:
+            grouping = [l for l in plan.labels if l in modifier.grouping]
+
+        inner = plan.select.subquery()
+        group_columns = [inner.c[label] for label in grouping]
+        aggregated = SQL_AGGREGATIONS[op](inner.c[VAL_COL]).label(VAL_COL)
+        if group_columns:
+            select = sqlalchemy.select(*group_columns, aggregated).group_by(
+                *group_columns
+            )
+            return SqlPlan(plan.configs, select, grouping)
+
+        # without GROUP BY the database returns a row even if there is no input
+        counted = (
+            sqlalchemy.select(
+                aggregated,
+                sqlalchemy.func.count(inner.c[VAL_COL]).label(SAMPLE_COUNT_COL),
+            )
+        ).subquery()
+        select = sqlalchemy.select(counted.c[VAL_COL]).where(
+            counted.c[SAMPLE_COUNT_COL] > 0
+        )
+        return SqlPlan(plan.configs, select, [])
+
+    def compile_function(
+        self, expr: Function, labels: List[str] = None
+    ) -> Optional[SqlPlan]:
+        if expr.name not in SQL_RANGE_AGGREGATIONS and expr.name != "last_over_time":
+            return None
+        if len(expr.args) != 1:
+            return None
+        matrix = expr.args[0]
+        if not isinstance(matrix, MatrixSelector) or not isinstance(
+            matrix.expr, VectorSelector
+        ):
+            return None
+        offset = datetime.timedelta(seconds=matrix.offset)
+        start_datetime = matrix.range.start_time - offset
+        end_datetime = matrix.range.end_time - offset
+        if expr.name == "last_over_time":
+            return self.compile_selector(
+                matrix.expr, start_datetime, end_datetime, labels=labels
+            )
+        plan = self.compile_rollup(
+            matrix.expr, start_datetime, end_datetime, expr.name, labels
+        )
+        if plan is not None:
+            return plan
+        return self.compile_selector(
+            matrix.expr,
+            start_datetime,
+            end_datetime,
+            aggregation=SQL_RANGE_AGGREGATIONS[expr.name],
+            labels=labels,
+        )
+
+    def compile_rollup(
+        self,
+        selector: VectorSelector,
+        start_datetime: datetime.datetime,
+        end_datetime: datetime.datetime,
+        function: str,
+        labels: List[str] = None,
+    ) -> Optional[SqlPlan]:
+        """Compiles a `*_over_time` aggregation which reads from a rollup
+        table; returns None if the metric has no rollup which fits the range,
+        see select_rollup_aggregate"""
+        configs = get_metric_configs(
+            {
+                "metric_name": selector.name,
+                "labels": selector.label_matchers,
+                "start_datetime": start_datetime,
+                "end_datetime": end_datetime,
+            }
+        )
+        if not get_resolutions(configs):
+            return None
+        tags = get_tag_columns(configs)
+        output = tags if labels is None else [tag for tag in tags if tag in labels]
+        select = select_rollup_aggregate(
+            configs,
+            selector.label_matchers,
+            start_datetime,
+            end_datetime,
+            function[: -len("_over_time")],
+            output,
+        )
+        if select is None:
+            return None
+        return SqlPlan(configs, select, output, len(output) == len(tags))
+
+    def compile_binary(
+        self, expr: BinaryExpression, labels: List[str] = None
+    ) -> Optional[SqlPlan]:
+        op = str(expr.op)
+        if op not in ARITHMETIC_OPS and op not in COMPARISON_OPS:
+            return None
+        return_bool = expr.bin_modifier is not None and expr.bin_modifier.return_bool
+        left = self.fold_constant(expr.left_expr)
+        right = self.fold_constant(expr.right_expr)
+        if left is not None and right is not None:
+            return None
+        if left is None and right is None:
+            # both sides are matched on their labels, which `on` narrows down
+            matching = expr.bin_modifier.vector_matching if expr.bin_modifier else None
+            if matching is not None and matching.on:
+                labels = matching.matching_labels
+            else:
+                labels = None
+        if left is None:
+            left = self.compile(expr.left_expr, labels)
+            if left is None:
+                return None
+        if right is None:
+            right = self.compile(expr.right_expr, labels)
+            if right is None:
+                return None
+
+        if is_scalar(left) or is_scalar(right):
+            plan = right if is_scalar(left) else left
+            inner = plan.select.subquery()
+            value = inner.c[VAL_COL]
+            lhs, rhs = (left, value) if is_scalar(left) else (value, right)
+            labels = plan.labels
+            columns = [inner.c[label] for label in labels]
+            unique = plan.unique
+        else:
+            if left.configs["DB"] is not right.configs["DB"]:
+                return None
+            join = self.join_one_to_one(left, right, expr.bin_modifier)
+            if join is None:
+                return None
+            lhs, rhs, labels, columns, inner = join
+            value = lhs
+            unique = True
+
+        if op in ARITHMETIC_OPS:
+            if op == "/" and (not is_scalar(rhs) or rhs == 0):
+                # see the division by zero in the docstring of the class
+                return None
+            result = ARITHMETIC_OPS[op](lhs, rhs)
+            select = sqlalchemy.select(*columns, result.label(VAL_COL))
+        elif return_bool:
+            condition = COMPARISON_OPS[op](lhs, rhs)
+            result = sqlalchemy.case((condition, 1.0), else_=0.0)
+            select = sqlalchemy.select(*columns, result.label(VAL_COL))
+        else:
+            condition = COMPARISON_OPS[op](lhs, rhs)
+            select = sqlalchemy.select(*columns, value.label(VAL_COL)).where(condition)
+        select = select.select_from(inner)
+        return SqlPlan(
+            (right if is_scalar(left) else left).configs, select, labels, unique
+        )
+
+    def join_one_to_one(self, left: SqlPlan, right: SqlPlan, bin_modifier):
+        """Joins two plans on their matching labels
+
+        The join is only one-to-one when the matching labels are all the
+        labels of both plans and their rows are unique on them. Otherwise
+        several series of a side could share a match group, which PromQL
+        reports as an error (or matches with group_left/group_right), so the
+        matching is left to binary_operation.
+
+        Returns:
+            the left and right values, the result labels and their columns
+            and the joined selectable; None when the matching cannot be
+            expressed as an inner join.
+        """
+        matching = bin_modifier.vector_matching if bin_modifier else None
+        if matching is not None and matching.card not in (None, "OneToOne"):
+            return None
+        matching_labels = (matching.matching_labels if matching else None) or []
+        if matching is not None and matching.on:
+            on_labels = list(matching_labels)
+            if any(l not in left.labels or l not in right.labels for l in on_labels):
+                return None
+            result_labels = on_labels
+        else:
+            on_labels = [l for l in left.labels if l not in matching_labels]
+            right_labels = [l for l in right.labels if l not in matching_labels]
+            if set(on_labels) != set(right_labels):
+                return None
+            result_labels = on_labels
+        for plan in (left, right):
+            if not plan.unique or set(on_labels) != set(plan.labels):
+                return None
+
+        lhs_query = left.select.subquery()
+        rhs_query = right.select.subquery()
+        on_clause = sqlalchemy.and_(
+            sqlalchemy.true(),
+            *[lhs_query.c[l] == rhs_query.c[l] for l in on_labels],
+        )
+        joined = lhs_query.join(rhs_query, on_clause)
+        columns = [lhs_query.c[l] for l in result_labels]
+        return (
+            lhs_query.c[VAL_COL],
+            rhs_query.c[VAL_COL],
+            result_labels,
+            columns,
+            joined,
+        )
+
+    def map_values(self, plan: SqlPlan, function) -> SqlPlan:
+        inner = plan.select.subquery()
+        select = sqlalchemy.select(
+            *[inner.c[label] for label in plan.labels],
+            function(inner.c[VAL_COL]).label(VAL_COL),
+        )
+        return SqlPlan(plan.configs, select, plan.labels, plan.unique)
+
+
+def selector_configs(selector: VectorSelector) -> Dict:
+    return get_metric_configs(
+        {
+            "metric_name": selector.name,
+            "labels": selector.label_matchers,
+            "start_datetime": None,
+            "end_datetime": None,
+        }
+    )
+
+
+def selector_key(selector: VectorSelector) -> Tuple:
+    """Identifies the samples of a selector, whatever its offset"""
+    labels = selector.label_matchers or dict()
+    return (
+        selector.name,
+        tuple(
+            sorted(
+                (name, option["op"], option["value"]) for name, option in labels.items()
+            )
+        ),
+    )
+
+
+def selector_source(selector: VectorSelector) -> Tuple:
+    """Identifies the database, table and columns a selector reads and the
+    configs its results depend on, e.g. to cache results across databases"""
+    configs = selector_configs(selector)
+    database = sqlalchemy.engine.make_url(getattr(configs["DB"], "url", configs["DB"]))
+    tag_columns = configs["TAG_COLUMNS"]
+    resolutions = get_resolutions(configs)
+    return (
+        database.render_as_string(hide_password=True),
+        configs["TABLE_NAME"],
+        configs["TIMESTAMP_COLUMN"],
+        configs["VALUE_COLUMN"],
+        tuple(tag_columns) if isinstance(tag_columns, list) else tag_columns,
+        configs["LOOK_BEHIND_DURATION"],
+        tuple(resolutions) if resolutions else None,
+    )
+
+
+class SharedExpr(ExecutableExpr):
+    """A subtree which occurs several times in a query, evaluated once
+
+    Every occurrence is replaced by the same SharedExpr (see
+    share_subexpressions), which evaluates the subtree the first time and
+    returns the same result afterwards. Results are never modified in place
+    by the operators, so they can be shared.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.evaluated = False
+        self.result = None
+
+    def __str__(self):
+        return f"SharedExpr({self.expr})"
+
+    @traced
+    def eval(self):
+        if not self.evaluated:
+            self.result = self.expr.eval()
+            self.evaluated = True
+        return self.result
+
+
+# nodes whose value is an instant vector, which can be shared as they are
+SHAREABLE_EXPRS = (
+    AggregateExpr,
+    BinaryExpression,
+    Function,
+    SqlQueryExpr,
+    UnaryExpr,
+    VectorSelector,
+)
+
+
+def structural_key(expr) -> Optional[Tuple]:
+    """Returns a key which is equal for structurally equal subtrees
+
+    Returns:
+        Optional[Tuple]: the key, None for subtrees which cannot be compared
+    """
+    if isinstance(expr, SharedExpr):
+        return structural_key(expr.expr)
+    if isinstance(expr, SqlQueryExpr):
+        key = structural_key(expr.expr)
+        return None if key is None else ("sql", key)
+    if isinstance(expr, VectorSelector):
+        return ("selector", selector_key(expr), expr.offset or 0, expr.eval_time)
+    if isinstance(expr, MatrixSelector):
+        time_range = expr.range
+        if time_range.duration is not None:
+            range_key = (time_range.duration,)
+        else:
+            range_key = (time_range.start_time, time_range.end_time)
+        key = structural_key(expr.expr)
+        return None if key is None else ("matrix", key, range_key, expr.offset or 0)
+    if isinstance(expr, SubqueryExpr):
+        key = structural_key(expr.matrix_selector)
+        return None if key is None else ("subquery", key, expr.step)
+    if isinstance(expr, AggregateExpr):
+        modifier = expr.aggregate_modifier
+        keys = [structural_key(arg) for arg in expr.function_call_body]
+        if any(key is None for key in keys):
+            return None
+        return (
+            "aggregate",
+            str(expr.aggregate_op),
+            tuple(modifier.grouping or []) if modifier else None,
+            bool(modifier.without) if modifier else False,
+            tuple(keys),
+        )
+    if isinstance(expr, BinaryExpression):
+        left, right = structural_key(expr.left_expr), structural_key(expr.right_expr)
+        if left is None or right is None:
+            return None
+        modifier = expr.bin_modifier
+        matching = modifier.vector_matching if modifier else None
+        return (
+            "binary",
+            str(expr.op),
+            bool(modifier.return_bool) if modifier else False,
+            (
+                (
+                    matching.card,
+                    tuple(matching.matching_labels or []),
+                    bool(matching.on),
+                    tuple(matching.include or []),
+                )
+                if matching
+                else None
+            ),
+            left,
+            right,
+        )
+    if isinstance(expr, Function):
+        keys = [structural_key(arg) for arg in expr.args]
+        if any(key is None for key in keys):
+            return None
+        return ("function", expr.name, tuple(keys))
+    if isinstance(expr, UnaryExpr):
+        key = structural_key(expr.expr)
+        return None if key is None else ("unary", str(expr.op), key)
+    if isinstance(expr, MetricUnion):
+        keys = [structural_key(child) for child in expr.exprs]
+        if any(key is None for key in keys):
+            return None
+        return ("union", tuple(expr.names), expr.name_label, tuple(keys))
+    if isinstance(expr, ExecutableExpr):
+        return None
+    return ("literal", type(expr).__name__, str(expr))
+
+
+def share_subexpressions(expr):
+    """Replaces the repeated subtrees of expr with one SharedExpr each
+
+    Structurally equal instant vector subtrees, e.g. both `x` in
+    `x / sum(x)`, are then evaluated once. Range selectors are not shared
+    this way; prefetch merges their fetches instead.
+    """
+    counts = Counter()
+    visit_shareable(expr, lambda node: counts.update([structural_key(node)]))
+    shared = dict()
+
+    def share(node):
+        key = structural_key(node) if isinstance(node, SHAREABLE_EXPRS) else None
+        if key is None or counts[key] < 2:
+            replace_children(node, share)
+            return node
+        if key not in shared:
+            replace_children(node, share)
+            shared[key] = SharedExpr(node)
+        return shared[key]
+
+    return share(expr)
+
+
+def replace_children(expr, replace: Callable):
+    """Replaces the children of expr which may be shared with replace(child)"""
+    if isinstance(expr, AggregateExpr):
+        expr.function_call_body = [replace(arg) for arg in expr.function_call_body]
+    elif isinstance(expr, BinaryExpression):
+        expr.left_expr = replace(expr.left_expr)
+        expr.right_expr = replace(expr.right_expr)
+    elif isinstance(expr, Function):
+        expr.args = [replace(arg) for arg in expr.args]
+    elif isinstance(expr, UnaryExpr):
+        expr.expr = replace(expr.expr)
+    elif isinstance(expr, MetricUnion):
+        expr.exprs = [replace(child) for child in expr.exprs]
+    # range selectors read their vector selector themselves, and the
+    # expressions of subqueries are evaluated over their own steps
+
+
+def visit_shareable(expr, visit: Callable):
+    """Calls visit on every node of expr which share_subexpressions may share"""
+
+    def walk(node):
+        key = structural_key(node) if isinstance(node, SHAREABLE_EXPRS) else None
+        if key is not None:
+            visit(node)
+        replace_children(node, walk)
+        return node
+
+    walk(expr)
+
+
+def find_selectors(expr) -> List[VectorSelector]:
+    """Lists the vector selectors of expr, in range selectors and subqueries
+    too, in the order of the query"""
+    selectors = []
+
+    def walk(node):
+        if isinstance(node, SharedExpr):
+            walk(node.expr)
+        elif isinstance(node, VectorSelector):
+            selectors.append(node)
+        elif isinstance(node, MatrixSelector):
+            walk(node.expr)
+        elif isinstance(node, SubqueryExpr):
+            walk(node.matrix_selector.expr)
+        else:
+            replace_children(node, walk)
+        return node
+
+    walk(expr)
+    return selectors
+
+
+def merge_windows(windows: List[Tuple]) -> List[Tuple]:
+    """Merges the overlapping or adjacent (start, end, item) windows
+
+    Returns:
+        List[Tuple]: (start, end, items) for each merged window
+    """
+    merged = []
+    for start, end, item in sorted(windows, key=lambda window: window[0]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+            merged[-1][2].append(item)
+        else:
+            merged.append([start, end, [item]])
+    return [tuple(window) for window in merged]
+
+
+def slice_frame(df: pd.DataFrame, start, end) -> pd.DataFrame:
+    """Keeps the samples of a long frame with start <= time <= end"""
+    times = df[TIME_COL]
+    tz = getattr(times.dt, "tz", None) if len(df) else None
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if tz is not None:
+        start, end = start.tz_localize(tz), end.tz_localize(tz)
+    return df[(times >= start) & (times <= end)].reset_index(drop=True)
+
+
+def collect_fetches(expr, fetches: List, seen: set = None):
+    """Lists the leaves of expr which read from a database
+
+    Each fetch is appended as the node, the configs of its metric, a function
+    which returns what the node reads when it is evaluated, and for the range
+    selectors the selector and window they read, so that windows of the same
+    selector can be merged. Subqueries read what they need themselves, see
+    query.find_subqueries.
+    """
+    seen = set() if seen is None else seen
+    if isinstance(expr, SharedExpr):
+        if id(expr) not in seen:
+            seen.add(id(expr))
+            collect_fetches(expr.expr, fetches, seen)
+    elif isinstance(expr, SqlQueryExpr):
+        fetches.append((expr, expr.plan.configs, expr.fetch, None))
+    elif isinstance(expr, VectorSelector):
+        eval_time = expr.eval_time or utc_now()
+        expr.eval_time = eval_time
+        fetches.append(
+            (
+                expr,
+                selector_configs(expr),
+                functools.partial(expr.fetch, eval_time),
+                None,
+            )
+        )
+    elif isinstance(expr, MatrixSelector):
+        fetches.append(
+            (
+                expr,
+                selector_configs(expr.expr),
+                expr.fetch,
+                (expr.expr,) + tuple(expr.window()),
+            )
+        )
+    elif isinstance(expr, Function):
+        for arg in expr.args:
+            collect_fetches(arg, fetches, seen)
+    elif isinstance(expr, AggregateExpr):
+        for arg in expr.function_call_body:
+            collect_fetches(arg, fetches, seen=seen)
+    elif isinstance(expr, BinaryExpression):
+        collect_fetches(expr.left_expr, fetches, seen=seen)
+        collect_fetches(expr.right_expr, fetches, seen=seen)
+    elif isinstance(expr, UnaryExpr):
+        collect_fetches(expr.expr, fetches, seen=seen)
+    elif isinstance(expr, MetricUnion):
+        for child in expr.exprs:
+            collect_fetches(child, fetches, seen)
+
+
+def prefetch(expr):
+    """Runs all the fetches of expr concurrently before it is evaluated
+
+    The raw samples of range selectors with the same selector and
+    overlapping or adjacent windows, e.g. `x[5m]` and `x[5m] offset 5m`, are
+    read with one fetch, which each node gets its window of. The results are
+    handed to the nodes, which use them instead of reading from the database
+    themselves; see run_fetches.
+    """
+    with trace("prefetch"):
+        run_prefetch(expr)
+
+
+def run_prefetch(expr):
+    collected = []
+    collect_fetches(expr, collected)
+    fetches, receivers = [], []
+    windows = defaultdict(list)
+    for node, configs, fetch, window in collected:
+        if window is None:
+            fetches.append((configs, fetch))
+            receivers.append([(node, None)])
+        else:
+            selector, start, end = window
+            windows[selector_key(selector)].append((start, end, (node, configs)))
+    for selector_windows in windows.values():
+        for start, end, nodes in merge_windows(selector_windows):
+            node, configs = nodes[0]
+            fetches.append(
+                (
+                    configs,
+                    functools.partial(
+                        fetch_metric_data,
+                        node.expr.name,
+                        node.expr.label_matchers,
+                        start_datetime=start,
+                        end_datetime=end,
+                    ),
+                )
+            )
+            receivers.append([(node, node.window()) for node, _ in nodes])
+    if len(fetches) < 2 and all(len(nodes) < 2 for nodes in receivers):
+        # a single fetch is as fast during the evaluation
+        return
+    results = run_fetches(fetches)
+    for nodes, result in zip(receivers, results):
+        for node, window in nodes:
+            node.prefetched = result if window is None else slice_frame(result, *window)
+
+
+def estimate_plan(expr) -> QueryCost:
+    """Estimates what the fetches of a planned instant query read; see cost
+
+    Pushed down subtrees return at most a row per combination of the values
+    of their output labels, and instant selectors the latest sample of each
+    series.
+    """
+
+    def selector_share(node) -> float:
+        """Returns the largest share of series the selectors of node select"""
+        if isinstance(node, MatrixSelector) and isinstance(node.expr, VectorSelector):
+            node = node.expr
+        if isinstance(node, VectorSelector):
+            return estimate_selectivity(selector_configs(node), node.label_matchers)
+        shares = []
+
+        def visit(child):
+            shares.append(selector_share(child))
+            return child
+
+        replace_children(node, visit)
+        return max(shares, default=1.0)
+
+    collected = []
+    collect_fetches(expr, collected)
+    cost = QueryCost()
+    for node, configs, _, _ in collected:
+        if isinstance(node, SqlQueryExpr):
+            cost.add(
+                estimate_output(
+                    configs, node.plan.labels, id(node), selector_share(node.expr)
+                )
+            )
+        elif isinstance(node, VectorSelector):
+            end = node.eval_time - datetime.timedelta(seconds=node.offset or 0)
+            start = end - datetime.timedelta(seconds=configs["LOOK_BEHIND_DURATION"])
+            cost.add(
+                estimate_fetch(
+                    configs,
+                    node.label_matchers,
+                    start,
+                    end,
+                    selector_key(node),
+                    latest=True,
+                )
+            )
+        else:
+            cost.add(
+                estimate_fetch(
+                    configs,
+                    node.expr.label_matchers,
+                    *node.window(),
+                    selector_key(node.expr),
+                )
+            )
+    return cost
+
+
+def expand_selector(selector: VectorSelector) -> Optional[MetricUnion]:
+    """Returns the union of a selector without metric name over the metrics
+    its `__name__` matcher matches; None for selectors with a name"""
+    if selector.name is not None or "__name__" not in selector.label_matchers:
+        return None
+    matcher = selector.label_matchers["__name__"]
+    names = metric_catalog.find_metrics(matcher["op"], matcher["value"])
+    matchers = {
+        name: option
+        for name, option in selector.label_matchers.items()
+        if name != "__name__"
+    }
+    return MetricUnion(
+        names,
+        [
+            VectorSelector(name, dict(matchers), selector.offset, selector.eval_time)
+            for name in names
+        ],
+    )
+
+
+def copy_range(expr: Union[MatrixSelector, SubqueryExpr], selector: VectorSelector):
+    """Returns the range or subquery expr over another selector"""
+    matrix = expr.matrix_selector if isinstance(expr, SubqueryExpr) else expr
+    time_range = TimeRange(
+        matrix.range.start_time, matrix.range.end_time, matrix.range.duration
+    )
+    if isinstance(expr, SubqueryExpr):
+        return SubqueryExpr(selector, time_range, expr.step, expr.offset)
+    return MatrixSelector(selector, time_range, expr.offset)
+
+
+def expand_metric_names(expr):
+    """Replaces the selectors on `__name__` regexes with the union of the
+    selectors of the metrics which match, from the metric catalog
+
+    Range selectors and subqueries of such selectors are expanded into a
+    union of range selectors or subqueries, and the range functions over
+    them into a union of functions, so that each function reads one metric
+    and can still be pushed down.
+    """
+    if isinstance(expr, VectorSelector):
+        union = expand_selector(expr)
+        return expr if union is None else union
+    if isinstance(expr, (MatrixSelector, SubqueryExpr)):
+        matrix = expr.matrix_selector if isinstance(expr, SubqueryExpr) else expr
+        if not isinstance(matrix.expr, VectorSelector):
+            matrix.expr = expand_metric_names(matrix.expr)
+            return expr
+        union = expand_selector(matrix.expr)
+        if union is None:
+            return expr
+        union.exprs = [copy_range(expr, selector) for selector in union.exprs]
+        return union
+    replace_children(expr, expand_metric_names)
+    if isinstance(expr, Function) and expr.args:
+        union = expr.args[-1]
+        if isinstance(union, MetricUnion):
+            # functions drop the metric name, as in Prometheus
+            return MetricUnion(
+                union.names,
+                [Function(expr.name, expr.args[:-1] + [arg]) for arg in union.exprs],
+                name_label=False,
+            )
+    return expr
+
+
+def plan_query(expr, eval_time: datetime.datetime = None):
+    """Pushes down as much of expr as possible and shares repeated subtrees;
+    see QueryPlanner and share_subexpressions"""
+    with trace("plan"):
+        expr = expand_metric_names(expr)
+        planner = QueryPlanner(eval_time)
+        planner.anchor(expr)
+        return share_subexpressions(planner.plan(expr))
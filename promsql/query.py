@@ -0,0 +1,774 @@
+"""Evaluation of range queries, every step at once"""
+
+import datetime
+import functools
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .clock import utc_now
+from .constants import DEFAULT_CONFIGS, DEFAULT_INTERVAL, TIME_COL, VAL_COL
+from .nodes import (
+    AggregateExpr,
+    BinaryExpression,
+    ExecutableExpr,
+    Function,
+    MatrixSelector,
+    MetricUnion,
+    SubqueryExpr,
+    UnaryExpr,
+    VectorSelector,
+)
+from .aggregations import aggregate
+from .binary_ops import binary_operation, is_scalar
+from .concurrency import run_fetches
+from .cost import QueryCost, estimate_fetch
+from . import limits
+from .limits import QueryBudget, QueryLimits
+from .parser import PromSqlParser
+from .results_cache import ResultsCache, results_cache
+from .range_functions import RANGE_FUNCTIONS, align_to_steps, evaluate_range_function
+from .rollups import (
+    ROLLUP_FUNCTIONS,
+    choose_range_resolution,
+    evaluate_rollup_function,
+    fetch_rollup_data,
+    get_resolutions,
+    rollup_series,
+)
+from .series import SeriesSet
+from . import tracing
+from .planner import (
+    SHAREABLE_EXPRS,
+    SharedExpr,
+    estimate_plan,
+    expand_metric_names,
+    find_selectors,
+    merge_windows,
+    plan_query,
+    prefetch,
+    replace_children,
+    selector_configs,
+    selector_key,
+    selector_source,
+    structural_key,
+)
+from .sql_miscs import fetch_metric_data
+from .transformer import PromSqlTransformer
+
+# Prometheus refuses range queries with more steps than this
+MAX_RANGE_STEPS = 11000
+# range queries are split into sub-ranges of this many seconds, aligned to the
+# unix epoch, which are evaluated in parallel and cached (see evaluate_range)
+QUERY_SPLIT_DURATION = 24 * 60 * 60
+# threads evaluating the sub-ranges of range queries
+SPLIT_THREADS = 4
+
+
+def get_parser() -> PromSqlParser:
+    """Returns the parser shared by query_range"""
+    if not hasattr(get_parser, "parser"):
+        get_parser.parser = PromSqlParser()
+    return get_parser.parser
+
+
+def get_split_executor() -> ThreadPoolExecutor:
+    """Returns the thread pool on which the sub-ranges of range queries are
+    evaluated; their fetches run on the pool of concurrency"""
+    with get_split_executor.lock:
+        if get_split_executor.executor is None:
+            get_split_executor.executor = ThreadPoolExecutor(
+                max_workers=SPLIT_THREADS, thread_name_prefix="promsql-split"
+            )
+        return get_split_executor.executor
+
+
+get_split_executor.lock = threading.Lock()
+get_split_executor.executor = None
+
+
+def to_seconds(duration: Union[int, float, datetime.timedelta]) -> float:
+    if isinstance(duration, datetime.timedelta):
+        return duration.total_seconds()
+    return float(duration)
+
+
+def range_steps(
+    start: datetime.datetime, end: datetime.datetime, step: float
+) -> pd.DatetimeIndex:
+    """Returns the evaluation timestamps start, start + step, ... <= end
+
+    Raises:
+        ValueError: for a non-positive step, an end before the start, or more
+            than MAX_RANGE_STEPS steps
+    """
+    if step <= 0:
+        raise ValueError(
+            "zero or negative query resolution step widths are not accepted"
+        )
+    if end < start:
+        raise ValueError("end timestamp must not be before start time")
+    count = int((end - start).total_seconds() // step) + 1
+    if count > MAX_RANGE_STEPS:
+        raise ValueError(
+            f"exceeded maximum resolution of {MAX_RANGE_STEPS} points per "
+            "timeseries; try decreasing the query resolution (?step=XX)"
+        )
+    start = pd.Timestamp(start).as_unit("ns")
+    return pd.DatetimeIndex(
+        start.value + np.arange(count, dtype=np.int64) * int(round(step * 1e9))
+    )
+
+
+def split_steps(steps: pd.DatetimeIndex, duration: float) -> List[pd.DatetimeIndex]:
+    """Splits steps at the multiples of duration seconds since the unix epoch"""
+    buckets = steps.asi8 // int(round(duration * 1e9))
+    bounds = np.flatnonzero(np.diff(buckets)) + 1
+    starts, ends = np.r_[0, bounds], np.r_[bounds, len(steps)]
+    return [steps[start:end] for start, end in zip(starts, ends)]
+
+
+def range_seconds(matrix: MatrixSelector) -> float:
+    time_range = matrix.range
+    if time_range.duration is not None:
+        return float(time_range.duration)
+    return (time_range.end_time - time_range.start_time).total_seconds()
+
+
+class RangeEvaluator:
+    """Evaluates a node tree at all the steps of a range query together
+
+    Evaluation takes two passes over the tree. The first one collects the
+    time windows every selector needs over all steps, including its offset,
+    the look behind duration of instant selectors and the range of range
+    selectors. Every distinct selector is then fetched once per group of
+    overlapping windows. The second pass evaluates the nodes on series sets
+    holding one sample per series and step, so the operators run once per
+    query rather than once per step.
+
+    Instant selectors return the latest sample within LOOK_BEHIND_DURATION
+    of each step, and range functions are evaluated over the windows ending
+    at every step. Subtrees which occur several times in the query, e.g. the
+    `rate(x[5m])` of `rate(x[5m]) / sum(rate(x[5m]))`, are evaluated once
+    over all the steps they are used at.
+
+    `*_over_time` functions read the buckets of the coarsest rollup table of
+    their metric whose resolution divides their range and the end of all
+    their windows, instead of the raw samples; see rollups.
+
+    Args:
+        steps (pd.DatetimeIndex): the evaluation timestamps
+    """
+
+    def __init__(self, steps: pd.DatetimeIndex):
+        self.steps = steps
+        self.windows = dict()
+        self.series = dict()
+        # steps each shareable subtree is evaluated at, by structural key
+        self.uses = Counter()
+        self.shared_steps = dict()
+        self.results = dict()
+        # rollup resolution of the range functions, by structural key, and
+        # the steps each of them is evaluated at
+        self.rollup_choice = dict()
+        self.rollup_uses = defaultdict(list)
+        self.rollup_windows = dict()
+        self.rollup_series = dict()
+
+    def run(self, expr) -> Union[SeriesSet, float, str]:
+        self.collect(expr, self.steps)
+        self.collect_rollups()
+        with tracing.trace("prefetch"):
+            self.fetch()
+        return self.evaluate(expr, self.steps)
+
+    def lookback(self, selector: VectorSelector) -> float:
+        return selector_configs(selector)["LOOK_BEHIND_DURATION"]
+
+    def add_window(
+        self, selector: VectorSelector, start: pd.Timestamp, end: pd.Timestamp
+    ):
+        offset = pd.Timedelta(seconds=selector.offset or 0)
+        key = selector_key(selector)
+        if key not in self.windows:
+            self.windows[key] = (selector, [])
+        self.windows[key][1].append((start - offset, end - offset, None))
+
+    def subquery_steps(
+        self, subquery: SubqueryExpr, steps: pd.DatetimeIndex
+    ) -> pd.DatetimeIndex:
+        """Returns the steps of a subquery, aligned to multiples of its step"""
+        matrix = subquery.matrix_selector
+        step = int(round((subquery.step or DEFAULT_INTERVAL) * 1e9))
+        offset = int(round((matrix.offset or 0) * 1e9))
+        first = steps[0].value - offset - int(round(range_seconds(matrix) * 1e9))
+        last = steps[-1].value - offset
+        first = -(-first // step) * step
+        return pd.DatetimeIndex(np.arange(first, last + 1, step, dtype=np.int64))
+
+    def collect(self, expr, steps: pd.DatetimeIndex):
+        """Records the windows the selectors of expr need and the steps its
+        subtrees are evaluated at"""
+        if isinstance(expr, SHAREABLE_EXPRS):
+            key = structural_key(expr)
+            if key is not None:
+                self.uses[key] += 1
+                known = self.shared_steps.get(key)
+                self.shared_steps[key] = steps if known is None else known.union(steps)
+        first, last = steps[0], steps[-1]
+        if isinstance(expr, VectorSelector):
+            lookback = pd.Timedelta(seconds=self.lookback(expr))
+            self.add_window(expr, first - lookback, last)
+        elif isinstance(expr, MatrixSelector):
+            if not isinstance(expr.expr, VectorSelector):
+                raise ValueError("ranges are only allowed for vector selectors")
+            length = pd.Timedelta(seconds=range_seconds(expr))
+            offset = pd.Timedelta(seconds=expr.offset or 0)
+            self.add_window(expr.expr, first - length - offset, last - offset)
+        elif isinstance(expr, SubqueryExpr):
+            steps = self.subquery_steps(expr, steps)
+            if len(steps):
+                self.collect(expr.matrix_selector.expr, steps)
+        elif isinstance(expr, AggregateExpr):
+            for arg in expr.function_call_body:
+                self.collect(arg, steps)
+        elif isinstance(expr, BinaryExpression):
+            self.collect(expr.left_expr, steps)
+            self.collect(expr.right_expr, steps)
+        elif isinstance(expr, Function):
+            args = expr.args[:-1] if self.collect_rollup(expr, steps) else expr.args
+            for arg in args:
+                self.collect(arg, steps)
+        elif isinstance(expr, UnaryExpr):
+            self.collect(expr.expr, steps)
+        elif isinstance(expr, MetricUnion):
+            for child in expr.exprs:
+                self.collect(child, steps)
+
+    def collect_rollup(self, expr: Function, steps: pd.DatetimeIndex) -> bool:
+        """Records a range function which may read from a rollup; its range
+        selector is collected by collect_rollups
+
+        A function which occurs several times only reads from a rollup if it
+        does at all its steps, since it is evaluated once for all of them.
+        """
+        if expr.name not in ROLLUP_FUNCTIONS or len(expr.args) != 1:
+            return False
+        matrix = expr.args[0]
+        if not isinstance(matrix, MatrixSelector) or not isinstance(
+            matrix.expr, VectorSelector
+        ):
+            return False
+        configs = selector_configs(matrix.expr)
+        if not get_resolutions(configs):
+            return False
+        offset = pd.Timedelta(seconds=(matrix.offset or 0) + (matrix.expr.offset or 0))
+        resolution = choose_range_resolution(
+            configs, range_seconds(matrix), (steps - offset).asi8
+        )
+        key = structural_key(expr)
+        if self.rollup_choice.get(key, resolution) != resolution:
+            resolution = None
+        self.rollup_choice[key] = resolution
+        self.rollup_uses[key].append((expr, steps))
+        return True
+
+    def collect_rollups(self):
+        """Records the windows of the range functions of collect_rollup, in
+        their rollup or in the raw samples"""
+        for key, uses in self.rollup_uses.items():
+            resolution = self.rollup_choice[key]
+            for expr, steps in uses:
+                matrix = expr.args[0]
+                if resolution is None:
+                    self.collect(matrix, steps)
+                    continue
+                length = pd.Timedelta(seconds=range_seconds(matrix))
+                offset = pd.Timedelta(
+                    seconds=(matrix.offset or 0) + (matrix.expr.offset or 0)
+                )
+                rollup_key = (selector_key(matrix.expr), resolution)
+                if rollup_key not in self.rollup_windows:
+                    self.rollup_windows[rollup_key] = (matrix.expr, [])
+                self.rollup_windows[rollup_key][1].append(
+                    (steps[0] - length - offset, steps[-1] - offset, None)
+                )
+
+    def planned_fetches(self) -> Iterator[Tuple]:
+        """Yields the fetches of the collected windows
+
+        Overlapping or adjacent windows of a selector are fetched together,
+        e.g. once for `x - x offset 5m` over more than 5 minutes of steps.
+
+        Yields:
+            Tuple: the key of the selector, or of the selector and the rollup
+                resolution, the selector, the start and end of the window and
+                the resolution, None for the raw samples
+        """
+        for key, (selector, windows) in self.windows.items():
+            for start, end, _ in merge_windows(windows):
+                yield key, selector, start, end, None
+        for key, (selector, windows) in self.rollup_windows.items():
+            for start, end, _ in merge_windows(windows):
+                yield key, selector, start, end, key[1]
+
+    def estimate(self) -> QueryCost:
+        """Estimates what the collected fetches read; see cost"""
+        cost = QueryCost()
+        for key, selector, start, end, resolution in self.planned_fetches():
+            cost.add(
+                estimate_fetch(
+                    selector_configs(selector),
+                    selector.label_matchers,
+                    start,
+                    end,
+                    key if resolution is None else key[0],
+                    resolution=resolution,
+                )
+            )
+        return cost
+
+    def fetch(self):
+        """Fetches the windows of all selectors concurrently; see
+        planned_fetches"""
+        keys, fetches = [], []
+        for key, selector, start, end, resolution in self.planned_fetches():
+            keys.append(key)
+            if resolution is None:
+                fetch = functools.partial(
+                    fetch_metric_data,
+                    selector.name,
+                    selector.label_matchers,
+                    start_datetime=start.to_pydatetime(),
+                    end_datetime=end.to_pydatetime(),
+                )
+            else:
+                fetch = functools.partial(
+                    fetch_rollup_data,
+                    selector.name,
+                    selector.label_matchers,
+                    start.to_pydatetime(),
+                    end.to_pydatetime(),
+                    resolution,
+                )
+            fetches.append((selector_configs(selector), fetch))
+        results = run_fetches(fetches) if fetches else []
+        frames = defaultdict(list)
+        for key, df in zip(keys, results):
+            frames[key].append(df)
+        for key, dfs in frames.items():
+            df = dfs[0] if len(dfs) == 1 else pd.concat(dfs, ignore_index=True)
+            if key in self.rollup_windows:
+                self.rollup_series[key] = rollup_series(df)
+            else:
+                self.series[key] = SeriesSet.from_frame(df)
+
+    def evaluate(self, expr, steps: pd.DatetimeIndex) -> Union[SeriesSet, float, str]:
+        if not isinstance(expr, ExecutableExpr) or not tracing.is_enabled():
+            return self.evaluate_shared(expr, steps)
+        with tracing.trace(tracing.describe_node(expr), steps=len(steps)) as span:
+            result = self.evaluate_shared(expr, steps)
+            span.record_result(result)
+            return result
+
+    def evaluate_shared(
+        self, expr, steps: pd.DatetimeIndex
+    ) -> Union[SeriesSet, float, str]:
+        key = structural_key(expr) if isinstance(expr, SHAREABLE_EXPRS) else None
+        if key is None or self.uses[key] < 2:
+            return self.evaluate_node(expr, steps)
+        if key not in self.results:
+            self.results[key] = self.evaluate_node(expr, self.shared_steps[key])
+        result = self.results[key]
+        if not isinstance(result, SeriesSet) or len(steps) == len(
+            self.shared_steps[key]
+        ):
+            return result
+        return result.filter(np.isin(result.times, steps.asi8))
+
+    def evaluate_node(
+        self, expr, steps: pd.DatetimeIndex
+    ) -> Union[SeriesSet, float, str]:
+        if not isinstance(expr, ExecutableExpr):
+            return expr
+        if isinstance(expr, VectorSelector):
+            return align_to_steps(
+                self.series[selector_key(expr)],
+                steps - pd.Timedelta(seconds=expr.offset or 0),
+                self.lookback(expr),
+                output_times=steps,
+            )
+        if isinstance(expr, (MatrixSelector, SubqueryExpr)):
+            raise ValueError(
+                "invalid expression type range vector for range query, "
+                "must be scalar or instant vector"
+            )
+        if isinstance(expr, Function):
+            return self.evaluate_function(expr, steps)
+        if isinstance(expr, AggregateExpr):
+            args = [self.evaluate(arg, steps) for arg in expr.function_call_body]
+            modifier = expr.aggregate_modifier
+            return aggregate(
+                expr.aggregate_op,
+                args[-1],
+                grouping=modifier.grouping if modifier else None,
+                without=bool(modifier.without) if modifier else False,
+                param=args[0] if len(args) > 1 else None,
+                steps=steps.asi8,
+            )
+        if isinstance(expr, BinaryExpression):
+            return binary_operation(
+                expr.op,
+                self.evaluate(expr.left_expr, steps),
+                self.evaluate(expr.right_expr, steps),
+                expr.bin_modifier,
+            )
+        if isinstance(expr, UnaryExpr):
+            value = self.evaluate(expr.expr, steps)
+            if str(expr.op) != "-":
+                return value
+            if isinstance(value, SeriesSet):
+                return value.with_values(-value.values)
+            return -value
+        if isinstance(expr, MetricUnion):
+            return expr.combine([self.evaluate(child, steps) for child in expr.exprs])
+        raise NotImplementedError(f"{expr} cannot be evaluated in a range query")
+
+    def evaluate_function(self, expr: Function, steps: pd.DatetimeIndex) -> SeriesSet:
+        if expr.name not in RANGE_FUNCTIONS:
+            raise NotImplementedError(f"Function {expr.name} is not implemented!")
+        matrix = expr.args[-1]
+        param = self.evaluate(expr.args[0], steps) if len(expr.args) > 1 else None
+        if isinstance(matrix, SubqueryExpr):
+            selector = matrix.matrix_selector
+            offset = selector.offset or 0
+            series = self.evaluate(selector.expr, self.subquery_steps(matrix, steps))
+        elif isinstance(matrix, MatrixSelector):
+            selector = matrix
+            offset = (matrix.offset or 0) + (matrix.expr.offset or 0)
+            resolution = self.rollup_choice.get(structural_key(expr))
+            if resolution is not None:
+                return evaluate_rollup_function(
+                    expr.name,
+                    self.rollup_series[(selector_key(matrix.expr), resolution)],
+                    steps - pd.Timedelta(seconds=offset),
+                    range_seconds(matrix),
+                    output_times=steps,
+                )
+            series = self.series[selector_key(matrix.expr)]
+        else:
+            raise ValueError(f"Function {expr.name} expects a range vector")
+        if not isinstance(series, SeriesSet):
+            raise ValueError(f"Function {expr.name} expects a range vector")
+        return evaluate_range_function(
+            expr.name,
+            series,
+            steps - pd.Timedelta(seconds=offset),
+            range_seconds(selector),
+            param=param,
+            output_times=steps,
+        )
+
+
+def start_budget(
+    query_limits: Optional[QueryLimits], estimate: Callable[[], QueryCost]
+) -> Optional[QueryBudget]:
+    """Returns the budget a query runs with, None if it has no limits
+
+    Args:
+        query_limits (QueryLimits, optional): the limits of the query; None
+            for the ones of DEFAULT_CONFIGS
+        estimate (Callable[[], QueryCost]): estimates what the query reads
+
+    Raises:
+        QueryLimitExceeded: when the estimate is over a limit
+    """
+    if query_limits is None:
+        query_limits = QueryLimits.from_configs(DEFAULT_CONFIGS)
+    if not query_limits:
+        return None
+    with tracing.trace("estimate"):
+        cost = estimate()
+        tracing.record(samples=cost.samples, series=cost.series, bytes=cost.bytes)
+    budget = QueryBudget(query_limits, cost)
+    budget.check_estimate()
+    return budget
+
+
+def evaluate_range(
+    expr,
+    steps: pd.DatetimeIndex,
+    split_duration: Optional[float] = QUERY_SPLIT_DURATION,
+    cache: Optional[ResultsCache] = results_cache,
+    query_limits: QueryLimits = None,
+) -> Union[SeriesSet, float, str]:
+    """Evaluates the node tree of a range query, one sub-range at a time
+
+    The steps are split at the multiples of split_duration seconds (days by
+    default) and the sub-ranges are evaluated in parallel by RangeEvaluator.
+    The result of each sub-range is cached under the structure of the query,
+    the databases, tables and configs its selectors read (see
+    selector_source), the step and the first and last steps of the
+    sub-range, so refreshing a dashboard only evaluates the sub-ranges which
+    are not cached: the most recent one, which has new steps, and the oldest
+    one if the start moved.
+    The steps stay the same from one refresh to the next only if the start
+    is a multiple of the step.
+
+    With limits, the fetches of the sub-ranges which are not cached are
+    estimated first and all of them are counted against the same budget;
+    see limits.
+
+    Args:
+        expr: the node tree of the query
+        steps (pd.DatetimeIndex): the evaluation timestamps
+        split_duration (float, optional): length of the sub-ranges in
+            seconds; None evaluates all steps together. Defaults to
+            QUERY_SPLIT_DURATION.
+        cache (ResultsCache, optional): where sub-range results are kept;
+            None disables caching. Defaults to results_cache.
+        query_limits (QueryLimits, optional): the most the query may read.
+            Defaults to the limits of DEFAULT_CONFIGS.
+
+    Raises:
+        QueryLimitExceeded: when the query is estimated to read, or reads,
+            more than its limits
+
+    Returns:
+        Union[SeriesSet, float, str]: the result over all steps
+    """
+    expr = expand_metric_names(expr)
+    key = structural_key(expr) if cache is not None else None
+    if key is not None:
+        sources = dict.fromkeys(map(selector_source, find_selectors(expr)))
+        key = (key, tuple(sources))
+    step = int(steps[1].value - steps[0].value) if len(steps) > 1 else 0
+    parts = split_steps(steps, split_duration) if split_duration else [steps]
+    part_keys = [
+        None if key is None else (key, step, part[0].value, part[-1].value)
+        for part in parts
+    ]
+    cached = [
+        None if part_key is None else cache.get(part_key) for part_key in part_keys
+    ]
+
+    def estimate() -> QueryCost:
+        cost = QueryCost()
+        for part, result in zip(parts, cached):
+            if result is None:
+                evaluator = RangeEvaluator(part)
+                evaluator.collect(expr, part)
+                evaluator.collect_rollups()
+                cost.extend(evaluator.estimate())
+        return cost
+
+    budget = None
+    if any(result is None for result in cached):
+        budget = start_budget(query_limits, estimate)
+
+    def run(part: pd.DatetimeIndex, part_key, result):
+        with tracing.trace("sub-range", start=str(part[0]), steps=len(part)):
+            if part_key is not None:
+                tracing.record(cached=result is not None)
+                if result is not None:
+                    return result
+            result = RangeEvaluator(part).run(expr)
+            if part_key is not None:
+                cache.put(part_key, result, part[-1].to_pydatetime())
+            return result
+
+    with limits.enforce(budget):
+        if len(parts) == 1:
+            results = [run(parts[0], part_keys[0], cached[0])]
+        else:
+            # the sub-ranges are traced in the span of the caller
+            futures = [
+                get_split_executor().submit(
+                    limits.propagate(
+                        tracing.propagate(functools.partial(run, *arguments))
+                    )
+                )
+                for arguments in zip(parts, part_keys, cached)
+            ]
+            results = [future.result() for future in futures]
+    if isinstance(results[0], SeriesSet):
+        return SeriesSet.concat(results)
+    return results[0]
+
+
+def parse_query(text: str, parser: PromSqlParser = None):
+    """Parses a query into its node tree without evaluating it"""
+    parser = parser or get_parser()
+    return PromSqlTransformer(evaluate=False).transform(parser.parse(text))
+
+
+def find_subqueries(expr, time: datetime.datetime) -> List[Tuple]:
+    """Lists the subqueries of a planned instant query, with their steps
+    when the query is evaluated at time
+
+    The expression of a subquery is evaluated at every step of the subquery,
+    like a range query; see evaluate_subqueries. A selector takes the latest
+    raw sample of each series within its lookback at each step, never the
+    average of a bucket. Subqueries within the expression are evaluated by
+    the RangeEvaluator of the outermost one.
+
+    Returns:
+        List[Tuple]: the SubqueryExpr and its steps, for each subquery
+    """
+    subqueries = dict()
+
+    def visit(node):
+        if isinstance(node, SharedExpr):
+            visit(node.expr)
+        elif isinstance(node, SubqueryExpr):
+            times = pd.DatetimeIndex([time])
+            steps = RangeEvaluator(times).subquery_steps(node, times)
+            subqueries[id(node)] = (node, steps)
+        else:
+            replace_children(node, visit)
+        return node
+
+    visit(expr)
+    return list(subqueries.values())
+
+
+def estimate_subqueries(subqueries: List[Tuple]) -> QueryCost:
+    """Estimates what the subqueries of find_subqueries read"""
+    cost = QueryCost()
+    for subquery, steps in subqueries:
+        if len(steps):
+            evaluator = RangeEvaluator(steps)
+            evaluator.collect(subquery.matrix_selector.expr, steps)
+            evaluator.collect_rollups()
+            cost.extend(evaluator.estimate())
+    return cost
+
+
+def evaluate_subqueries(subqueries: List[Tuple]):
+    """Evaluates the expressions of the subqueries of find_subqueries at all
+    their steps, and hands the results to the subqueries
+
+    Raises:
+        ValueError: for expressions which are not instant vectors
+    """
+    for subquery, steps in subqueries:
+        result = SeriesSet.empty()
+        if len(steps):
+            result = RangeEvaluator(steps).run(subquery.matrix_selector.expr)
+        if not isinstance(result, SeriesSet):
+            raise ValueError("subqueries are only allowed on instant vectors")
+        subquery.prefetched = result
+
+
+def evaluate_instant(
+    expr, time: datetime.datetime, query_limits: QueryLimits = None
+) -> Union[SeriesSet, float, str]:
+    """Evaluates the node tree of a query at time; see query
+
+    With limits, the planned fetches are estimated first and counted
+    against the budget of the query as they read; see limits.
+
+    Raises:
+        QueryLimitExceeded: when the query is estimated to read, or reads,
+            more than query_limits, by default the limits of DEFAULT_CONFIGS
+    """
+    if not isinstance(expr, ExecutableExpr):
+        return expr
+    expr = plan_query(expr, time)
+    if not isinstance(expr, ExecutableExpr):
+        return expr
+    subqueries = find_subqueries(expr, time)
+
+    def estimate() -> QueryCost:
+        cost = estimate_plan(expr)
+        cost.extend(estimate_subqueries(subqueries))
+        return cost
+
+    with limits.enforce(start_budget(query_limits, estimate)):
+        prefetch(expr)
+        evaluate_subqueries(subqueries)
+        return expr.eval()
+
+
+def query(
+    text: str,
+    time: datetime.datetime = None,
+    parser: PromSqlParser = None,
+    query_limits: QueryLimits = None,
+) -> Union[pd.DataFrame, float, str]:
+    """Evaluates a query at a single time, like the `/api/v1/query` endpoint
+    of Prometheus
+
+    Args:
+        text (str): the PromQL query
+        time (datetime.datetime, optional): the evaluation timestamp.
+            Defaults to now, in UTC.
+        parser (PromSqlParser, optional): the parser to use. Defaults to one
+            shared by all calls.
+        query_limits (QueryLimits, optional): the most the query may read.
+            Defaults to the limits of DEFAULT_CONFIGS.
+
+    Raises:
+        QueryLimitExceeded: when the query is estimated to read, or reads,
+            more than its limits
+
+    Returns:
+        Union[pd.DataFrame, float, str]: one row per sample with a column per
+            label plus VAL_COL and TIME_COL, or the scalar or string the
+            query evaluates to
+    """
+    result = evaluate_instant(
+        parse_query(text, parser), time or utc_now(), query_limits
+    )
+    return result.to_frame() if isinstance(result, SeriesSet) else result
+
+
+def query_range(
+    text: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    step: Union[int, float, datetime.timedelta],
+    parser: PromSqlParser = None,
+    query_limits: QueryLimits = None,
+) -> pd.DataFrame:
+    """Evaluates a query at every step between start and end
+
+    The query is parsed once and split into day-aligned sub-ranges, which
+    are evaluated in parallel and cached; see evaluate_range. Within a
+    sub-range each selector is fetched once; see RangeEvaluator.
+
+    Args:
+        text (str): the PromQL query
+        start (datetime.datetime): the first evaluation timestamp
+        end (datetime.datetime): the last possible evaluation timestamp
+        step (Union[int, float, datetime.timedelta]): the step in seconds
+        parser (PromSqlParser, optional): the parser to use. Defaults to one
+            shared by all calls.
+        query_limits (QueryLimits, optional): the most the query may read.
+            Defaults to the limits of DEFAULT_CONFIGS.
+
+    Raises:
+        ValueError: for invalid ranges or queries which do not evaluate to an
+            instant vector or a scalar
+        QueryLimitExceeded: when the query is estimated to read, or reads,
+            more than its limits
+
+    Returns:
+        pd.DataFrame: one row per series and step, with a column per label
+            plus VAL_COL and TIME_COL (the step timestamp)
+    """
+    steps = range_steps(start, end, to_seconds(step))
+    result = evaluate_range(parse_query(text, parser), steps, query_limits=query_limits)
+    if isinstance(result, SeriesSet):
+        return result.to_frame()
+    if is_scalar(result):
+        # a scalar has the same value at every step
+        return pd.DataFrame({VAL_COL: float(result), TIME_COL: steps})
+    raise ValueError(
+        f"invalid expression type {type(result).__name__} for range query, "
+        "must be scalar or instant vector"
+    )
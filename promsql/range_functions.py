@@ -0,0 +1,392 @@
+"""Vectorized evaluation of PromQL range functions"""
+
+from typing import Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .series import SeriesSet
+
+# minimum number of samples in a window for each function to return a value
+RANGE_FUNCTIONS = {
+    "rate": 2,
+    "increase": 2,
+    "delta": 2,
+    "irate": 2,
+    "idelta": 2,
+    "deriv": 2,
+    "changes": 1,
+    "resets": 1,
+    "avg_over_time": 1,
+    "min_over_time": 1,
+    "max_over_time": 1,
+    "sum_over_time": 1,
+    "count_over_time": 1,
+    "last_over_time": 1,
+    "present_over_time": 1,
+    "stddev_over_time": 1,
+    "stdvar_over_time": 1,
+    "quantile_over_time": 1,
+}
+
+# keys of two series are kept this far apart, see locate_windows
+MAX_KEY = 2**62
+
+
+def to_milliseconds(times) -> np.ndarray:
+    """Converts timestamps to int64 milliseconds since the epoch (UTC)"""
+    return pd.DatetimeIndex(times).as_unit("ms").asi8
+
+
+def prefix_sum(values: np.ndarray) -> np.ndarray:
+    return np.concatenate(([0], np.cumsum(values)))
+
+
+def locate_windows(
+    codes: np.ndarray,
+    times: np.ndarray,
+    n_series: int,
+    steps: np.ndarray,
+    range_ms: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the samples of every (series, step) window
+
+    The samples must be sorted by series code and time. Each series is
+    shifted onto its own stretch of a single int64 axis, far enough from the
+    next one that no window can reach into it, so that all windows of all
+    series are located with two searchsorted calls. Windows are left-open,
+    (step - range, step], as in Prometheus.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the start (inclusive) and end
+            (exclusive) positions of each window, series x step
+    """
+    origin = min(times.min() if len(times) else steps.min(), steps.min() - range_ms)
+    span = max(times.max() if len(times) else steps.max(), steps.max()) - origin
+    stride = span + range_ms + 1
+    keys = codes * stride + (times - origin)
+    ends = np.arange(n_series)[:, None] * stride + (steps - origin)[None, :]
+    hi = np.searchsorted(keys, ends, side="right")
+    lo = np.searchsorted(keys, ends - range_ms, side="right")
+    return lo, hi
+
+
+def window_pairs(
+    values: np.ndarray, codes: np.ndarray, lo: np.ndarray, hi: np.ndarray, kind: str
+) -> np.ndarray:
+    """Sums a property of consecutive sample pairs over each window
+
+    Args:
+        kind (str): "resets" counts the decreases, "changes" the changes and
+            "correction" sums the values before each counter reset
+
+    Returns:
+        np.ndarray: the sums, series x step
+    """
+    previous = np.concatenate(([np.nan], values[:-1]))
+    same_series = np.concatenate(([False], codes[1:] == codes[:-1]))
+    if kind == "resets":
+        pairs = same_series & (values < previous)
+    elif kind == "changes":
+        both_nan = np.isnan(values) & np.isnan(previous)
+        pairs = same_series & (values != previous) & ~both_nan
+    else:
+        pairs = np.where(same_series & (values < previous), previous, 0.0)
+    sums = prefix_sum(pairs.astype(np.float64))
+    # the pairs of a window end at the samples lo + 1 .. hi - 1
+    return sums[np.maximum(hi, lo + 1)] - sums[lo + 1]
+
+
+def sparse_table_reduce(
+    ufunc: np.ufunc, values: np.ndarray, lo: np.ndarray, hi: np.ndarray
+) -> np.ndarray:
+    """Reduces the non-empty windows [lo, hi) with an idempotent ufunc
+
+    Builds a sparse table of the reductions over power of two spans, so
+    every window is answered by combining two overlapping spans.
+    """
+    lengths = hi - lo
+    levels = [values]
+    while 2 ** len(levels) <= lengths.max(initial=1):
+        half = 2 ** (len(levels) - 1)
+        levels.append(ufunc(levels[-1][:-half], levels[-1][half:]))
+    exponents = np.frexp(lengths)[1] - 1
+    result = np.empty(len(lo))
+    for exponent in np.unique(exponents):
+        selected = exponents == exponent
+        level = levels[exponent]
+        result[selected] = ufunc(level[lo[selected]], level[hi[selected] - 2**exponent])
+    return result
+
+
+def extrapolated_rate(
+    times: np.ndarray,
+    values: np.ndarray,
+    codes: np.ndarray,
+    lo: np.ndarray,
+    hi: np.ndarray,
+    steps: np.ndarray,
+    range_ms: int,
+    is_counter: bool,
+    is_rate: bool,
+) -> np.ndarray:
+    """Computes delta, increase and rate like Prometheus' extrapolatedRate"""
+    first, last = lo, hi - 1
+    count = hi - lo
+    result = values[last] - values[first]
+    if is_counter:
+        result = result + window_pairs(values, codes, lo, hi, "correction")
+    duration_to_start = (times[first] - (steps - range_ms)) / 1000
+    duration_to_end = (steps - times[last]) / 1000
+    sampled_interval = (times[last] - times[first]) / 1000
+    average_interval = sampled_interval / (count - 1)
+    if is_counter:
+        zero_reached = (result > 0) & (values[first] >= 0)
+        duration_to_zero = sampled_interval * (values[first] / result)
+        duration_to_start = np.where(
+            zero_reached & (duration_to_zero < duration_to_start),
+            duration_to_zero,
+            duration_to_start,
+        )
+    threshold = average_interval * 1.1
+    extrapolate_to = (
+        sampled_interval
+        + np.where(
+            duration_to_start < threshold, duration_to_start, average_interval / 2
+        )
+        + np.where(duration_to_end < threshold, duration_to_end, average_interval / 2)
+    )
+    result = result * (extrapolate_to / sampled_interval)
+    if is_rate:
+        result = result / (range_ms / 1000)
+    return result
+
+
+def compute_range_function(
+    name: str,
+    codes: np.ndarray,
+    times: np.ndarray,
+    values: np.ndarray,
+    n_series: int,
+    steps: np.ndarray,
+    range_ms: int,
+    param=None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Evaluates a range function for every series at every step
+
+    Sums, averages and counts come from prefix sums and counter resets from a
+    prefix sum over sample pairs, so their cost grows with the number of
+    samples plus the number of windows rather than with the samples of every
+    window. Min and max come from a sparse table, which adds a factor of the
+    logarithm of the window length.
+
+    Args:
+        name (str): one of RANGE_FUNCTIONS
+        codes (np.ndarray): the series code of each sample
+        times (np.ndarray): int64 millisecond timestamps, sorted by series
+            and time
+        values (np.ndarray): float64 values
+        n_series (int): the number of series
+        steps (np.ndarray): int64 millisecond evaluation timestamps
+        range_ms (int): the length of the windows
+        param (optional): the parameter of quantile_over_time
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the results and whether each one is
+            defined, series x step
+    """
+    lo, hi = locate_windows(codes, times, n_series, steps, range_ms)
+    count = hi - lo
+    valid = count >= RANGE_FUNCTIONS[name]
+    lo, hi, count = lo[valid], hi[valid], count[valid]
+    step_of = np.broadcast_to(steps, valid.shape)[valid]
+    result = np.full(valid.shape, np.nan)
+
+    with np.errstate(all="ignore"):
+        if name == "count_over_time":
+            reduced = count.astype(np.float64)
+        elif name == "present_over_time":
+            reduced = np.ones(len(lo))
+        elif name == "last_over_time":
+            reduced = values[hi - 1]
+        elif name in ("sum_over_time", "avg_over_time"):
+            sums = prefix_sum(values)
+            reduced = sums[hi] - sums[lo]
+            if name == "avg_over_time":
+                reduced = reduced / count
+        elif name in ("stddev_over_time", "stdvar_over_time"):
+            # shifting each series by its first value keeps the squares small
+            starts = np.searchsorted(codes, codes, side="left")
+            shifted = values - values[starts]
+            sums = prefix_sum(shifted)
+            squares = prefix_sum(shifted**2)
+            mean = (sums[hi] - sums[lo]) / count
+            reduced = np.maximum((squares[hi] - squares[lo]) / count - mean**2, 0)
+            if name == "stddev_over_time":
+                reduced = np.sqrt(reduced)
+        elif name == "min_over_time":
+            reduced = sparse_table_reduce(np.fmin, values, lo, hi)
+        elif name == "max_over_time":
+            reduced = sparse_table_reduce(np.fmax, values, lo, hi)
+        elif name == "quantile_over_time":
+            phi = float(param)
+            reduced = np.array(
+                [
+                    np.quantile(values[start:end], min(max(phi, 0.0), 1.0))
+                    for start, end in zip(lo, hi)
+                ]
+            )
+            if phi < 0 or phi > 1:
+                reduced[:] = -np.inf if phi < 0 else np.inf
+        elif name in ("changes", "resets"):
+            reduced = window_pairs(values, codes, lo, hi, name)
+        elif name in ("irate", "idelta"):
+            previous, last = values[hi - 2], values[hi - 1]
+            reduced = last - previous
+            if name == "irate":
+                reduced = np.where(last < previous, last, reduced)
+                reduced = reduced / ((times[hi - 1] - times[hi - 2]) / 1000)
+        elif name == "deriv":
+            # shifting each series by its first sample keeps the sums of
+            # squares small, as epoch seconds would lose the slope to
+            # cancellation
+            starts = np.searchsorted(codes, codes, side="left")
+            seconds = (times - times[starts]) / 1000
+            shifted = values - values[starts]
+            sx, sy = prefix_sum(seconds), prefix_sum(shifted)
+            sxx, sxy = prefix_sum(seconds**2), prefix_sum(seconds * shifted)
+            x, y = sx[hi] - sx[lo], sy[hi] - sy[lo]
+            xx, xy = sxx[hi] - sxx[lo], sxy[hi] - sxy[lo]
+            reduced = (count * xy - x * y) / (count * xx - x * x)
+        else:
+            reduced = extrapolated_rate(
+                times,
+                values,
+                codes,
+                lo,
+                hi,
+                step_of,
+                range_ms,
+                is_counter=name in ("rate", "increase"),
+                is_rate=name == "rate",
+            )
+    result[valid] = reduced
+    return result, valid
+
+
+def evaluate_range_function(
+    name: str,
+    matrix: SeriesSet,
+    step_times: Sequence,
+    range_seconds: float,
+    param=None,
+    output_times: Sequence = None,
+) -> SeriesSet:
+    """Evaluates a range function over a range vector
+
+    Args:
+        name (str): one of RANGE_FUNCTIONS
+        matrix (SeriesSet): the samples of the range vector
+        step_times (Sequence): the timestamps at which windows end
+        range_seconds (float): the length of the windows
+        param (optional): the parameter of quantile_over_time
+        output_times (Sequence, optional): the timestamps of the results, one
+            per step. Defaults to step_times.
+
+    Returns:
+        SeriesSet: the instant vector of each step
+    """
+    output_times = pd.DatetimeIndex(
+        output_times if output_times is not None else step_times
+    ).as_unit("ns")
+    if len(matrix) == 0:
+        return SeriesSet.empty()
+    # the samples of a series set are already sorted by series and time
+    codes = matrix.sample_series()
+    times = matrix.times // 1_000_000
+    values = matrix.values
+    n_series = len(matrix)
+    first = matrix.offsets
+
+    steps = to_milliseconds(step_times)
+    range_ms = int(round(range_seconds * 1000))
+    # series are evaluated in batches whose keys fit into an int64
+    span = max(times.max(), steps.max()) - min(times.min(), steps.min() - range_ms)
+    batch = max(1, MAX_KEY // (span + range_ms + 1))
+    results, valids = [], []
+    for start in range(0, n_series, batch):
+        end = min(start + batch, n_series)
+        rows = slice(first[start], first[end])
+        result, valid = compute_range_function(
+            name,
+            codes[rows] - start,
+            times[rows],
+            values[rows],
+            end - start,
+            steps,
+            range_ms,
+            param,
+        )
+        results.append(result)
+        valids.append(valid)
+    return SeriesSet.from_matrix(
+        matrix.labels,
+        output_times.asi8,
+        np.concatenate(results),
+        np.concatenate(valids),
+    )
+
+
+def align_to_steps(
+    matrix: SeriesSet,
+    step_times: Sequence,
+    lookback_seconds: float,
+    output_times: Sequence = None,
+) -> SeriesSet:
+    """Takes the latest sample of each series at or before every step, as
+    PromQL evaluates an instant selector, if it is less than lookback_seconds
+    older than the step
+
+    Each sample is assigned to the first step at or after it with a single
+    searchsorted call over the steps. The last sample of each series and
+    step is written into a series x step matrix of sample positions, which a
+    running maximum along the steps carries forward to the steps without
+    samples, so the cost grows with the number of samples plus the size of
+    the result. Nothing is interpolated: a step whose latest sample is stale
+    has no value.
+
+    Args:
+        matrix (SeriesSet): the samples
+        step_times (Sequence): the sorted timestamps of the steps
+        lookback_seconds (float): how old the latest sample may be
+        output_times (Sequence, optional): the timestamps of the results, one
+            per step. Defaults to step_times.
+
+    Returns:
+        SeriesSet: the samples of the series at the steps
+    """
+    output_times = pd.DatetimeIndex(
+        output_times if output_times is not None else step_times
+    ).as_unit("ns")
+    steps = pd.DatetimeIndex(step_times).as_unit("ns").asi8
+    if len(matrix) == 0 or len(steps) == 0:
+        return SeriesSet.empty()
+    codes = matrix.sample_series()
+    bins = np.searchsorted(steps, matrix.times, side="left")
+    # the last sample of each series before each step, the samples after
+    # the last step aside
+    last = np.concatenate(
+        ((codes[1:] != codes[:-1]) | (bins[1:] != bins[:-1]), [True])
+    ) & (bins < len(steps))
+    positions = np.full((len(matrix), len(steps)), -1, dtype=np.int64)
+    positions[codes[last], bins[last]] = np.flatnonzero(last)
+    # the positions of the samples of a series grow with their time
+    np.maximum.accumulate(positions, axis=1, out=positions)
+    found = positions >= 0
+    lookback = int(round(lookback_seconds * 1e9))
+    found[found] = matrix.times[positions[found]] > (
+        np.broadcast_to(steps, found.shape)[found] - lookback
+    )
+    values = np.full(positions.shape, np.nan)
+    values[found] = matrix.values[positions[found]]
+    return SeriesSet.from_matrix(matrix.labels, output_times.asi8, values, found)
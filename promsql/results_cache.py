@@ -0,0 +1,236 @@
+"""Caches the results of the sub-ranges of range queries"""
+
+import datetime
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from promsql.clock import utc_now
+from promsql.series import SeriesSet
+
+# memory budget of the module level results_cache
+RESULTS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# results whose last step is less than this many seconds old are recent:
+# samples may still arrive for them, so they are only kept for
+# RESULTS_CACHE_TTL seconds
+RESULTS_CACHE_RECENT_DURATION = 10 * 60
+RESULTS_CACHE_TTL = 60
+# bytes of results kept in the on-disk store, if any
+RESULTS_CACHE_MAX_DISK_BYTES = 1024 * 1024 * 1024
+
+
+def result_size(result) -> int:
+    if isinstance(result, SeriesSet):
+        return sum(result.memory_usage().values())
+    return 64
+
+
+class ResultsCache:
+    """LRU cache of query results with a memory budget and an optional
+    on-disk store
+
+    Results are stored with the time of their last step. The results of
+    steps in the future are never stored, as the steps are not complete yet.
+    Recent results, whose last step is less than `recent_duration` seconds
+    old, expire `ttl` seconds after they were stored; older results are kept
+    until they are evicted.
+
+    When `directory` is set, results are also written there, one pickle file
+    per key, so they survive the process. Expired files are removed when they
+    are read, and the least recently used files are removed once the
+    directory holds more than `max_disk_bytes`.
+
+    Args:
+        max_bytes (int, optional): memory budget. Defaults to
+            RESULTS_CACHE_MAX_BYTES.
+        directory (str, optional): where to store results on disk. Defaults
+            to None, results are only kept in memory.
+        ttl (float, optional): seconds recent results are kept. Defaults to
+            RESULTS_CACHE_TTL.
+        recent_duration (float, optional): age in seconds below which a
+            result is recent. Defaults to RESULTS_CACHE_RECENT_DURATION.
+        max_disk_bytes (int, optional): budget of the on-disk store. Defaults
+            to RESULTS_CACHE_MAX_DISK_BYTES.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = RESULTS_CACHE_MAX_BYTES,
+        directory: Optional[str] = None,
+        ttl: float = RESULTS_CACHE_TTL,
+        recent_duration: float = RESULTS_CACHE_RECENT_DURATION,
+        max_disk_bytes: int = RESULTS_CACHE_MAX_DISK_BYTES,
+    ):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.ttl = ttl
+        self.recent_duration = recent_duration
+        self.max_disk_bytes = max_disk_bytes
+        self.current_bytes = 0
+        # bytes of the files of the directory, None until it is listed
+        self.disk_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable):
+        """Returns the result stored for key, or None"""
+        now = utc_now()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= now:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        entry = self._read(key, now)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._store(key, *entry)
+        return entry[0]
+
+    def put(self, key: Hashable, result, last_step: datetime.datetime):
+        """Stores the result of steps up to last_step, unless some are in the
+        future"""
+        now = utc_now()
+        if last_step > now:
+            return
+        expires = None
+        if last_step > now - datetime.timedelta(seconds=self.recent_duration):
+            expires = now + datetime.timedelta(seconds=self.ttl)
+        with self._lock:
+            self._store(key, result, expires)
+        self._write(key, result, expires)
+
+    def _store(self, key: Hashable, result, expires: Optional[datetime.datetime]):
+        self._remove(key)
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (result, expires, size)
+        self.current_bytes += size
+        self._evict()
+
+    def _remove(self, key: Hashable):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.current_bytes -= previous[2]
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def _path(self, key: Hashable) -> str:
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.pickle")
+
+    def _read(self, key: Hashable, now: datetime.datetime):
+        """Returns the result and expiry stored on disk for key, removing the
+        file if it expired"""
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                stored_key, result, expires = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        # keys are compared in case of a collision of their digests
+        if stored_key != key:
+            return None
+        expired = expires is not None and expires <= now
+        try:
+            if expired:
+                os.remove(path)
+            else:
+                # the least recently read files are removed first, see _prune
+                os.utime(path)
+        except OSError:
+            pass
+        return None if expired else (result, expires)
+
+    def _write(self, key: Hashable, result, expires: Optional[datetime.datetime]):
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # written to a temporary file first so readers never see half a file
+            fd, path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((key, result, expires), f, pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(path)
+            os.replace(path, self._path(key))
+        except OSError:
+            # the on-disk store is best effort, results are still in memory
+            return
+        with self._lock:
+            if self.disk_bytes is not None:
+                self.disk_bytes += size
+            full = self.disk_bytes is None or self.disk_bytes > self.max_disk_bytes
+        if full:
+            self._prune()
+
+    def _prune(self):
+        """Lists the files of the directory and removes the least recently
+        used ones until they fit in max_disk_bytes"""
+        files = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".pickle"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self.disk_bytes = total
+
+    def set_max_bytes(self, max_bytes: int):
+        """Changes the memory budget, evicting results if needed"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Drops the results kept in memory; the on-disk store is kept"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict:
+        """Returns the hit, miss and eviction counters and the memory usage"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "results": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+results_cache = ResultsCache()
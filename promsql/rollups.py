@@ -0,0 +1,577 @@
+"""Pre-aggregated rollup tables, read instead of the raw samples of long ranges
+
+With ROLLUP_RESOLUTIONS set, e.g. to [60, 300, 3600], every metric table gets
+one rollup table per resolution (see ROLLUP_TABLE_FORMAT), with a row per
+series and bucket: the tag columns, the end of the bucket as timestamp and the
+sum, count, minimum, maximum and last value of the samples. Buckets are
+right-closed, (end - resolution, end], like the windows of range functions,
+so a window whose bounds are multiples of the resolution is exactly the union
+of its buckets.
+
+The tables are built by update_rollups, incrementally: each run only reads
+the samples after the last bucket of the table, up to the last bucket which
+is complete, and each resolution is built from the finer one it is a
+multiple of. Run it periodically, e.g. with the `--rollup-interval` option of
+the server.
+
+Range queries read a rollup for `sum/count/min/max/avg/last_over_time` when
+the range and every step (minus the offset) are multiples of its resolution;
+the coarsest such rollup is taken. Instant queries push these functions down
+as the rollup buckets inside the range plus the raw samples at its edges.
+Samples after the last bucket of a rollup are always read from the raw table.
+
+The results are the same as from the raw samples, except that:
+
+- sums and averages may differ by floating point rounding, as the samples
+  are added in another order
+- NaN samples are left out of the buckets
+- samples which arrive after the rollup has been built past their timestamp
+  are never added to it; rollups assume samples arrive in time order
+"""
+
+import datetime
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from .catalog import schema_catalog
+from .constants import ROLLUP_TABLE_FORMAT, TIME_COL, VAL_COL
+from .limits import current_budget
+from .range_functions import evaluate_range_function
+from .series import SeriesSet
+from .sql_miscs import (
+    fetch_metric_data,
+    get_metric_configs,
+    get_tag_columns,
+    get_where_clauses,
+    metric_catalog,
+)
+from .tracing import record, traced_fetch
+
+# the columns of the aggregations of a bucket
+ROLLUP_COLUMNS = {
+    "sum": "value_sum",
+    "count": "value_count",
+    "min": "value_min",
+    "max": "value_max",
+    "last": "value_last",
+}
+
+# range functions which can be answered from rollups
+ROLLUP_FUNCTIONS = (
+    "sum_over_time",
+    "count_over_time",
+    "min_over_time",
+    "max_over_time",
+    "avg_over_time",
+    "last_over_time",
+)
+
+# seconds of samples read at a time by update_rollups
+ROLLUP_BUILD_CHUNK = 24 * 60 * 60
+
+# instant queries only read a rollup whose buckets fit this many times in the
+# range, so that the raw samples at its edges stay a small part of it
+ROLLUP_MIN_BUCKETS = 10
+
+NS_PER_SECOND = 1_000_000_000
+
+
+def get_resolutions(configs: Dict) -> List[int]:
+    """Returns the rollup resolutions of a metric in seconds, finest first"""
+    return sorted(int(resolution) for resolution in configs["ROLLUP_RESOLUTIONS"] or ())
+
+
+def get_rollup_table_name(configs: Dict, resolution: int) -> str:
+    return ROLLUP_TABLE_FORMAT.format(
+        table_name=configs["TABLE_NAME"], resolution=resolution
+    )
+
+
+def get_rollup_configs(configs: Dict, resolution: int) -> Dict:
+    """Returns the configs of a metric pointing at one of its rollup tables"""
+    configs = dict(configs)
+    configs["TABLE_NAME"] = get_rollup_table_name(configs, resolution)
+    return configs
+
+
+def get_rollup_table(
+    configs: Dict, resolution: int, tag_columns: List[str]
+) -> sqlalchemy.sql.expression.TableClause:
+    """Describes a rollup table as an sqlalchemy core table"""
+    return sqlalchemy.table(
+        get_rollup_table_name(configs, resolution),
+        sqlalchemy.column(configs["TIMESTAMP_COLUMN"], sqlalchemy.DateTime),
+        *[
+            sqlalchemy.column(column, sqlalchemy.Float)
+            for column in ROLLUP_COLUMNS.values()
+        ],
+        *[sqlalchemy.column(tag) for tag in tag_columns],
+    )
+
+
+def to_nanoseconds(timestamp) -> int:
+    return pd.Timestamp(timestamp).as_unit("ns").value
+
+
+def from_nanoseconds(nanoseconds: int) -> datetime.datetime:
+    return pd.Timestamp(nanoseconds).to_pydatetime()
+
+
+def read_time_bounds(
+    engine: sqlalchemy.engine.Engine, table_name: str, timestamp_column: str
+):
+    """Returns the first and last timestamps of a table, None when empty"""
+    timestamp = sqlalchemy.column(timestamp_column, sqlalchemy.DateTime)
+    table = sqlalchemy.table(table_name, timestamp)
+    with engine.connect() as connection:
+        return connection.execute(
+            sqlalchemy.select(
+                sqlalchemy.func.min(table.c[timestamp_column]),
+                sqlalchemy.func.max(table.c[timestamp_column]),
+            )
+        ).one()
+
+
+def get_rollup_high_water(configs: Dict, resolution: int) -> Optional[int]:
+    """Returns the end of the last bucket of a rollup in nanoseconds since the
+    epoch, None if the rollup does not exist
+
+    The value is read again after ROLLUP_REFRESH_INTERVAL seconds.
+    """
+    key = (configs["DB"], get_rollup_table_name(configs, resolution))
+    with get_rollup_high_water.lock:
+        cached = get_rollup_high_water.high_waters.get(key)
+    if cached is not None and (
+        time.monotonic() - cached[1] < configs["ROLLUP_REFRESH_INTERVAL"]
+    ):
+        return cached[0]
+    high_water = None
+    if key[1] in schema_catalog.get_table_names(configs["DB"]):
+        last = read_time_bounds(configs["DB"], key[1], configs["TIMESTAMP_COLUMN"])[1]
+        high_water = None if last is None else to_nanoseconds(last)
+    with get_rollup_high_water.lock:
+        get_rollup_high_water.high_waters[key] = (high_water, time.monotonic())
+    return high_water
+
+
+get_rollup_high_water.lock = threading.Lock()
+get_rollup_high_water.high_waters = dict()
+
+
+def aggregate_buckets(
+    df: pd.DataFrame,
+    tag_columns: List[str],
+    timestamp_column: str,
+    resolution: int,
+    from_rollup: bool,
+) -> pd.DataFrame:
+    """Aggregates samples, or the buckets of a finer rollup, into buckets
+
+    Args:
+        df (pd.DataFrame): the rows read from the source table
+        tag_columns (List[str]): the label columns
+        timestamp_column (str): the timestamp column of the metric
+        resolution (int): the length of the buckets in seconds
+        from_rollup (bool): whether df holds the buckets of a finer rollup
+            rather than raw samples with a VAL_COL
+
+    Returns:
+        pd.DataFrame: one row per series and bucket, stamped with the end of
+            the bucket
+    """
+    step = resolution * NS_PER_SECOND
+    times = pd.DatetimeIndex(df[timestamp_column]).as_unit("ns").asi8
+    # the end of the right-closed bucket of each row
+    ends = -(-times // step) * step
+    df = df.assign(**{timestamp_column: ends}).iloc[np.argsort(times, kind="stable")]
+    groups = df.groupby(tag_columns + [timestamp_column], dropna=False, sort=False)
+    if from_rollup:
+        columns = ROLLUP_COLUMNS
+        buckets = groups.agg(
+            value_sum=(columns["sum"], "sum"),
+            value_count=(columns["count"], "sum"),
+            value_min=(columns["min"], "min"),
+            value_max=(columns["max"], "max"),
+            value_last=(columns["last"], "last"),
+        )
+    else:
+        buckets = groups.agg(
+            value_sum=(VAL_COL, "sum"),
+            value_count=(VAL_COL, "count"),
+            value_min=(VAL_COL, "min"),
+            value_max=(VAL_COL, "max"),
+            value_last=(VAL_COL, "last"),
+        )
+    buckets = buckets.reset_index()
+    buckets[timestamp_column] = pd.to_datetime(buckets[timestamp_column])
+    return buckets[buckets[ROLLUP_COLUMNS["count"]] > 0]
+
+
+def update_rollup(configs: Dict, resolution: int, source: Optional[int]) -> int:
+    """Adds the buckets completed since the last update to a rollup table
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        resolution (int): the resolution of the rollup in seconds
+        source (int, optional): the resolution of the rollup it is built
+            from; None for the raw table
+
+    Returns:
+        int: the number of rows written
+    """
+    engine = configs["DB"]
+    timestamp_column = configs["TIMESTAMP_COLUMN"]
+    tags = get_tag_columns(configs)
+    step = resolution * NS_PER_SECOND
+    if source is None:
+        source_table = configs["TABLE_NAME"]
+    else:
+        source_table = get_rollup_table_name(configs, source)
+    first, last = read_time_bounds(engine, source_table, timestamp_column)
+    if last is None:
+        return 0
+    last = to_nanoseconds(last)
+    if source is None:
+        # the bucket of the last sample may still get samples
+        end = -(-last // step) * step - step
+    else:
+        # the source is complete up to its last bucket
+        end = last // step * step
+    target = get_rollup_table_name(configs, resolution)
+    high_water = None
+    if target in schema_catalog.get_table_names(engine):
+        high_water = read_time_bounds(engine, target, timestamp_column)[1]
+    if high_water is not None:
+        start = to_nanoseconds(high_water)
+    else:
+        start = -(-to_nanoseconds(first) // step) * step - step
+    chunk = max(1, ROLLUP_BUILD_CHUNK // resolution) * step
+
+    if source is None:
+        table = sqlalchemy.table(
+            source_table,
+            sqlalchemy.column(timestamp_column, sqlalchemy.DateTime),
+            sqlalchemy.column(configs["VALUE_COLUMN"], sqlalchemy.Float),
+            *[sqlalchemy.column(tag) for tag in tags],
+        )
+        columns = [table.c[tag] for tag in tags] + [
+            table.c[configs["VALUE_COLUMN"]].label(VAL_COL),
+            table.c[timestamp_column],
+        ]
+    else:
+        table = get_rollup_table(configs, source, tags)
+        columns = list(table.c)
+    timestamp = table.c[timestamp_column]
+    written = 0
+    while start < end:
+        stop = min(start + chunk, end)
+        select = sqlalchemy.select(*columns).where(
+            timestamp > from_nanoseconds(start), timestamp <= from_nanoseconds(stop)
+        )
+        df = pd.read_sql(select, engine)
+        if len(df):
+            buckets = aggregate_buckets(
+                df, tags, timestamp_column, resolution, source is not None
+            )
+            with engine.begin() as connection:
+                buckets.to_sql(target, connection, if_exists="append", index=False)
+            if high_water is None:
+                # the table has just been created
+                schema_catalog.invalidate(engine)
+                high_water = stop
+            written += len(buckets)
+        start = stop
+    return written
+
+
+def update_rollups(metric_name: str) -> Dict[int, int]:
+    """Brings the rollup tables of a metric up to date; see the module
+    docstring
+
+    Args:
+        metric_name (str): name of the metric
+
+    Returns:
+        Dict[int, int]: the number of rows written per resolution
+    """
+    configs = get_metric_configs(
+        {
+            "metric_name": metric_name,
+            "labels": dict(),
+            "start_datetime": None,
+            "end_datetime": None,
+        }
+    )
+    written = dict()
+    resolutions = get_resolutions(configs)
+    for index, resolution in enumerate(resolutions):
+        # the coarsest finer rollup this one is a multiple of
+        sources = [r for r in resolutions[:index] if resolution % r == 0]
+        source = sources[-1] if sources else None
+        written[resolution] = update_rollup(configs, resolution, source)
+        # read again by the next query
+        with get_rollup_high_water.lock:
+            get_rollup_high_water.high_waters.pop(
+                (configs["DB"], get_rollup_table_name(configs, resolution)), None
+            )
+    return written
+
+
+def update_all_rollups() -> Dict[str, Dict[int, int]]:
+    """Updates the rollups of every metric of the catalog which has some"""
+    written = dict()
+    for metric_name in metric_catalog.metric_names():
+        configs = get_metric_configs(
+            {
+                "metric_name": metric_name,
+                "labels": dict(),
+                "start_datetime": None,
+                "end_datetime": None,
+            }
+        )
+        if get_resolutions(configs):
+            written[metric_name] = update_rollups(metric_name)
+    return written
+
+
+def choose_range_resolution(
+    configs: Dict, range_seconds: float, window_ends: np.ndarray
+) -> Optional[int]:
+    """Returns the coarsest rollup which answers windows exactly
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        range_seconds (float): the length of the windows
+        window_ends (np.ndarray): int64 nanosecond ends of the windows
+
+    Returns:
+        Optional[int]: the resolution, None if no rollup fits
+    """
+    range_ns = int(round(range_seconds * NS_PER_SECOND))
+    for resolution in reversed(get_resolutions(configs)):
+        step = resolution * NS_PER_SECOND
+        if range_ns % step or np.any(window_ends % step):
+            continue
+        if get_rollup_high_water(configs, resolution) is not None:
+            return resolution
+    return None
+
+
+@traced_fetch
+def fetch_rollup_data(
+    metric_name: str,
+    labels: Dict,
+    start_datetime: datetime.datetime,
+    end_datetime: datetime.datetime,
+    resolution: int,
+) -> pd.DataFrame:
+    """Fetches the buckets of a metric from a rollup table
+
+    The samples after the last bucket of the rollup are read from the raw
+    table, each as a bucket of its own. Within a query with limits, every
+    bucket counts as a sample.
+
+    Returns:
+        pd.DataFrame: one column per label, TIME_COL (the end of the buckets)
+            and the columns of ROLLUP_COLUMNS
+    """
+    configs = get_metric_configs(
+        {
+            "metric_name": metric_name,
+            "labels": labels,
+            "start_datetime": start_datetime,
+            "end_datetime": end_datetime,
+        }
+    )
+    record(resolution=resolution)
+    tags = get_tag_columns(configs)
+    high_water = get_rollup_high_water(configs, resolution)
+    frames = []
+    if high_water is not None and to_nanoseconds(start_datetime) < high_water:
+        rollup_configs = get_rollup_configs(configs, resolution)
+        table = get_rollup_table(configs, resolution, tags)
+        end = min(to_nanoseconds(end_datetime), high_water)
+        select = sqlalchemy.select(
+            *[table.c[tag] for tag in tags],
+            table.c[configs["TIMESTAMP_COLUMN"]].label(TIME_COL),
+            *[table.c[column] for column in ROLLUP_COLUMNS.values()],
+        ).where(
+            *get_where_clauses(
+                table, rollup_configs, labels, start_datetime, from_nanoseconds(end)
+            )
+        )
+        df = pd.read_sql(select, configs["DB"])
+        budget = current_budget()
+        if budget is not None:
+            budget.add_frame((configs["DB"], configs["TABLE_NAME"]), df, tags)
+        frames.append(df)
+    if high_water is None or to_nanoseconds(end_datetime) > high_water:
+        raw_start = start_datetime
+        if high_water is not None:
+            raw_start = max(start_datetime, from_nanoseconds(high_water))
+        df = fetch_metric_data(
+            metric_name,
+            labels,
+            start_datetime=raw_start,
+            end_datetime=end_datetime,
+            tag_columns=tags,
+        )
+        if high_water is not None:
+            times = pd.DatetimeIndex(df[TIME_COL]).as_unit("ns").asi8
+            df = df[times > high_water]
+        values = df.pop(VAL_COL)
+        columns = {column: values for column in ROLLUP_COLUMNS.values()}
+        columns[ROLLUP_COLUMNS["count"]] = 1.0
+        frames.append(df.assign(**columns))
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+def rollup_series(df: pd.DataFrame) -> Dict[str, SeriesSet]:
+    """Splits the buckets of fetch_rollup_data into a series set per
+    aggregation, with the same series in the same order"""
+    columns = list(ROLLUP_COLUMNS.values())
+    labels = df.drop(columns=columns)
+    return {
+        aggregation: SeriesSet.from_frame(labels.assign(**{VAL_COL: df[column]}))
+        for aggregation, column in ROLLUP_COLUMNS.items()
+    }
+
+
+def evaluate_rollup_function(
+    name: str,
+    series: Dict[str, SeriesSet],
+    step_times: pd.DatetimeIndex,
+    range_seconds: float,
+    output_times: pd.DatetimeIndex = None,
+) -> SeriesSet:
+    """Evaluates one of ROLLUP_FUNCTIONS over the buckets of a rollup
+
+    Args:
+        name (str): the range function
+        series (Dict[str, SeriesSet]): the buckets, see rollup_series
+        step_times (pd.DatetimeIndex): the timestamps at which windows end,
+            multiples of the resolution
+        range_seconds (float): the length of the windows, a multiple of the
+            resolution
+        output_times (pd.DatetimeIndex, optional): the timestamps of the
+            results. Defaults to step_times.
+
+    Returns:
+        SeriesSet: the instant vector of each step
+    """
+
+    def over_time(function: str, aggregation: str) -> SeriesSet:
+        return evaluate_range_function(
+            function,
+            series[aggregation],
+            step_times,
+            range_seconds,
+            output_times=output_times,
+        )
+
+    if name == "avg_over_time":
+        # both have a sample wherever there is a bucket
+        sums = over_time("sum_over_time", "sum")
+        counts = over_time("sum_over_time", "count")
+        return sums.with_values(sums.values / counts.values)
+    if name == "count_over_time":
+        return over_time("sum_over_time", "count")
+    aggregation = name[: -len("_over_time")]
+    return over_time(name, aggregation)
+
+
+def select_rollup_aggregate(
+    configs: Dict,
+    labels: Dict,
+    start_datetime: datetime.datetime,
+    end_datetime: datetime.datetime,
+    aggregation: str,
+    output: List[str],
+):
+    """Aggregates the samples of each series in the left-open range
+    (start, end], like the windows of range functions, from the coarsest
+    fitting rollup and the raw table
+
+    The buckets which lie within the range are read from the rollup, and
+    the samples before the first one and after the last one from the raw
+    table.
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        labels (Dict): label matchers of the selector
+        start_datetime (datetime.datetime): start of the range (exclusive)
+        end_datetime (datetime.datetime): end of the range (inclusive)
+        aggregation (str): one of sum, count, min, max and avg
+        output (List[str]): the tag columns to select
+
+    Returns:
+        the statement, with the aggregate as VAL_COL; None if no rollup
+            covers ROLLUP_MIN_BUCKETS buckets of the range
+    """
+    tags = get_tag_columns(configs)
+    if any(label not in tags for label in labels):
+        return None
+    start, end = to_nanoseconds(start_datetime), to_nanoseconds(end_datetime)
+    for resolution in reversed(get_resolutions(configs)):
+        step = resolution * NS_PER_SECOND
+        high_water = get_rollup_high_water(configs, resolution)
+        if high_water is None:
+            continue
+        first = -(-start // step) * step
+        last = min(end // step * step, high_water)
+        if last - first >= ROLLUP_MIN_BUCKETS * step:
+            break
+    else:
+        return None
+    first, last = from_nanoseconds(first), from_nanoseconds(last)
+
+    raw = sqlalchemy.table(
+        configs["TABLE_NAME"],
+        sqlalchemy.column(configs["TIMESTAMP_COLUMN"], sqlalchemy.DateTime),
+        sqlalchemy.column(configs["VALUE_COLUMN"], sqlalchemy.Float),
+        *[sqlalchemy.column(tag) for tag in tags],
+    )
+    value = raw.c[configs["VALUE_COLUMN"]]
+    timestamp = raw.c[configs["TIMESTAMP_COLUMN"]]
+    edges = sqlalchemy.select(
+        *[raw.c[tag] for tag in tags],
+        value.label(ROLLUP_COLUMNS["sum"]),
+        sqlalchemy.literal(1.0, sqlalchemy.Float).label(ROLLUP_COLUMNS["count"]),
+        value.label(ROLLUP_COLUMNS["min"]),
+        value.label(ROLLUP_COLUMNS["max"]),
+    ).where(
+        *get_where_clauses(
+            raw, configs, labels, start_datetime, end_datetime, left_open=True
+        ),
+        sqlalchemy.or_(timestamp <= first, timestamp > last),
+    )
+    rollup = get_rollup_table(configs, resolution, tags)
+    buckets = sqlalchemy.select(
+        *[rollup.c[tag] for tag in tags],
+        *[rollup.c[ROLLUP_COLUMNS[name]] for name in ("sum", "count", "min", "max")],
+    ).where(
+        *get_where_clauses(
+            rollup, get_rollup_configs(configs, resolution), labels, first, last
+        ),
+        rollup.c[configs["TIMESTAMP_COLUMN"]] > first,
+    )
+    inner = sqlalchemy.union_all(edges, buckets).subquery()
+    if aggregation == "avg":
+        value = sqlalchemy.func.sum(
+            inner.c[ROLLUP_COLUMNS["sum"]]
+        ) / sqlalchemy.func.sum(inner.c[ROLLUP_COLUMNS["count"]])
+    elif aggregation == "count":
+        value = sqlalchemy.func.sum(inner.c[ROLLUP_COLUMNS["count"]])
+    else:
+        value = getattr(sqlalchemy.func, aggregation)(
+            inner.c[ROLLUP_COLUMNS[aggregation]]
+        )
+    select = sqlalchemy.select(*[inner.c[tag] for tag in output], value.label(VAL_COL))
+    if tags:
+        select = select.group_by(*[inner.c[tag] for tag in tags])
+    return select
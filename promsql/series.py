@@ -0,0 +1,373 @@
+"""Columnar storage of the series which queries are evaluated on"""
+
+import threading
+import weakref
+from typing import AbstractSet, Dict, List, Mapping
+
+import numpy as np
+import pandas as pd
+
+from .constants import TIME_COL, VAL_COL
+from .pandas_miscs import find_tags
+
+
+def combine_codes(code_arrays: List[np.ndarray], length: int) -> np.ndarray:
+    """Combines several integer codes per row into one dense code per row
+
+    Args:
+        code_arrays (List[np.ndarray]): non-negative codes, one array per key
+        length (int): the number of rows
+
+    Returns:
+        np.ndarray: int64 codes, equal for two rows iff all their codes are
+    """
+    combined = np.zeros(length, dtype=np.int64)
+    for codes in code_arrays:
+        size = int(codes.max()) + 1 if len(codes) else 1
+        combined, _ = pd.factorize(combined * size + codes)
+    return combined.astype(np.int64, copy=False)
+
+
+def is_label_value(value) -> bool:
+    # None, NaN and the empty string all mean that the label is not set
+    return value is not None and value == value and value != ""
+
+
+class LabelSet:
+    """An immutable set of labels, interned
+
+    Label sets are created with LabelSet.intern, which returns the existing
+    instance for equal labels. A label set is therefore stored once however
+    many series and intermediate results refer to it, and it can be used as
+    a dictionary key at the cost of an identity check.
+    """
+
+    __slots__ = ("items", "names", "__weakref__")
+
+    # weak references, so that label sets no result refers to are freed
+    _interned = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, items: tuple):
+        self.items = items
+        self.names = tuple(name for name, _ in items)
+
+    @classmethod
+    def intern(cls, labels: Mapping) -> "LabelSet":
+        items = tuple(
+            sorted(
+                (name, value) for name, value in labels.items() if is_label_value(value)
+            )
+        )
+        return cls.from_items(items)
+
+    @classmethod
+    def from_items(cls, items: tuple) -> "LabelSet":
+        """Returns the label set of (name, value) pairs sorted by name"""
+        reference = cls._interned.get(items)
+        label_set = reference() if reference is not None else None
+        if label_set is None:
+            with cls._lock:
+                reference = cls._interned.get(items)
+                label_set = reference() if reference is not None else None
+                if label_set is None:
+                    label_set = cls(items)
+                    cls._interned[items] = weakref.KeyedRef(
+                        label_set, LabelSet._discard, items
+                    )
+        return label_set
+
+    @staticmethod
+    def _discard(reference: weakref.KeyedRef):
+        with LabelSet._lock:
+            if LabelSet._interned.get(reference.key) is reference:
+                del LabelSet._interned[reference.key]
+
+    def get(self, name: str, default=""):
+        # label sets are small, a scan is faster than building a dict
+        for label, value in self.items:
+            if label == name:
+                return value
+        return default
+
+    def keep(self, names: AbstractSet[str]) -> "LabelSet":
+        if names.issuperset(self.names):
+            return self
+        return LabelSet.from_items(tuple(i for i in self.items if i[0] in names))
+
+    def drop(self, names: AbstractSet[str]) -> "LabelSet":
+        if names.isdisjoint(self.names):
+            return self
+        return LabelSet.from_items(tuple(i for i in self.items if i[0] not in names))
+
+    def set(self, name: str, value) -> "LabelSet":
+        mapping = dict(self.items)
+        mapping[name] = value
+        return LabelSet.intern(mapping)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __reduce__(self):
+        # unpickled label sets are interned like the others
+        return LabelSet.from_items, (self.items,)
+
+    def __str__(self):
+        return "{" + ", ".join(f'{name}="{value}"' for name, value in self.items) + "}"
+
+    __repr__ = __str__
+
+
+def factorize_label_sets(label_sets: List[LabelSet]) -> np.ndarray:
+    """Returns a dense code per label set, equal for equal label sets"""
+    codes = dict()
+    return np.fromiter(
+        (codes.setdefault(label_set, len(codes)) for label_set in label_sets),
+        dtype=np.int64,
+        count=len(label_sets),
+    )
+
+
+class SeriesSet:
+    """A set of series stored as contiguous arrays
+
+    The samples of all series are concatenated, series after series and in
+    time order within a series; `offsets` holds the position of the first
+    sample of each series plus the total number of samples. Each series has
+    one interned LabelSet. Operators which only change the values share the
+    other arrays with their input.
+
+    Args:
+        labels (List[LabelSet]): the labels of each series
+        offsets (np.ndarray): int64 start of each series, and the end
+        times (np.ndarray): int64 nanosecond timestamps of the samples
+        values (np.ndarray): float64 values of the samples
+    """
+
+    __slots__ = ("labels", "offsets", "times", "values")
+
+    def __init__(
+        self,
+        labels: List[LabelSet],
+        offsets: np.ndarray,
+        times: np.ndarray,
+        values: np.ndarray,
+    ):
+        self.labels = labels
+        self.offsets = offsets
+        self.times = times
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __str__(self):
+        return f"SeriesSet({len(self.labels)} series, {len(self.values)} samples)"
+
+    @classmethod
+    def empty(cls) -> "SeriesSet":
+        return cls(
+            [],
+            np.zeros(1, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.float64),
+        )
+
+    @classmethod
+    def from_samples(
+        cls,
+        labels: List[LabelSet],
+        series: np.ndarray,
+        times: np.ndarray,
+        values: np.ndarray,
+    ) -> "SeriesSet":
+        """Builds a series set from loose samples
+
+        Args:
+            labels (List[LabelSet]): candidate label sets
+            series (np.ndarray): for each sample, the position of its label
+                set in labels; samples with equal label sets are merged
+            times (np.ndarray): int64 nanosecond timestamps
+            values (np.ndarray): float64 values
+
+        Returns:
+            SeriesSet: the series which have samples, in the order of labels
+        """
+        if len(series) == 0:
+            return cls.empty()
+        label_codes = factorize_label_sets(labels)
+        series = label_codes[series]
+        order = np.lexsort((times, series))
+        series = series[order]
+        used, counts = np.unique(series, return_counts=True)
+        first_label = np.empty(label_codes.max() + 1, dtype=np.int64)
+        first_label[label_codes[::-1]] = np.arange(len(labels) - 1, -1, -1)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return cls(
+            [labels[position] for position in first_label[used]],
+            offsets,
+            np.asarray(times, dtype=np.int64)[order],
+            np.asarray(values, dtype=np.float64)[order],
+        )
+
+    @classmethod
+    def concat(cls, parts: List["SeriesSet"]) -> "SeriesSet":
+        """Merges series sets, e.g. the results of consecutive time ranges
+
+        The samples of equal label sets are merged into one series.
+        """
+        parts = [part for part in parts if len(part.times)]
+        if len(parts) < 2:
+            return parts[0] if parts else cls.empty()
+        labels, series, first = [], [], 0
+        for part in parts:
+            labels.extend(part.labels)
+            series.append(part.sample_series() + first)
+            first += len(part.labels)
+        return cls.from_samples(
+            labels,
+            np.concatenate(series),
+            np.concatenate([part.times for part in parts]),
+            np.concatenate([part.values for part in parts]),
+        )
+
+    @classmethod
+    def from_matrix(
+        cls,
+        labels: List[LabelSet],
+        times: np.ndarray,
+        values: np.ndarray,
+        mask: np.ndarray = None,
+    ) -> "SeriesSet":
+        """Builds a series set from a series x step matrix
+
+        Args:
+            labels (List[LabelSet]): the distinct labels of each row
+            times (np.ndarray): sorted int64 nanosecond timestamps, one per
+                column
+            values (np.ndarray): float64 values, series x step
+            mask (np.ndarray, optional): the samples to keep. Defaults to the
+                values which are not NaN.
+
+        Returns:
+            SeriesSet: the rows which have samples
+        """
+        if mask is None:
+            mask = ~np.isnan(values)
+        series, steps = np.nonzero(mask)
+        counts = np.bincount(series, minlength=len(labels))
+        kept = np.flatnonzero(counts)
+        return cls(
+            [labels[position] for position in kept],
+            np.concatenate(([0], np.cumsum(counts[kept]))),
+            np.asarray(times, dtype=np.int64)[steps],
+            values[series, steps],
+        )
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "SeriesSet":
+        """Converts samples in the long format (see fetch_metric_data)"""
+        if len(df) == 0:
+            return cls.empty()
+        tags = find_tags(df)
+        code_arrays = []
+        for tag in tags:
+            column = df[tag]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                # the dictionary encoded columns of the fetch backends: the
+                # categories which are not label values share code 0 with
+                # NULL, like fillna("") below
+                lookup = np.arange(len(column.cat.categories) + 1, dtype=np.int64)
+                unset = [not is_label_value(v) for v in column.cat.categories]
+                lookup[1:][np.array(unset, dtype=bool)] = 0
+                code_arrays.append(lookup[column.cat.codes.to_numpy() + 1])
+                continue
+            if column.hasnans:
+                column = column.fillna("")
+            code_arrays.append(pd.factorize(column)[0].astype(np.int64))
+        codes = combine_codes(code_arrays, len(df))
+        first = np.empty(int(codes.max()) + 1, dtype=np.int64)
+        first[codes[::-1]] = np.arange(len(df) - 1, -1, -1)
+        names = sorted(tags)
+        columns = [df[name].to_numpy(dtype=object)[first] for name in names]
+        rows = zip(*columns) if names else [()] * len(first)
+        labels = [
+            LabelSet.from_items(
+                tuple(
+                    (name, value)
+                    for name, value in zip(names, row)
+                    if is_label_value(value)
+                )
+            )
+            for row in rows
+        ]
+        times = pd.DatetimeIndex(df[TIME_COL]).as_unit("ns")
+        if times.tz is not None:
+            times = times.tz_convert(None)
+        return cls.from_samples(
+            labels, codes, times.asi8, df[VAL_COL].to_numpy(dtype=np.float64)
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        """Converts to the long format, one column per label name"""
+        names = self.label_names()
+        lengths = self.lengths()
+        columns = dict()
+        for name in names:
+            values = np.empty(len(self.labels), dtype=object)
+            values[:] = [label_set.get(name, None) for label_set in self.labels]
+            columns[name] = np.repeat(values, lengths)
+        columns[VAL_COL] = self.values
+        columns[TIME_COL] = pd.to_datetime(self.times, unit="ns")
+        return pd.DataFrame(columns)
+
+    def label_names(self) -> List[str]:
+        names = dict()
+        for label_set in self.labels:
+            for name in label_set.names:
+                names[name] = None
+        return list(names)
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def sample_series(self) -> np.ndarray:
+        """Returns the position of the series of each sample"""
+        return np.repeat(np.arange(len(self.labels)), self.lengths())
+
+    def with_values(self, values: np.ndarray) -> "SeriesSet":
+        """Returns the same series with other values; the rest is shared"""
+        return SeriesSet(self.labels, self.offsets, self.times, values)
+
+    def with_labels(self, labels: List[LabelSet]) -> "SeriesSet":
+        """Returns the same samples under other labels
+
+        Series whose new labels are equal are merged.
+        """
+        if len(set(labels)) == len(labels):
+            return SeriesSet(labels, self.offsets, self.times, self.values)
+        return SeriesSet.from_samples(
+            labels, self.sample_series(), self.times, self.values
+        )
+
+    def filter(self, mask: np.ndarray) -> "SeriesSet":
+        """Keeps the samples where mask is True, and the series with any"""
+        if mask.all():
+            return self
+        series = self.sample_series()[mask]
+        counts = np.bincount(series, minlength=len(self.labels))
+        kept = np.flatnonzero(counts)
+        return SeriesSet(
+            [self.labels[position] for position in kept],
+            np.concatenate(([0], np.cumsum(counts[kept]))),
+            self.times[mask],
+            self.values[mask],
+        )
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Returns the bytes used by the sample arrays and the offsets"""
+        return {
+            "offsets": self.offsets.nbytes,
+            "times": self.times.nbytes,
+            "values": self.values.nbytes,
+        }
@@ -0,0 +1,607 @@
+"""Serves the query API of Prometheus over HTTP
+
+The endpoints `/api/v1/query`, `/api/v1/query_range`, `/api/v1/series`,
+`/api/v1/labels` and `/api/v1/label/<name>/values` answer like the ones of
+Prometheus, so Grafana can use
+PromSQL as a Prometheus data source:
+
+    promsql-server.py --port 9090 --db sqlite:///metrics.db
+
+Requests are read on an asyncio event loop and queries are evaluated on a
+thread pool, so a slow query never blocks the other connections. Identical
+requests which arrive while one of them is being evaluated share its
+evaluation, and responses are encoded and written a few thousand samples at a
+time with chunked transfer encoding, rather than built in memory as a whole.
+
+Timestamps without a timezone, on the way in and out, are UTC.
+"""
+
+import argparse
+import asyncio
+import datetime
+import functools
+import itertools
+import json
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+from lark.exceptions import LarkError
+
+from .clock import utc_now
+from .concurrency import run_fetches
+from .constants import DEFAULT_CONFIGS
+from .nodes import MatrixSelector, SubqueryExpr, VectorSelector
+from .planner import expand_selector, selector_configs
+from .query import evaluate_instant, evaluate_range, parse_query, range_steps
+from .results_cache import results_cache
+from .rollups import update_all_rollups
+from .series import LabelSet, SeriesSet
+from .sql_miscs import (
+    fetch_metric_data,
+    get_label_values,
+    get_tag_columns,
+    metric_catalog,
+)
+from .limits import QueryLimitExceeded
+from .transformer import duration_literal_to_seconds
+
+# threads evaluating queries; their fetches run on the pool of concurrency,
+# so an evaluation never waits for a thread that another one holds
+EVAL_THREADS = 4
+# samples encoded between two writes of a streamed response
+SAMPLES_PER_CHUNK = 5000
+# largest accepted request body (form encoded parameters of POST requests)
+MAX_BODY_SIZE = 1 << 20
+
+DURATION_REGEX = re.compile(r"^[0-9]+[smhdwy]$")
+LABEL_VALUES_PATH = re.compile(r"^/api/v1/label/([^/]+)/values/?$")
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    500: "Internal Server Error",
+}
+
+
+class ApiError(Exception):
+    """An error reported to the client in the format of Prometheus
+
+    Args:
+        status (int): the HTTP status code
+        error_type (str): e.g. "bad_data" or "execution"
+        message (str): the error message
+    """
+
+    def __init__(self, status: int, error_type: str, message: str):
+        self.status = status
+        self.error_type = error_type
+        super().__init__(message)
+
+
+def parse_time(value: Optional[str], default: datetime.datetime) -> datetime.datetime:
+    """Parses a unix timestamp or an RFC 3339 date into a naive UTC datetime
+
+    Raises:
+        ApiError: for values which are neither
+    """
+    if value is None:
+        return default
+    try:
+        timestamp = pd.Timestamp(float(value), unit="s")
+    except ValueError:
+        try:
+            timestamp = pd.Timestamp(value)
+        except ValueError:
+            raise ApiError(
+                400, "bad_data", f"cannot parse {value!r} to a valid timestamp"
+            )
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp.to_pydatetime()
+
+
+def parse_duration(value: Optional[str]) -> float:
+    """Parses a number of seconds or a duration literal such as `15s`
+
+    Raises:
+        ApiError: for values which are neither
+    """
+    if value is not None and DURATION_REGEX.match(value):
+        return float(duration_literal_to_seconds(value))
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, "bad_data", f"cannot parse {value!r} to a valid duration")
+
+
+def get_param(params: Dict[str, List[str]], name: str) -> Optional[str]:
+    values = params.get(name)
+    return values[-1] if values else None
+
+
+def parse_expr(text: Optional[str]):
+    """Parses the query of a request
+
+    Raises:
+        ApiError: for missing or invalid queries
+    """
+    if not text:
+        raise ApiError(400, "bad_data", "no query given")
+    try:
+        return parse_query(text)
+    except LarkError as error:
+        raise ApiError(400, "bad_data", f"invalid parameter 'query': {error}")
+
+
+def parse_selectors(params: Dict[str, List[str]]) -> List[VectorSelector]:
+    """Parses the `match[]` series selectors of a request
+
+    Selectors on a `__name__` regex are replaced by the selectors of the
+    metrics of the catalog which match.
+
+    Raises:
+        ApiError: for parameters which are not plain series selectors
+    """
+    selectors = []
+    for text in params.get("match[]", []):
+        expr = parse_expr(text)
+        if not isinstance(expr, VectorSelector) or expr.offset:
+            raise ApiError(400, "bad_data", f"invalid series selector {text!r}")
+        union = expand_selector(expr)
+        selectors.extend([expr] if union is None else union.exprs)
+    return selectors
+
+
+def format_value(value: float) -> str:
+    """Formats a sample value the way Prometheus does, e.g. `1`, `0.5`, `NaN`"""
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    text = repr(float(value))
+    if "e" in text:
+        return np.format_float_positional(value, trim="-")
+    return text[:-2] if text.endswith(".0") else text
+
+
+def format_timestamp(nanoseconds: int) -> str:
+    """Formats a timestamp as seconds with millisecond precision"""
+    seconds, milliseconds = divmod(int(nanoseconds) // 1000000, 1000)
+    if not milliseconds:
+        return str(seconds)
+    return f"{seconds}.{milliseconds:03d}".rstrip("0")
+
+
+def format_labels(series: SeriesSet, index: int) -> str:
+    return json.dumps({name: str(value) for name, value in series.labels[index].items})
+
+
+def encode_series(
+    series: SeriesSet, time: Optional[datetime.datetime] = None
+) -> Iterator[str]:
+    """Encodes the JSON list of a vector, or of a matrix if time is None
+
+    The list is yielded in pieces of about SAMPLES_PER_CHUNK samples.
+    """
+    stamp = None if time is None else format_timestamp(pd.Timestamp(time).value)
+    pieces, samples, separator = ["["], 0, ""
+    for index in range(len(series.labels)):
+        start, end = series.offsets[index], series.offsets[index + 1]
+        if start == end:
+            continue
+        metric = format_labels(series, index)
+        values = [format_value(value) for value in series.values[start:end].tolist()]
+        if stamp is not None:
+            items = [
+                f'{{"metric":{metric},"value":[{stamp},"{value}"]}}' for value in values
+            ]
+        else:
+            times = map(format_timestamp, series.times[start:end].tolist())
+            points = ",".join(f'[{t},"{value}"]' for t, value in zip(times, values))
+            items = [f'{{"metric":{metric},"values":[{points}]}}']
+        for item in items:
+            pieces.append(separator + item)
+            separator = ","
+        samples += end - start
+        if samples >= SAMPLES_PER_CHUNK:
+            yield "".join(pieces)
+            pieces, samples = [], 0
+    pieces.append("]")
+    yield "".join(pieces)
+
+
+def encode_result(result_type: str, result, time: datetime.datetime) -> Iterator[str]:
+    """Encodes the body of a successful query response
+
+    The first piece holds the first samples of the result, or the whole of a
+    scalar, so that most encoding errors surface before the response is
+    started; see QueryServer.respond.
+    """
+    head = f'{{"status":"success","data":{{"resultType":"{result_type}","result":'
+    if isinstance(result, SeriesSet):
+        pieces = encode_series(result, time if result_type == "vector" else None)
+        yield head + next(pieces)
+        yield from pieces
+    else:
+        stamp = format_timestamp(pd.Timestamp(time).value)
+        value = result if result_type == "string" else format_value(float(result))
+        yield f"{head}[{stamp},{json.dumps(value)}]"
+    yield "}}"
+
+
+def encode_data(data) -> Iterator[str]:
+    yield json.dumps({"status": "success", "data": data})
+
+
+def run_instant_query(params: Dict[str, List[str]]) -> Tuple:
+    """Evaluates the query of an `/api/v1/query` request"""
+    expr = parse_expr(get_param(params, "query"))
+    time = parse_time(get_param(params, "time"), utc_now())
+    result = evaluate_instant(expr, time)
+    if isinstance(result, SeriesSet):
+        is_range = isinstance(expr, (MatrixSelector, SubqueryExpr))
+        return ("matrix" if is_range else "vector", result, time)
+    if isinstance(result, str):
+        return ("string", result, time)
+    return ("scalar", result, time)
+
+
+def run_range_query(params: Dict[str, List[str]]) -> Tuple:
+    """Evaluates the query of an `/api/v1/query_range` request"""
+    expr = parse_expr(get_param(params, "query"))
+    start = parse_time(get_param(params, "start"), None)
+    end = parse_time(get_param(params, "end"), None)
+    if start is None or end is None:
+        raise ApiError(400, "bad_data", "start and end are required")
+    try:
+        steps = range_steps(start, end, parse_duration(get_param(params, "step")))
+    except ValueError as error:
+        raise ApiError(400, "bad_data", str(error))
+    result = evaluate_range(expr, steps)
+    if isinstance(result, SeriesSet):
+        return ("matrix", result, None)
+    # a scalar has the same value at every step
+    values = np.full((1, len(steps)), float(result))
+    series = SeriesSet.from_matrix(
+        [LabelSet.intern({})], steps.asi8, values, np.ones_like(values, dtype=bool)
+    )
+    return ("matrix", series, None)
+
+
+def run_series(params: Dict[str, List[str]]) -> List[Dict]:
+    """Lists the label sets of the series matching an `/api/v1/series`
+    request"""
+    selectors = parse_selectors(params)
+    if not selectors:
+        raise ApiError(400, "bad_data", "no match[] parameter provided")
+    end = parse_time(get_param(params, "end"), utc_now())
+    fetches = []
+    for selector in selectors:
+        configs = selector_configs(selector)
+        default_start = end - datetime.timedelta(
+            seconds=configs["LOOK_BEHIND_DURATION"]
+        )
+        fetch = functools.partial(
+            fetch_metric_data,
+            selector.name,
+            selector.label_matchers,
+            start_datetime=parse_time(get_param(params, "start"), default_start),
+            end_datetime=end,
+        )
+        fetches.append((configs, fetch))
+    series = dict()
+    for selector, df in zip(selectors, run_fetches(fetches)):
+        for labels in SeriesSet.from_frame(df).labels:
+            key = (selector.name, labels.items)
+            series[key] = dict(
+                __name__=selector.name,
+                **{name: str(value) for name, value in labels.items},
+            )
+    return list(series.values())
+
+
+def run_labels(params: Dict[str, List[str]]) -> List[str]:
+    """Lists the label names of an `/api/v1/labels` request
+
+    Without `match[]`, every metric of the catalog is listed.
+    """
+    selectors = parse_selectors(params)
+    if not selectors:
+        selectors = [
+            VectorSelector(name=name, label_matchers=dict())
+            for name in metric_catalog.metric_names()
+        ]
+    labels = {"__name__"}
+    for selector in selectors:
+        labels.update(get_tag_columns(selector_configs(selector)))
+    return sorted(labels)
+
+
+def run_label_values(label_name: str, params: Dict[str, List[str]]) -> List[str]:
+    """Lists the values of a label for an `/api/v1/label/<name>/values`
+    request
+
+    Without `match[]`, the values of every metric of the catalog are read
+    from the label index; otherwise from the series which match.
+    """
+    if params.get("match[]"):
+        values = {labels.get(label_name) for labels in run_series(params)}
+        return sorted(value for value in values if value)
+    if label_name == "__name__":
+        return metric_catalog.metric_names()
+    values = set()
+    for name in metric_catalog.metric_names():
+        configs = selector_configs(VectorSelector(name=name, label_matchers=dict()))
+        if label_name in get_tag_columns(configs):
+            values.update(str(value) for value in get_label_values(configs, label_name))
+    return sorted(value for value in values if value)
+
+
+class QueryServer:
+    """Answers the HTTP requests of one or more asyncio servers
+
+    Args:
+        executor (ThreadPoolExecutor, optional): the threads evaluating
+            queries. Defaults to EVAL_THREADS new threads.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor = None):
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=EVAL_THREADS, thread_name_prefix="promsql-eval"
+        )
+        # evaluations in progress, by endpoint and parameters
+        self.in_flight = dict()
+        self.routes = {
+            "/api/v1/query": (run_instant_query, lambda result: encode_result(*result)),
+            "/api/v1/query_range": (
+                run_range_query,
+                lambda result: encode_result(*result),
+            ),
+            "/api/v1/series": (run_series, encode_data),
+            "/api/v1/labels": (run_labels, encode_data),
+        }
+
+    async def evaluate(self, path: str, params: Dict[str, List[str]], run: Callable):
+        """Runs run(params) on the executor, once for identical requests
+
+        A request which arrives while an identical one is evaluated waits for
+        the same result instead of evaluating the query again.
+        """
+        key = (
+            path,
+            tuple(sorted((name, tuple(values)) for name, values in params.items())),
+        )
+        future = self.in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, run, params)
+            self.in_flight[key] = future
+
+            def done(_):
+                if self.in_flight.get(key) is future:
+                    del self.in_flight[key]
+
+            future.add_done_callback(done)
+        # a client going away must not cancel the evaluation of the others
+        return await asyncio.shield(future)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves the requests of a connection until it is closed"""
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.respond(writer, method, target, headers, body, keep_alive)
+                if not keep_alive:
+                    break
+        except ApiError as error:
+            await send_error(writer, error, keep_alive=False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        target: str,
+        headers: Dict[str, str],
+        body: bytes,
+        keep_alive: bool,
+    ):
+        url = urlsplit(target)
+        route = self.routes.get(url.path.rstrip("/"))
+        label_values = LABEL_VALUES_PATH.match(url.path)
+        if route is None and label_values is not None:
+            label_name = unquote(label_values.group(1))
+            route = (functools.partial(run_label_values, label_name), encode_data)
+        try:
+            if route is None:
+                raise ApiError(404, "not_found", f"unknown path {url.path}")
+            if method not in ("GET", "POST"):
+                raise ApiError(405, "bad_data", f"method {method} not allowed")
+            params = parse_qs(url.query)
+            if headers.get("content-type", "").startswith(
+                "application/x-www-form-urlencoded"
+            ):
+                for name, values in parse_qs(body.decode()).items():
+                    params.setdefault(name, []).extend(values)
+            run, encode = route
+            result = await self.evaluate(url.path, params, run)
+            chunks = encode(result)
+            # the first piece is encoded before the status is sent, so that
+            # its errors are reported like the ones of the evaluation
+            first = next(chunks)
+        except ApiError as error:
+            await send_error(writer, error, keep_alive)
+            return
+        except (
+            LarkError,
+            QueryLimitExceeded,
+            ValueError,
+            NotImplementedError,
+        ) as error:
+            await send_error(writer, ApiError(422, "execution", str(error)), keep_alive)
+            return
+        except Exception as error:
+            await send_error(writer, ApiError(500, "internal", str(error)), keep_alive)
+            return
+        await send_chunks(writer, 200, itertools.chain([first], chunks), keep_alive)
+
+
+async def read_request(
+    reader: asyncio.StreamReader,
+) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    """Reads the method, target, headers and body of the next request
+
+    Returns None once the client closed the connection.
+
+    Raises:
+        ApiError: for malformed requests
+    """
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    parts = line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise ApiError(400, "bad_data", "malformed request line")
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > MAX_BODY_SIZE:
+        raise ApiError(413, "bad_data", "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return parts[0].upper(), parts[1], headers, body
+
+
+def response_head(status: int, keep_alive: bool, **headers) -> bytes:
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+    headers["Content-Type"] = "application/json"
+    headers["Connection"] = "keep-alive" if keep_alive else "close"
+    lines.extend(
+        f"{name.replace('_', '-')}: {value}" for name, value in headers.items()
+    )
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_chunks(
+    writer: asyncio.StreamWriter, status: int, chunks: Iterator[str], keep_alive: bool
+):
+    """Writes a response body piece by piece with chunked transfer encoding
+
+    Waiting for each piece to be sent lets the other connections be served
+    while a large response is encoded, and bounds the memory it takes.
+
+    Raises:
+        ConnectionAbortedError: when a piece cannot be encoded once the
+            response is started. The connection is aborted without the last
+            chunk, so that the client sees a truncated response rather than
+            a successful one.
+    """
+    writer.write(response_head(status, keep_alive, Transfer_Encoding="chunked"))
+    try:
+        for chunk in chunks:
+            data = chunk.encode()
+            if data:
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                await writer.drain()
+    except ConnectionError:
+        raise
+    except Exception as error:
+        writer.transport.abort()
+        raise ConnectionAbortedError(f"response aborted: {error}") from error
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def send_error(writer: asyncio.StreamWriter, error: ApiError, keep_alive: bool):
+    body = json.dumps(
+        {"status": "error", "errorType": error.error_type, "error": str(error)}
+    ).encode()
+    writer.write(response_head(error.status, keep_alive, Content_Length=len(body)))
+    writer.write(body)
+    await writer.drain()
+
+
+async def update_rollups_every(interval: float):
+    """Updates the rollup tables every interval seconds, off the event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(None, update_all_rollups)
+        await asyncio.sleep(interval)
+
+
+async def serve(
+    host: str = "127.0.0.1", port: int = 9090, rollup_interval: float = None
+):
+    """Serves the API until the task is cancelled
+
+    Args:
+        host (str, optional): the address to listen on
+        port (int, optional): the port to listen on
+        rollup_interval (float, optional): seconds between two updates of
+            the rollup tables; None leaves them as they are
+    """
+    server = await asyncio.start_server(QueryServer().handle, host, port)
+    rollups = None
+    if rollup_interval:
+        rollups = asyncio.create_task(update_rollups_every(rollup_interval))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if rollups is not None:
+            rollups.cancel()
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Serves the Prometheus query API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--db", help="database url, overrides the DB config")
+    parser.add_argument(
+        "--cache-dir", help="directory where range query results are cached"
+    )
+    parser.add_argument(
+        "--dialect", help="SQL flavour of the database, overrides the DIALECT config"
+    )
+    parser.add_argument(
+        "--rollup-interval",
+        type=float,
+        help="seconds between two updates of the rollup tables, see "
+        "ROLLUP_RESOLUTIONS; they are not updated by default",
+    )
+    args = parser.parse_args(argv)
+    if args.db:
+        DEFAULT_CONFIGS["DB"] = args.db
+        # the default dialect is the one of QuestDB
+        DEFAULT_CONFIGS["DIALECT"] = args.dialect
+    elif args.dialect:
+        DEFAULT_CONFIGS["DIALECT"] = args.dialect
+    # the catalog reads the configs and lists the metric tables once
+    metric_catalog.reload()
+    metric_catalog.index()
+    results_cache.directory = args.cache_dir
+    asyncio.run(serve(args.host, args.port, args.rollup_interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,415 @@
 """Miscellaneous functions for retrieving data from a sql database"""
 
+import functools
 import re
-from typing import Dict
-import pandas as pd
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Iterable, List
 import sqlalchemy
 import datetime
-from promsql.constants import DEFAULT_CONFIGS, CUSTOM_CONFIGS, VAL_COL, TIME_COL
+from promsql.constants import DEFAULT_CONFIGS, CUSTOM_CONFIGS
+from promsql.backends import get_fetch_backend
+from promsql.clock import utc_now
+from promsql.catalog import MetricCatalog, label_index, schema_catalog
+from promsql.dialects import (
+    anchor_regex,
+    get_latest_sample_strategy,
+    get_regex_match_strategy,
+    regex_match,
+    select_latest_samples,
+)
+from promsql.fetch_cache import fetch_cache
+from promsql.limits import current_budget
+from promsql.tracing import is_enabled, record, traced_fetch
+from promsql.pandas_miscs import latest_samples
 
+# number of selector statements kept per engine by get_selector_statement
+STATEMENT_CACHE_SIZE = 512
 
-def get_db_engine(db_url: str) -> sqlalchemy.engine.Engine:
+REGEX_OPS = ("=~", "!~")
+
+
+def get_db_engine(
+    db_url: str,
+    pool_size: int = None,
+    max_overflow: int = None,
+    pool_recycle: int = None,
+) -> sqlalchemy.engine.Engine:
     """Creates an sqlalchemy engine
 
+    One engine is kept per url and pool settings. The pool settings which
+    are None are left to sqlalchemy; they are dropped for the pools which do
+    not take them (e.g. the single connection pool of in-memory SQLite).
+
     Args:
-        db_url (str): the url which is passed to the create_engine function 
+        db_url (str): the url which is passed to the create_engine function
             of sqlalchemy.
+        pool_size (int, optional): connections kept open in the pool
+        max_overflow (int, optional): connections opened beyond pool_size
+            when the pool is exhausted
+        pool_recycle (int, optional): seconds after which a connection is
+            replaced; -1 never replaces them
 
     Returns:
         sqlalchemy.engine.Engine: The created engine
     """
     if not hasattr(get_db_engine, "clients"):
         get_db_engine.clients = dict()
-    if db_url in get_db_engine.clients:
-        return get_db_engine.clients[db_url]
-    engine = sqlalchemy.create_engine(db_url, echo=False)
-    get_db_engine.clients[db_url] = engine
+    key = (db_url, pool_size, max_overflow, pool_recycle)
+    if key in get_db_engine.clients:
+        return get_db_engine.clients[key]
+    options = {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_recycle": pool_recycle,
+    }
+    options = {name: value for name, value in options.items() if value is not None}
+    try:
+        engine = sqlalchemy.create_engine(db_url, echo=False, **options)
+    except TypeError:
+        # the pool of this dialect does not size itself
+        options.pop("pool_size", None)
+        options.pop("max_overflow", None)
+        engine = sqlalchemy.create_engine(db_url, echo=False, **options)
+    get_db_engine.clients[key] = engine
     return engine
 
 
+metric_catalog = MetricCatalog(DEFAULT_CONFIGS, CUSTOM_CONFIGS, get_db_engine)
+
+
 def get_metric_configs(params: Dict) -> Dict:
-    metric_name = params["metric_name"]
-    if not hasattr(get_metric_configs, "configs"):
-        get_metric_configs.configs = dict()
-    if metric_name in get_metric_configs.configs:
-        return get_metric_configs.configs[metric_name]
-
-    configs = dict()
-    for custom_config in CUSTOM_CONFIGS:
-        if isinstance(custom_config["check"], str):
-            regex = re.compile(custom_config["check"])
-            if regex.match(metric_name):
-                configs = custom_config
-                break
-        elif callable(custom_config["check"]):
-            if custom_config["check"](params):
-                configs = custom_config
-                break
-
-    for k, v in DEFAULT_CONFIGS.items():
-        if k not in configs:
-            configs[k] = v
-
-    for k, v in configs.items():
-        if isinstance(v, str):
-            configs[k] = v.format(**params)
-        elif callable(v):
-            configs[k] = v(params)
-
-    configs["DB"] = get_db_engine(configs["DB"])
-    get_metric_configs.configs[metric_name] = configs
-    return configs
+    """Returns the configs of a metric, resolved by the metric catalog
+
+    Args:
+        params (Dict): `metric_name`, `labels`, `start_datetime` and
+            `end_datetime` of the fetch, passed to the functions of the
+            configs
+
+    Returns:
+        Dict: the configs, with the engine of the database as `DB`
+    """
+    return metric_catalog.resolve(params)
+
+
+def get_table_columns(configs: Dict) -> List[str]:
+    """Returns the column names of the metric table from the schema catalog
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+
+    Returns:
+        List[str]: names of the columns in the table
+    """
+    return schema_catalog.get_column_names(configs["DB"], configs["TABLE_NAME"])
+
+
+def get_tag_columns(configs: Dict) -> List[str]:
+    """Returns the columns which are used as labels of the metric
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+
+    Returns:
+        List[str]: names of the tag columns
+    """
+    tag_columns = configs["TAG_COLUMNS"]
+    if isinstance(tag_columns, (list, tuple)):
+        return list(tag_columns)
+    reserved = [configs["VALUE_COLUMN"], configs["TIMESTAMP_COLUMN"]]
+    columns = [c for c in get_table_columns(configs) if c not in reserved]
+    if isinstance(tag_columns, str):
+        regex = re.compile(tag_columns)
+        columns = [c for c in columns if regex.match(c)]
+    return columns
+
+
+def get_metric_table(
+    configs: Dict, tag_columns: Iterable[str]
+) -> sqlalchemy.sql.expression.TableClause:
+    """Describes the metric table as an sqlalchemy core table
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        tag_columns (Iterable[str]): the label columns to declare
+
+    Returns:
+        sqlalchemy.sql.expression.TableClause: the table with the timestamp,
+            value and the given tag columns
+    """
+    return sqlalchemy.table(
+        configs["TABLE_NAME"],
+        sqlalchemy.column(configs["TIMESTAMP_COLUMN"], sqlalchemy.DateTime),
+        sqlalchemy.column(configs["VALUE_COLUMN"], sqlalchemy.Float),
+        *[sqlalchemy.column(tag) for tag in tag_columns],
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_label_regex(regex: str) -> re.Pattern:
+    """Compiles the regex of a label matcher
+
+    Raises:
+        ValueError: if the regex is invalid
+    """
+    try:
+        return re.compile(regex)
+    except re.error as error:
+        raise ValueError(f"invalid regex {regex!r}: {error}") from error
+
+
+def matches_missing(label_option: Dict) -> bool:
+    """Whether a regex matcher selects the series without the label, whose
+    value is the empty string in PromQL and NULL in the table"""
+    matches = compile_label_regex(label_option["value"]).fullmatch("") is not None
+    return matches != (label_option["op"] == "!~")
+
+
+def get_label_values(configs: Dict, label_name: str) -> List:
+    """Returns the distinct values of a label of the metric table, from the
+    label index
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        label_name (str): the label column
+
+    Returns:
+        List: the values, sorted by their text
+    """
+    return label_index.get_values(
+        configs["DB"],
+        configs["TABLE_NAME"],
+        configs["TIMESTAMP_COLUMN"],
+        label_name,
+        configs["LABEL_INDEX_REFRESH_INTERVAL"],
+    )
+
+
+def get_matcher_value(configs: Dict, label_name: str, label_option: Dict):
+    """Returns the parameter value of a label matcher
+
+    Regexes are anchored for the regex operator of the database, or replaced
+    by the values of the label index which they match for the "in_list"
+    strategy; see get_regex_match_strategy.
+    """
+    if label_option["op"] not in REGEX_OPS:
+        return label_option["value"]
+    if get_regex_match_strategy(configs) == "regex":
+        return anchor_regex(label_option["value"])
+    return label_index.find_values(
+        configs["DB"],
+        configs["TABLE_NAME"],
+        configs["TIMESTAMP_COLUMN"],
+        label_name,
+        compile_label_regex(label_option["value"]),
+        configs["LABEL_INDEX_REFRESH_INTERVAL"],
+    )
 
 
+def get_where_clauses(
+    table: sqlalchemy.sql.expression.TableClause,
+    configs: Dict,
+    labels: Dict,
+    start_datetime: datetime.datetime = None,
+    end_datetime: datetime.datetime = None,
+    unique: bool = True,
+    left_open: bool = False,
+) -> List:
+    """Builds the time range and label matcher conditions of a selector
+
+    All values are bound parameters. With `unique=False` they are named as in
+    get_selector_params, so that the values can be supplied when the
+    statement is executed.
+
+    Regex matchers use the regex operator of the database, or an IN list of
+    the label values they match (see get_matcher_value). As in PromQL, a
+    series without the label matches if the regex matches the empty string.
+
+    Args:
+        table (sqlalchemy.sql.expression.TableClause): table returned by
+            get_metric_table; it must declare every label in labels
+        configs (Dict): the metric configs returned by get_metric_configs
+        labels (Dict): label matchers of the selector
+        start_datetime (datetime.datetime, optional): start of the range
+            (inclusive, unless left_open)
+        end_datetime (datetime.datetime, optional): end of the range
+            (inclusive)
+        unique (bool, optional): whether to give the parameters anonymous
+            names. Defaults to True.
+        left_open (bool, optional): whether to leave out the samples at
+            start_datetime, as the windows of range functions do in PromQL.
+            Defaults to False.
+
+    Raises:
+        NotImplementedError: for unknown label operators
+        ValueError: for invalid regexes
+
+    Returns:
+        List: sqlalchemy conditions to be joined with AND
+    """
+    timestamp = table.c[configs["TIMESTAMP_COLUMN"]]
+    start = sqlalchemy.bindparam(
+        "start_datetime", start_datetime, sqlalchemy.DateTime, unique=unique
+    )
+    end = sqlalchemy.bindparam(
+        "end_datetime", end_datetime, sqlalchemy.DateTime, unique=unique
+    )
+    if left_open:
+        where_clauses = [timestamp > start, timestamp <= end]
+    else:
+        where_clauses = [timestamp.between(start, end)]
+    for index, (label_name, label_option) in enumerate(labels.items()):
+        column = table.c[label_name]
+        op = label_option["op"]
+        if op not in ("=", "!=") + REGEX_OPS:
+            raise NotImplementedError(f"Operator {op} is not implemented!")
+        in_list = op in REGEX_OPS and get_regex_match_strategy(configs) == "in_list"
+        value = sqlalchemy.bindparam(
+            f"label_{index}",
+            get_matcher_value(configs, label_name, label_option) if unique else None,
+            unique=unique,
+            expanding=in_list,
+        )
+        if op == "=":
+            where_clauses.append(column == value)
+        elif op == "!=":
+            where_clauses.append(column != value)
+        else:
+            if in_list:
+                condition = column.not_in(value) if op == "!~" else column.in_(value)
+            else:
+                condition = regex_match(configs, column, value, negate=op == "!~")
+            if matches_missing(label_option):
+                condition = sqlalchemy.or_(condition, column.is_(None))
+            elif in_list and op == "!~":
+                # NOT IN an empty list is true for NULL too
+                condition = sqlalchemy.and_(condition, column.is_not(None))
+            where_clauses.append(condition)
+    return where_clauses
+
+
+def get_selector_params(
+    configs: Dict,
+    labels: Dict,
+    start_datetime: datetime.datetime,
+    end_datetime: datetime.datetime,
+) -> Dict:
+    """Returns the parameter values of a statement from get_selector_statement"""
+    params = {"start_datetime": start_datetime, "end_datetime": end_datetime}
+    for index, (label_name, label_option) in enumerate(labels.items()):
+        params[f"label_{index}"] = get_matcher_value(configs, label_name, label_option)
+    return params
+
+
+def get_selector_statement(
+    configs: Dict,
+    tag_columns: List[str],
+    labels: Dict,
+    latest: bool = False,
+):
+    """Returns the select statement of a selector, with bound parameters
+
+    Statements are cached per engine and keyed by the shape of the selector:
+    the table, the selected columns and the label names and operators. Label
+    values and the time range are parameters (see get_selector_params), so
+    refreshing a query reuses both the statement and sqlalchemy's compiled
+    form of it, and the database sees the same SQL text every time. The
+    cache is shared by the threads which fetch concurrently, under a lock.
+
+    Args:
+        configs (Dict): the metric configs returned by get_metric_configs
+        tag_columns (List[str]): the label columns to select
+        labels (Dict): label matchers of the selector
+        latest (bool, optional): only select the latest sample of each series,
+            see select_latest_samples. Defaults to False.
+
+    Returns:
+        sqlalchemy.sql.expression.Select: the statement
+    """
+    key = (
+        configs["TABLE_NAME"],
+        configs["TIMESTAMP_COLUMN"],
+        configs["VALUE_COLUMN"],
+        tuple(tag_columns),
+        tuple(
+            (name, option["op"], option["op"] in REGEX_OPS and matches_missing(option))
+            for name, option in labels.items()
+        ),
+        get_regex_match_strategy(configs),
+        get_latest_sample_strategy(configs) if latest else None,
+    )
+    with get_selector_statement.lock:
+        statements = get_selector_statement.statements.setdefault(
+            configs["DB"], OrderedDict()
+        )
+        if key in statements:
+            statements.move_to_end(key)
+            return statements[key]
+
+    table = get_metric_table(
+        configs, tag_columns + [l for l in labels if l not in tag_columns]
+    )
+    tags = [table.c[tag] for tag in tag_columns]
+    columns = tags + [
+        table.c[configs["VALUE_COLUMN"]],
+        table.c[configs["TIMESTAMP_COLUMN"]],
+    ]
+    where_clauses = get_where_clauses(table, configs, labels, unique=False)
+    if latest:
+        statement = select_latest_samples(configs, table, tags, columns, where_clauses)
+    else:
+        statement = sqlalchemy.select(*columns).where(*where_clauses)
+    with get_selector_statement.lock:
+        statements[key] = statement
+        if len(statements) > STATEMENT_CACHE_SIZE:
+            statements.popitem(last=False)
+    return statement
+
+
+get_selector_statement.lock = threading.Lock()
+get_selector_statement.statements = weakref.WeakKeyDictionary()
+
+
+@traced_fetch
 def fetch_metric_data(
     metric_name: str,
-    labels=Dict,
+    labels: Dict = None,
     start_datetime: datetime.datetime = None,
     end_datetime: datetime.datetime = None,
     offset: int = 0,
+    tag_columns: List[str] = None,
+    latest: bool = False,
 ):
+    """Fetches the samples of a metric
+
+    Args:
+        metric_name (str): name of the metric
+        labels (Dict, optional): label matchers
+        start_datetime (datetime.datetime, optional): start of the range.
+            Defaults to LOOK_BEHIND_DURATION before end_datetime.
+        end_datetime (datetime.datetime, optional): end of the range.
+            Defaults to now, in UTC.
+        offset (int, optional): seconds to shift the range back. Defaults to 0.
+        tag_columns (List[str], optional): label columns to fetch. Defaults
+            to all tag columns of the metric.
+        latest (bool, optional): only keep the latest sample of each series.
+            It is selected in the database unless LATEST_SAMPLE_STRATEGY is
+            "pandas". Defaults to False.
+
+    The rows are streamed in batches of FETCH_BATCH_SIZE by the backend of
+    FETCH_BACKEND (see backends), and the fetch is aborted with
+    SampleLimitExceeded once it reads more than MAX_SAMPLES samples. Within a
+    query with limits, every batch is also counted against the budget of the
+    query, which aborts the fetch with QueryLimitExceeded (see limits), as are
+    the chunks served from fetch_cache. Range fetches go through fetch_cache
+    in chunks of FETCH_CHUNK_DURATION seconds, so only the most recent chunk
+    is read again when a query is refreshed.
+
+    Returns:
+        pd.DataFrame: one column per label, plus VAL_COL and TIME_COL
+    """
+    labels = labels or dict()
     configs = get_metric_configs(
         {
             "metric_name": metric_name,
@@ -77,7 +419,7 @@ def fetch_metric_data(
         }
     )
     if end_datetime is None:
-        end_datetime = datetime.datetime.now()
+        end_datetime = utc_now()
     if start_datetime is None:
         start_datetime = end_datetime - datetime.timedelta(
             seconds=configs["LOOK_BEHIND_DURATION"]
@@ -86,46 +428,52 @@ def fetch_metric_data(
     start_datetime = start_datetime - datetime.timedelta(seconds=offset)
     end_datetime = end_datetime - datetime.timedelta(seconds=offset)
 
-    where_clauses = []
-    where_clauses.append(
-        "{TIMESTAMP_COLUMN} in('%sZ', '%sZ')"
-        % (start_datetime.isoformat(), end_datetime.isoformat())
-    )
-    for label_name, label_option in labels.items():
-        if label_option["op"] == "=":
-            op = "="
-        elif label_option["op"] == "!=":
-            op = "<>"
-        else:
-            raise NotImplementedError(
-                f"Operator {label_option['op']} is not implemented!"
-            )
-        value = (
-            f"'{label_option['value']}'"
-            if isinstance(label_option["value"], str)
-            else label_option["value"]
+    if tag_columns is None:
+        tag_columns = get_tag_columns(configs)
+    pushdown_latest = latest and get_latest_sample_strategy(configs) != "pandas"
+    sql_query = get_selector_statement(configs, tag_columns, labels, pushdown_latest)
+
+    budget = current_budget()
+    on_batch, on_cached = None, None
+    if budget is not None:
+        source = (configs["DB"], configs["TABLE_NAME"])
+        on_batch = functools.partial(budget.add, source)
+        on_cached = functools.partial(budget.add_frame, source, tag_columns=tag_columns)
+
+    backend = get_fetch_backend(configs)
+
+    def read(start_datetime, end_datetime):
+        return backend.read(
+            configs["DB"],
+            sql_query,
+            get_selector_params(configs, labels, start_datetime, end_datetime),
+            tag_columns,
+            configs["VALUE_COLUMN"],
+            configs["TIMESTAMP_COLUMN"],
+            batch_size=configs["FETCH_BATCH_SIZE"],
+            max_samples=configs["MAX_SAMPLES"],
+            on_batch=on_batch,
         )
-        where_clauses.append(f"{label_name}{op}{value}")
-    where_clause = (
-        "WHERE " + " AND ".join(where_clauses) if len(where_clauses) > 0 else ""
-    )
-    sql_query = (
-        """
-        SELECT *
-        FROM '{TABLE_NAME}'
-    """
-        + where_clause
-    ).format(**configs)
-    df = pd.read_sql(
-        sql_query, configs["DB"], parse_dates=[configs["TIMESTAMP_COLUMN"]]
-    ).rename(
-        columns={
-            configs["VALUE_COLUMN"]: VAL_COL,
-            configs["TIMESTAMP_COLUMN"]: TIME_COL,
-        }
-    )
-    if configs["TAG_COLUMNS"] is not None:
-        df = df[configs["TAG_COLUMNS"] + [VAL_COL, TIME_COL]]
-    print(df.count())
-    print(sql_query)
+
+    chunk_duration = configs["FETCH_CHUNK_DURATION"]
+    if latest or not chunk_duration:
+        df = read(start_datetime, end_datetime)
+    else:
+        key = (
+            configs["DB"],
+            configs["TABLE_NAME"],
+            configs["TIMESTAMP_COLUMN"],
+            configs["VALUE_COLUMN"],
+            tuple(tag_columns),
+            tuple(
+                (name, option["op"], option["value"]) for name, option in labels.items()
+            ),
+        )
+        df = fetch_cache.fetch(
+            key, start_datetime, end_datetime, chunk_duration, read, on_cached
+        )
+    if latest and not pushdown_latest:
+        df = latest_samples(df)
+    if is_enabled():
+        record(sql=str(sql_query), latest=latest)
     return df
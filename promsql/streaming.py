@@ -0,0 +1,336 @@
+"""Streams query results into per-series arrays or typed column buffers"""
+
+import datetime
+import itertools
+import re
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from promsql.constants import TIME_COL, VAL_COL
+from promsql.limits import SampleLimitExceeded
+
+# number of rows fetched from the cursor at a time
+DEFAULT_BATCH_SIZE = 10000
+
+# the end of a timestamp in text with a UTC offset, e.g. "+02:00" or "Z"
+TIMEZONE_SUFFIX = re.compile(r"(?:Z|[+-]\d\d(?::?\d\d)?)$")
+
+
+class SeriesArrays:
+    """Accumulates samples in typed arrays, one pair of arrays per series
+
+    The values are kept as float64 and the timestamps as int64 nanoseconds,
+    so a sample takes 16 bytes however it was read; the labels are stored
+    once per series.
+
+    Args:
+        tag_columns (List[str]): names of the label columns
+    """
+
+    def __init__(self, tag_columns: List[str]):
+        self.tag_columns = tag_columns
+        self.series_index = dict()
+        self.values = []
+        self.times = []
+        self.samples = 0
+        self.tz = None
+
+    def __len__(self) -> int:
+        return self.samples
+
+    def append(self, tags: Sequence[Sequence], values: np.ndarray, times: np.ndarray):
+        """Adds a batch of samples
+
+        Args:
+            tags (Sequence[Sequence]): one sequence per tag column with the
+                label values of the samples
+            values (np.ndarray): float64 values of the samples
+            times (np.ndarray): int64 nanosecond timestamps of the samples
+        """
+        if len(values) == 0:
+            return
+        index = self.series_index
+        keys = zip(*tags) if tags else [()] * len(values)
+        codes = np.fromiter(
+            (index.setdefault(key, len(index)) for key in keys),
+            dtype=np.intp,
+            count=len(values),
+        )
+        for _ in range(len(index) - len(self.values)):
+            self.values.append([])
+            self.times.append([])
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        bounds = np.flatnonzero(np.diff(codes)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(codes)]))
+        for start, end in zip(starts, ends):
+            selected = order[start:end]
+            self.values[codes[start]].append(values[selected])
+            self.times[codes[start]].append(times[selected])
+        self.samples += len(values)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Returns the samples in the long format, grouped by series
+
+        The tag columns are categorical with NULL as a missing value, as
+        ColumnBuffers.to_frame returns them, whatever the type of the
+        column.
+        """
+        lengths = np.array(
+            [sum(len(v) for v in values) for values in self.values], dtype=np.int64
+        )
+        columns = dict()
+        keys = list(self.series_index)
+        for position, tag in enumerate(self.tag_columns):
+            labels = np.empty(len(keys), dtype=object)
+            labels[:] = [key[position] for key in keys]
+            codes, categories = pd.factorize(labels)
+            columns[tag] = pd.Categorical.from_codes(
+                np.repeat(codes, lengths),
+                categories=pd.Index(categories, dtype=object),
+                validate=False,
+            )
+        columns[VAL_COL] = np.concatenate(
+            [np.concatenate(values) for values in self.values] or [np.empty(0)]
+        )
+        times = np.concatenate(
+            [np.concatenate(times) for times in self.times]
+            or [np.empty(0, dtype=np.int64)]
+        )
+        columns[TIME_COL] = pd.to_datetime(times, unit="ns")
+        df = pd.DataFrame(columns)
+        if self.tz is not None:
+            df[TIME_COL] = df[TIME_COL].dt.tz_localize("UTC").dt.tz_convert(self.tz)
+        return df
+
+
+def to_nanoseconds(times: Sequence) -> Tuple[np.ndarray, object]:
+    """Converts timestamps read from the database to int64 nanoseconds
+
+    Returns:
+        Tuple[np.ndarray, object]: the nanoseconds since the epoch in UTC
+            and the timezone of the timestamps, None if they are naive
+    """
+    index = pd.DatetimeIndex(pd.to_datetime(list(times))).as_unit("ns")
+    if index.tz is not None:
+        return index.tz_convert(None).asi8, index.tz
+    return index.asi8, None
+
+
+def decode_times(times: Sequence) -> Tuple[np.ndarray, object]:
+    """Converts a column of timestamps to int64 nanoseconds like
+    to_nanoseconds, but parses naive timestamps, and their ISO text as
+    SQLite returns it, in a single numpy call"""
+    first = times[0] if len(times) else None
+    naive = (isinstance(first, str) and not TIMEZONE_SUFFIX.search(first)) or (
+        isinstance(first, datetime.datetime) and first.tzinfo is None
+    )
+    if naive:
+        try:
+            return np.asarray(times, dtype="datetime64[ns]").view(np.int64), None
+        except (TypeError, ValueError):
+            pass
+    return to_nanoseconds(times)
+
+
+class ColumnBuffers:
+    """Accumulates samples in typed column buffers, batch by batch
+
+    Each tag column is dictionary encoded: its distinct values are kept once
+    and every sample holds an int32 code into them, -1 for NULL. The values
+    are kept as float64 and the timestamps as int64 nanoseconds. to_frame
+    hands the buffers to pandas as categorical, float and datetime columns
+    without going through Python objects, and SeriesSet.from_frame reads the
+    codes of the categorical columns as they are.
+
+    Args:
+        tag_columns (List[str]): names of the label columns
+    """
+
+    def __init__(self, tag_columns: List[str]):
+        self.tag_columns = tag_columns
+        self.dictionaries = [dict() for _ in tag_columns]
+        self.categories = [[] for _ in tag_columns]
+        self.codes = [[] for _ in tag_columns]
+        self.values = []
+        self.times = []
+        self.samples = 0
+        self.series = set()
+        self.tz = None
+
+    def __len__(self) -> int:
+        return self.samples
+
+    def encode(self, position: int, codes: np.ndarray, uniques: Sequence):
+        """Maps the codes of a batch into the dictionary of a tag column
+
+        Args:
+            position (int): the position of the tag column
+            codes (np.ndarray): the position of the value of each sample in
+                uniques, negative for NULL
+            uniques (Sequence): the distinct values of the batch
+
+        Returns:
+            np.ndarray: int32 codes into the dictionary, -1 for NULL
+        """
+        dictionary = self.dictionaries[position]
+        categories = self.categories[position]
+        mapping = np.empty(len(uniques) + 1, dtype=np.int32)
+        for index, value in enumerate(uniques):
+            code = dictionary.get(value)
+            if code is None:
+                code = dictionary[value] = len(categories)
+                categories.append(value)
+            mapping[index] = code
+        # NULL, -1, takes the last entry
+        mapping[-1] = -1
+        return mapping[np.where(codes < 0, -1, codes)]
+
+    def append(
+        self,
+        tags: Sequence[Tuple[np.ndarray, Sequence]],
+        values: np.ndarray,
+        times: np.ndarray,
+    ) -> List[np.ndarray]:
+        """Adds a batch of samples
+
+        Args:
+            tags (Sequence[Tuple[np.ndarray, Sequence]]): for each tag
+                column, the codes of the samples and the distinct values of
+                the batch, like pd.factorize returns them
+            values (np.ndarray): float64 values of the samples
+            times (np.ndarray): int64 nanosecond timestamps of the samples
+
+        Returns:
+            List[np.ndarray]: the codes of the samples in the dictionaries
+        """
+        codes = [
+            self.encode(position, *batch_codes)
+            for position, batch_codes in enumerate(tags)
+        ]
+        for buffer, batch_codes in zip(self.codes, codes):
+            buffer.append(batch_codes)
+        self.values.append(values)
+        self.times.append(times)
+        self.samples += len(values)
+        return codes
+
+    def new_series(self, codes: List[np.ndarray], samples: int) -> List[Tuple]:
+        """Returns the label values of the series of a batch which no
+        earlier batch had, given the codes append returned"""
+        if not samples:
+            return []
+        if codes:
+            keys = map(tuple, np.unique(np.stack(codes, axis=1), axis=0).tolist())
+        else:
+            keys = [()]
+        added = []
+        for key in keys:
+            if key not in self.series:
+                self.series.add(key)
+                added.append(
+                    tuple(
+                        None if code < 0 else categories[code]
+                        for code, categories in zip(key, self.categories)
+                    )
+                )
+        return added
+
+    def to_frame(self) -> pd.DataFrame:
+        """Returns the samples in the long format, in the order they were
+        read"""
+        columns = dict()
+        for tag, categories, codes in zip(
+            self.tag_columns, self.categories, self.codes
+        ):
+            columns[tag] = pd.Categorical.from_codes(
+                np.concatenate(codes) if codes else np.empty(0, dtype=np.int32),
+                categories=pd.Index(categories, dtype=object),
+                validate=False,
+            )
+        columns[VAL_COL] = np.concatenate(self.values) if self.values else np.empty(0)
+        times = (
+            np.concatenate(self.times) if self.times else np.empty(0, dtype=np.int64)
+        )
+        columns[TIME_COL] = times.view("datetime64[ns]")
+        df = pd.DataFrame(columns)
+        if self.tz is not None:
+            df[TIME_COL] = df[TIME_COL].dt.tz_localize("UTC").dt.tz_convert(self.tz)
+        return df
+
+
+def stream_select(
+    engine: sqlalchemy.engine.Engine,
+    statement,
+    params: Dict,
+    tag_columns: List[str],
+    value_column: str,
+    timestamp_column: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_samples: int = None,
+    on_batch: Callable[[List[Tuple], int], None] = None,
+) -> pd.DataFrame:
+    """Runs a selector statement and collects its rows batch by batch
+
+    The rows are fetched through a server-side cursor where the driver
+    supports one, `batch_size` rows at a time, and each batch is moved into a
+    SeriesArrays before the next one is fetched. Only one batch of row tuples
+    is alive at any time, so the peak memory is close to the size of the
+    result rather than a multiple of it.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): the engine of the database
+        statement: the select statement
+        params (Dict): the parameters of the statement
+        tag_columns (List[str]): the label columns selected by the statement
+        value_column (str): the column holding the values
+        timestamp_column (str): the column holding the timestamps
+        batch_size (int, optional): rows per batch. Defaults to
+            DEFAULT_BATCH_SIZE.
+        max_samples (int, optional): abort once more samples than this are
+            read. Defaults to no limit.
+        on_batch (Callable[[List[Tuple], int], None], optional): called after
+            each batch with the label values of the series it added and its
+            number of samples, e.g. QueryBudget.add; an exception it raises
+            aborts the fetch. Defaults to None.
+
+    Raises:
+        SampleLimitExceeded: when more than max_samples samples are read; the
+            cursor is closed before this or an exception of on_batch
+            propagates
+
+    Returns:
+        pd.DataFrame: one column per label, plus VAL_COL and TIME_COL
+    """
+    series = SeriesArrays(tag_columns)
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=batch_size).execute(
+            statement, params
+        )
+        with result:
+            names = list(result.keys())
+            tag_positions = [names.index(tag) for tag in tag_columns]
+            value_position = names.index(value_column)
+            time_position = names.index(timestamp_column)
+            for rows in result.partitions():
+                if max_samples is not None and len(series) + len(rows) > max_samples:
+                    raise SampleLimitExceeded(max_samples, len(series) + len(rows))
+                columns = list(zip(*rows))
+                times, tz = to_nanoseconds(columns[time_position])
+                series.tz = series.tz or tz
+                known = len(series.series_index)
+                series.append(
+                    [columns[position] for position in tag_positions],
+                    np.asarray(columns[value_position], dtype=np.float64),
+                    times,
+                )
+                if on_batch is not None:
+                    on_batch(
+                        list(itertools.islice(series.series_index, known, None)),
+                        len(rows),
+                    )
+    return series.to_frame()
@@ -0,0 +1,221 @@
+"""Records what the stages of a query do and how long they take
+
+Tracing is off unless a hook is registered with add_hook or a query runs
+inside collect, and then costs one check per node. When it is on, every node
+evaluation, fetch and planning stage opens a Span, nested in the span which
+was open when it started, with its wall time and what it produced: rows
+fetched, series, samples, bytes, the generated SQL and fetch cache hits.
+
+    with collect() as root:
+        query("sum(rate(cpu[5m]))")
+    print(root.format())
+
+Hooks are called with every span once it is finished, e.g. to export them:
+
+    add_hook(lambda span: print(span.name, span.duration))
+"""
+
+import contextlib
+import contextvars
+import functools
+import time
+from typing import Callable, Dict, Iterator, Optional
+
+import pandas as pd
+
+from promsql.series import SeriesSet
+
+_current = contextvars.ContextVar("promsql_span", default=None)
+_hooks = []
+
+
+class Span:
+    """A stage of a query, with the spans of the stages it ran
+
+    Args:
+        name (str): what ran, e.g. "fetch" or a node description
+        attributes (Dict): what it read and produced; see record
+    """
+
+    def __init__(self, name: str, attributes: Dict = None):
+        self.name = name
+        self.attributes = dict(attributes or ())
+        self.children = []
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def record(self, **attributes):
+        """Sets attributes of the span; numbers are added to the previous
+        value, e.g. the rows of several reads"""
+        for name, value in attributes.items():
+            previous = self.attributes.get(name)
+            if isinstance(value, (int, float)) and isinstance(previous, (int, float)):
+                value = previous + value
+            self.attributes[name] = value
+
+    def record_result(self, result):
+        """Records the size of what a stage returned"""
+        if isinstance(result, SeriesSet):
+            self.record(
+                series=len(result.labels),
+                samples=len(result.times),
+                bytes=sum(result.memory_usage().values()),
+            )
+        elif isinstance(result, pd.DataFrame):
+            self.record(
+                rows=len(result), bytes=int(result.memory_usage(deep=True).sum())
+            )
+
+    def walk(self) -> Iterator["Span"]:
+        """Yields this span and all the spans below it, depth first"""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def format(self, indent: int = 0) -> str:
+        """Returns the tree of spans, one line per span, like EXPLAIN ANALYZE"""
+        duration = (
+            "running" if self.duration is None else f"{self.duration * 1000:.3f} ms"
+        )
+        attributes = "".join(
+            f" {name}={value}"
+            for name, value in self.attributes.items()
+            if name != "sql"
+        )
+        prefix = "  " * indent + ("-> " if indent else "")
+        lines = [f"{prefix}{self.name}  (time={duration}{attributes})"]
+        if "sql" in self.attributes:
+            sql = " ".join(str(self.attributes["sql"]).split())
+            lines.append("  " * (indent + 2) + f"SQL: {sql}")
+        lines.extend(child.format(indent + 1) for child in self.children)
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.format()
+
+
+def add_hook(hook: Callable[[Span], None]):
+    """Calls hook with every span once it is finished, from any thread"""
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[Span], None]):
+    _hooks.remove(hook)
+
+
+def is_enabled() -> bool:
+    return bool(_hooks) or _current.get() is not None
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def record(**attributes):
+    """Records attributes on the current span, if there is one"""
+    span = _current.get()
+    if span is not None:
+        span.record(**attributes)
+
+
+@contextlib.contextmanager
+def _open(span: Span, parent: Optional[Span]):
+    if parent is not None:
+        parent.children.append(span)
+    token = _current.set(span)
+    try:
+        yield span
+    finally:
+        span.duration = time.perf_counter() - span.start
+        _current.reset(token)
+        for hook in list(_hooks):
+            hook(span)
+
+
+@contextlib.contextmanager
+def trace(name: str, **attributes):
+    """Runs the body in a span, if tracing is on; yields the span or None"""
+    parent = _current.get()
+    if parent is None and not _hooks:
+        yield None
+        return
+    with _open(Span(name, attributes), parent) as span:
+        yield span
+
+
+@contextlib.contextmanager
+def collect(name: str = "query"):
+    """Traces the body, whether hooks are registered or not, and yields the
+    root span"""
+    with _open(Span(name), _current.get()) as span:
+        yield span
+
+
+def describe_node(node) -> str:
+    """Returns a one line description of a node, without its children"""
+    details = [
+        str(value)
+        for value in (
+            getattr(node, "aggregate_op", None),
+            getattr(node, "op", None),
+            getattr(node, "name", None),
+        )
+        if value is not None
+    ]
+    matchers = getattr(node, "label_matchers", None)
+    if matchers:
+        details.append(
+            "{"
+            + ",".join(
+                f'{name}{option["op"]}"{option["value"]}"'
+                for name, option in matchers.items()
+            )
+            + "}"
+        )
+    time_range = getattr(node, "range", None)
+    if getattr(time_range, "duration", None) is not None:
+        details.append(f"[{time_range.duration}s]")
+    if getattr(node, "step", None):
+        details.append(f"step={node.step}s")
+    if getattr(node, "offset", None):
+        details.append(f"offset {node.offset}s")
+    return f"{type(node).__name__}({', '.join(details)})"
+
+
+def traced(method: Callable) -> Callable:
+    """Wraps the eval method of a node in a span, when tracing is on"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        parent = _current.get()
+        if parent is None and not _hooks:
+            return method(self, *args, **kwargs)
+        with _open(Span(describe_node(self)), parent) as span:
+            result = method(self, *args, **kwargs)
+            span.record_result(result)
+            return result
+
+    return wrapper
+
+
+def traced_fetch(function: Callable) -> Callable:
+    """Wraps a fetch of a metric in a span, when tracing is on"""
+
+    @functools.wraps(function)
+    def wrapper(metric_name: str, *args, **kwargs):
+        parent = _current.get()
+        if parent is None and not _hooks:
+            return function(metric_name, *args, **kwargs)
+        with _open(Span(f"fetch {metric_name}"), parent) as span:
+            result = function(metric_name, *args, **kwargs)
+            span.record_result(result)
+            return result
+
+    return wrapper
+
+
+def propagate(function: Callable) -> Callable:
+    """Binds function to the current span, for running it on another thread"""
+    if not is_enabled():
+        return function
+    return functools.partial(contextvars.copy_context().run, function)
@@ -1,12 +1,18 @@
 import datetime
 import dateparser
-from lark import Transformer
+from lark import Token, Transformer
 
+from .clock import utc_now
 from .nodes import *
+from .series import SeriesSet
 
 
 def get_vector_name(metric_name, label_matchers):
-    if "__name__" in label_matchers:
+    # other __name__ matchers stay, the planner expands them to the metrics
+    # of the catalog which match
+    if "__name__" in label_matchers and (
+        metric_name is not None or label_matchers["__name__"]["op"] == "="
+    ):
         metric_name = metric_name or label_matchers["__name__"]["value"]
         del label_matchers["__name__"]
     return metric_name, label_matchers
@@ -42,11 +48,29 @@ def duration_literal_to_seconds(duration_literal: str) -> int:
 
 
 class PromSqlTransformer(Transformer):
+    """Builds the node tree of a parsed query and evaluates it
+
+    Args:
+        evaluate (bool, optional): whether to evaluate the query at the
+            current time; if False the node tree is returned, e.g. for
+            query_range. Defaults to True.
+        visit_tokens (bool, optional): passed to lark. Defaults to True.
+    """
+
+    def __init__(self, evaluate: bool = True, visit_tokens: bool = True):
+        super().__init__(visit_tokens)
+        self.evaluate = evaluate
+
     def start(self, items):
-        if items[0] is None:
+        if len(items) == 0 or items[0] is None:
             return "no expression found in input"
-        if isinstance(items[0], ExecutableExpr):
-            return items[0].eval()
+        if isinstance(items[0], ExecutableExpr) and self.evaluate:
+            # imported here as query imports this module to parse queries
+            from .query import evaluate_instant
+
+            result = evaluate_instant(items[0], utc_now())
+            # series sets are internal, results are returned as DataFrames
+            return result.to_frame() if isinstance(result, SeriesSet) else result
         return items[0]
 
     def expr(self, items):
@@ -168,10 +192,10 @@ class PromSqlTransformer(Transformer):
             )
             result.name = metric_name
             result.label_matchers = label_matchers
-        elif isinstance(items[0], dict):
+        elif isinstance(items[0], VectorSelector):
             result = items[0]
             metric_name, label_matchers = get_vector_name(None, result.label_matchers)
-            if metric_name is None:
+            if metric_name is None and "__name__" not in label_matchers:
                 return None
             result.name = metric_name
             result.label_matchers = label_matchers
@@ -194,45 +218,14 @@ class PromSqlTransformer(Transformer):
     def label_matcher(self, items):
         return {str(items[0]): {"value": items[2], "op": str(items[1])}}
 
-    def metric(self, items):
-        if len(items) == 2:
-            result = items[1]
-            result.update({"__name__": {"value": str(items[0]), "op": "="}})
-        else:
-            result = items[0]
-        metric_name, label_matchers = get_vector_name(None, result)
-        if metric_name is None:
-            return None
-        result = VectorSelector(name=metric_name, label_matchers=label_matchers)
-        return result
-
     def metric_identifier(self, items):
         return str(items[0])
 
-    def label_set(self, items):
-        if len(items) >= 3:
-            return items[1]
-        return {}
-
-    def label_set_list(self, items):
-        result = items[0]
-        if len(items) == 3:
-            result.update(items[2])
-        return result
-
-    def label_set_item(self, items):
-        return {str(items[0]): {"value": items[2], "op": "="}}
-
     def series_description(self, items):
         return SeriesDescription(labels=items[0], values=items[1])
 
     def series_values(self, items):
-        if len(items) == 0:
-            return []
-        result = items[0]
-        if len(items) == 3:
-            result.append(items[2])
-        return result
+        return [value for series_item in items for value in series_item]
 
     def series_item(self, items):
         if len(items) == 1 and items[0] == "_":
@@ -241,7 +234,7 @@ class PromSqlTransformer(Transformer):
             result = []
             for _ in range(items[2]):
                 result.append(SequenceValue(omitted=True))
-        elif len(items) == 0:
+        elif len(items) == 1:
             result = [SequenceValue(value=items[0])]
         elif len(items) == 3:
             result = []
@@ -306,6 +299,11 @@ class PromSqlTransformer(Transformer):
             start_time=dateparser.parse(str(items[0])),
             end_time=dateparser.parse(items[2])
             if len(items) == 3
-            else datetime.datetime.now(),
+            else utc_now(),
         )
+        if isinstance(items[0], Token) and items[0].type == "DURATION":
+            result.duration = duration_literal_to_seconds(str(items[0]))
+            result.start_time = result.end_time - datetime.timedelta(
+                seconds=result.duration
+            )
         return result
@@ -28,7 +28,7 @@ setup(
 #   install_requires=[
 #       'dependency==1.2.3',
 #   ],
-    scripts=['bin/promsql-cli.py'],
+    scripts=['bin/promsql-cli.py', 'bin/promsql-server.py'],
     include_package_data=True,
     classifiers=[
         "Development Status :: 4 - Beta",
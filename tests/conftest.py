@@ -0,0 +1,108 @@
+"""Fixtures: a SQLite database of small metrics in the layout of the default
+configs, and configs pointing at it"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+
+import promsql.constants as constants
+from promsql.catalog import label_index, schema_catalog
+from promsql.cost import get_table_statistics
+from promsql.fetch_cache import fetch_cache
+from promsql.results_cache import results_cache
+from promsql.sql_miscs import get_selector_statement, metric_catalog
+
+# the last sample of every series
+END = datetime.datetime(2026, 1, 1, 12, 0, 0)
+# seconds between two samples of a series
+INTERVAL = 15
+SAMPLES = 480
+HOSTS = ["a", "b", "c"]
+
+
+def sample_times() -> pd.DatetimeIndex:
+    return pd.date_range(end=END, periods=SAMPLES, freq=f"{INTERVAL}s")
+
+
+def metric_frames():
+    """Returns the rows of each metric table
+
+    - `counter`: increases by 1 per sample for hosts a and c and by 2 for
+      host b, so its rate and deriv are exactly 1/15 and 2/15
+    - `gauge`: values between 0 and 49, including zeros
+    - `status`: an integer `code` label which is NULL for one series
+    """
+    times = sample_times()
+    steps = np.arange(SAMPLES)
+    counters, gauges = [], []
+    for index, host in enumerate(HOSTS):
+        labels = {"host": host, "job": "api", "created": times}
+        slope = 2 if host == "b" else 1
+        counters.append(
+            pd.DataFrame({**labels, "origin": 100.0 * index + slope * steps})
+        )
+        gauges.append(
+            pd.DataFrame({**labels, "origin": ((steps * 7 + index * 13) % 50) * 1.0})
+        )
+    status = []
+    for index, code in enumerate([200, 500, None]):
+        status.append(
+            pd.DataFrame(
+                {
+                    "created": times,
+                    "origin": 1.0 * index,
+                    "host": "a",
+                    "code": pd.array([code] * SAMPLES, dtype="Int64"),
+                }
+            )
+        )
+    return {
+        "counter": pd.concat(counters, ignore_index=True),
+        "gauge": pd.concat(gauges, ignore_index=True),
+        "status": pd.concat(status, ignore_index=True),
+    }
+
+
+@pytest.fixture(scope="session")
+def database(tmp_path_factory) -> str:
+    """The url of a SQLite database holding metric_frames"""
+    url = f"sqlite:///{tmp_path_factory.mktemp('promsql') / 'metrics.db'}"
+    engine = sqlalchemy.create_engine(url)
+    for name, df in metric_frames().items():
+        df.to_sql(name, engine, index=False)
+    engine.dispose()
+    return url
+
+
+@pytest.fixture
+def end() -> datetime.datetime:
+    """The time of the last sample of every series"""
+    return END
+
+
+def clear_caches():
+    fetch_cache.clear()
+    results_cache.clear()
+    schema_catalog.invalidate()
+    label_index.invalidate()
+    get_table_statistics.statistics.clear()
+    get_selector_statement.statements.clear()
+    metric_catalog.reload()
+
+
+@pytest.fixture
+def configs(database, monkeypatch):
+    """Points the default configs at the database; tests may change them"""
+    for name, value in {
+        "DB": database,
+        "DIALECT": None,
+        "TIMESTAMP_COLUMN": "created",
+        "VALUE_COLUMN": "origin",
+    }.items():
+        monkeypatch.setitem(constants.DEFAULT_CONFIGS, name, value)
+    clear_caches()
+    yield constants.DEFAULT_CONFIGS
+    clear_caches()
@@ -0,0 +1,134 @@
+"""topk, bottomk, quantile and count_values give the results of sorting the
+samples of each group at each step, whether their groups are sampled or not"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from promsql.aggregations import SAMPLE_ROWS, aggregate
+from promsql.query import query, query_range
+from promsql.series import LabelSet, SeriesSet
+
+STEPS = 12
+
+
+def random_vector(rows: int, ties: bool, seed: int = 0) -> SeriesSet:
+    """A vector of rows series over STEPS steps, a tenth of whose samples
+    are missing; with ties, the values are small integers"""
+    rng = np.random.default_rng(seed)
+    steps = np.arange(STEPS, dtype=np.int64) * 60 * 10**9
+    present = rng.random((rows, STEPS)) > 0.1
+    if ties:
+        values = rng.integers(0, 20, (rows, STEPS)).astype(np.float64)
+    else:
+        values = rng.normal(size=(rows, STEPS))
+    series, at = np.nonzero(present)
+    labels = [
+        LabelSet.intern({"job": f"j{index % 3}", "host": f"h{index}"})
+        for index in range(rows)
+    ]
+    return SeriesSet.from_samples(labels, series, steps[at], values[series, at])
+
+
+def groups_of(vector: SeriesSet, grouping):
+    df = vector.to_frame()
+    return df, df.groupby(grouping + ["__time__"])["__value__"]
+
+
+# one group above SAMPLE_ROWS series, and groups above and below it
+CASES = [(50, ["job"]), (SAMPLE_ROWS * 2, []), (SAMPLE_ROWS * 4, ["job"])]
+
+
+@pytest.mark.parametrize("rows, grouping", CASES)
+@pytest.mark.parametrize("ties", [False, True])
+@pytest.mark.parametrize("op", ["topk", "bottomk"])
+@pytest.mark.parametrize("k", [1, 5])
+def test_topk(rows, grouping, ties, op, k):
+    vector = random_vector(rows, ties)
+    df, groups = groups_of(vector, grouping)
+    result = aggregate(op, vector, grouping, param=k).to_frame()
+    # the selected samples are samples of the vector...
+    merged = result.merge(df, on=["host", "job", "__time__"], suffixes=("", "_in"))
+    assert len(merged) == len(result)
+    np.testing.assert_array_equal(merged["__value__"], merged["__value___in"])
+    # ...with the k largest (smallest) values of their group, ties aside
+    ascending = op == "bottomk"
+    expected = groups.apply(
+        lambda values: np.sort(values.to_numpy())[:: 1 if ascending else -1][:k]
+    )
+    selected = result.groupby(grouping + ["__time__"])["__value__"].apply(
+        lambda values: np.sort(values.to_numpy())[:: 1 if ascending else -1]
+    )
+    assert list(selected.index) == list(expected.index)
+    for key in expected.index:
+        np.testing.assert_array_equal(selected[key], expected[key])
+
+
+@pytest.mark.parametrize("rows, grouping", CASES)
+@pytest.mark.parametrize("ties", [False, True])
+@pytest.mark.parametrize("phi", [0.0, 0.1, 0.5, 0.9, 0.99, 1.0])
+def test_quantile(rows, grouping, ties, phi):
+    vector = random_vector(rows, ties)
+    _, groups = groups_of(vector, grouping)
+    expected = groups.quantile(phi).reset_index()
+    result = aggregate("quantile", vector, grouping, param=phi).to_frame()
+    result = result.sort_values(grouping + ["__time__"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(
+        result[grouping + ["__time__"]], expected[grouping + ["__time__"]]
+    )
+    np.testing.assert_allclose(result["__value__"], expected["__value__"], rtol=1e-12)
+
+
+def test_quantile_out_of_range():
+    # like Prometheus, -Inf below 0 and +Inf above 1
+    vector = random_vector(10, False)
+    assert (aggregate("quantile", vector, [], param=-0.5).values == -np.inf).all()
+    assert (aggregate("quantile", vector, [], param=1.5).values == np.inf).all()
+
+
+@pytest.mark.parametrize("rows, grouping", CASES[:2])
+def test_count_values(rows, grouping):
+    vector = random_vector(rows, True)
+    df, _ = groups_of(vector, grouping)
+    df["value"] = df["__value__"].map(lambda value: str(int(value)))
+    expected = df.groupby(grouping + ["value", "__time__"]).size().reset_index()
+    result = aggregate("count_values", vector, grouping, param="value").to_frame()
+    columns = grouping + ["value", "__time__"]
+    result = result.sort_values(columns).reset_index(drop=True)
+    pd.testing.assert_frame_equal(
+        result[columns], expected[columns], check_column_type=False
+    )
+    np.testing.assert_array_equal(result["__value__"], expected[0])
+
+
+@pytest.mark.parametrize(
+    "q",
+    [
+        "topk(2, gauge)",
+        "bottomk(1, gauge) by (job)",
+        "quantile(0.3, gauge)",
+        "quantile by (job) (0.75, rate(counter[2m]))",
+        'count_values("value", gauge)',
+    ],
+)
+def test_range_and_instant(configs, end, q):
+    start = end - datetime.timedelta(minutes=4)
+    ranged = query_range(q, start, end, 60)
+    assert len(ranged)
+    for index in range(5):
+        time = start + datetime.timedelta(minutes=index)
+        instant = query(q, time)
+        expected = ranged[ranged["__time__"] == time]
+        columns = [c for c in ["host", "job", "value"] if c in instant]
+        instant = instant.sort_values(columns + ["__value__"])
+        expected = expected.sort_values(columns + ["__value__"])
+        assert len(instant) == len(expected), (q, time)
+        np.testing.assert_allclose(
+            instant["__value__"], expected["__value__"], rtol=1e-12, err_msg=q
+        )
+        pd.testing.assert_frame_equal(
+            instant[columns].reset_index(drop=True),
+            expected[columns].reset_index(drop=True),
+        )
@@ -0,0 +1,108 @@
+"""The fetch backends read the same frames and give the same results"""
+
+import datetime
+
+import pandas as pd
+import pytest
+import sqlalchemy
+
+from promsql import limits
+from promsql.backends import FETCH_BACKENDS, get_fetch_backend
+from promsql.fetch_cache import fetch_cache
+from promsql.limits import QueryBudget, QueryLimits
+from promsql.query import query, query_range
+from promsql.sql_miscs import fetch_metric_data, metric_catalog
+
+BACKENDS = sorted(FETCH_BACKENDS)
+
+
+def configure(configs, monkeypatch, **items):
+    """Changes the configs of the metrics, which the catalog compiled"""
+    for name, value in items.items():
+        monkeypatch.setitem(configs, name, value)
+    metric_catalog.reload()
+    fetch_cache.clear()
+
+
+def fetch(name, end):
+    df = fetch_metric_data(
+        name, start_datetime=end - datetime.timedelta(minutes=30), end_datetime=end
+    )
+    columns = sorted(df.columns)
+    return df[columns].sort_values(columns[:-1]).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("chunk_duration", [None, 600])
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("name", ["counter", "gauge", "status"])
+def test_same_frames(configs, end, monkeypatch, backend, name, chunk_duration):
+    configure(
+        configs,
+        monkeypatch,
+        FETCH_BACKEND="pandas",
+        FETCH_CHUNK_DURATION=chunk_duration,
+    )
+    expected = fetch(name, end)
+    configure(configs, monkeypatch, FETCH_BACKEND=backend)
+    df = fetch(name, end)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_null_labels(configs, end, monkeypatch):
+    for backend in BACKENDS:
+        configure(configs, monkeypatch, FETCH_BACKEND=backend)
+        codes = fetch("status", end)["code"]
+        assert isinstance(codes.dtype, pd.CategoricalDtype), backend
+        assert list(codes.cat.categories) == [200, 500], backend
+        assert codes.isna().sum() == 121, backend
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_same_budget_for_cached_chunks(configs, end, monkeypatch, backend):
+    configure(configs, monkeypatch, FETCH_BACKEND=backend)
+    budgets = []
+    for _ in range(2):
+        budget = QueryBudget(QueryLimits(max_series=100))
+        with limits.enforce(budget):
+            fetch_metric_data(
+                "status",
+                start_datetime=end - datetime.timedelta(hours=1),
+                end_datetime=end,
+            )
+        budgets.append(budget)
+    # the second fetch reads the cache, the series with a NULL code included
+    assert budgets[0].series == budgets[1].series
+    assert len(budgets[0].series) == 3
+
+
+@pytest.mark.parametrize(
+    "q",
+    [
+        "status",
+        "sum by (code) (status)",
+        "rate(counter[5m])",
+        "max_over_time(gauge[10m:1m])",
+        "gauge / on(host, job) counter",
+    ],
+)
+def test_same_results(configs, end, monkeypatch, q):
+    results = dict()
+    for backend in BACKENDS:
+        configure(configs, monkeypatch, FETCH_BACKEND=backend)
+        instant = query(q, end)
+        ranged = query_range(q, end - datetime.timedelta(minutes=10), end, 60)
+        results[backend] = (instant, ranged)
+    for backend in BACKENDS:
+        for df, expected in zip(results[backend], results["pandas"]):
+            pd.testing.assert_frame_equal(df, expected)
+
+
+def test_default_backend(database, monkeypatch):
+    engine = sqlalchemy.create_engine(database)
+    assert get_fetch_backend({"DB": engine}) is FETCH_BACKENDS["arrow"]
+    # plain cursors of drivers with server-side cursors buffer whole results
+    monkeypatch.setattr(engine.dialect, "supports_server_side_cursors", True)
+    assert get_fetch_backend({"DB": engine}) is FETCH_BACKENDS["pandas"]
+    configs = {"DB": engine, "FETCH_BACKEND": "numpy"}
+    assert get_fetch_backend(configs) is FETCH_BACKENDS["numpy"]
+    engine.dispose()
@@ -0,0 +1,51 @@
+import datetime
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from promsql.clock import utc_now
+from promsql.constants import TIME_COL
+from promsql.fetch_cache import FetchCache
+from promsql.results_cache import ResultsCache
+from promsql.series import SeriesSet
+
+
+@pytest.fixture(params=["America/New_York", "Asia/Tehran"])
+def local_timezone(request, monkeypatch):
+    """Runs the test with the local timezone behind and ahead of UTC"""
+    monkeypatch.setenv("TZ", request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_utc_now(local_timezone):
+    expected = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    assert abs(utc_now() - expected) < datetime.timedelta(seconds=1)
+
+
+def test_recent_results_are_cached(local_timezone):
+    cache = ResultsCache()
+    cache.put("key", SeriesSet.empty(), utc_now() - datetime.timedelta(minutes=1))
+    assert cache.get("key") is not None
+
+
+def test_incomplete_chunks_are_not_cached(local_timezone):
+    cache = FetchCache()
+    reads = []
+
+    def read(start, end):
+        reads.append((start, end))
+        return pd.DataFrame({TIME_COL: pd.DatetimeIndex([], dtype="datetime64[ns]")})
+
+    now = utc_now()
+    # a range which ends in the future, e.g. the last step of a dashboard
+    end = now + datetime.timedelta(hours=1)
+    for _ in range(2):
+        cache.fetch("key", now - datetime.timedelta(hours=1), end, 600, read)
+    # the chunk with the current time is read again, as it is incomplete
+    assert len(reads) == 2
+    assert reads[1][0] <= now < reads[1][0] + datetime.timedelta(minutes=10)
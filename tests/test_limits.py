@@ -0,0 +1,40 @@
+import datetime
+
+import pytest
+from lark.exceptions import VisitError
+
+from promsql import PromSqlParser, PromSqlTransformer
+from promsql import limits
+from promsql.limits import QueryBudget, QueryLimitExceeded, QueryLimits
+from promsql.sql_miscs import fetch_metric_data
+
+
+def fetch_counted(end):
+    """Fetches the last hour of counter within a budget; returns the budget"""
+    budget = QueryBudget(QueryLimits(max_samples=10**6))
+    with limits.enforce(budget):
+        fetch_metric_data(
+            "counter",
+            start_datetime=end - datetime.timedelta(hours=1),
+            end_datetime=end,
+        )
+    return budget
+
+
+def test_cached_chunks_are_counted(configs, end):
+    read = fetch_counted(end)
+    # 3 series, 4 samples a minute, the start included
+    assert read.samples == 3 * 241
+    assert len(read.series) == 3
+    cached = fetch_counted(end)
+    assert (cached.samples, cached.series) == (read.samples, read.series)
+
+
+def test_transformer_enforces_limits(configs, monkeypatch):
+    monkeypatch.setitem(configs, "MAX_QUERY_SERIES", 2)
+    # the transformer evaluates at the current time
+    tree = PromSqlParser().parse("counter[1y]")
+    # lark wraps the errors of the transformer
+    with pytest.raises(VisitError) as error:
+        PromSqlTransformer().transform(tree)
+    assert isinstance(error.value.orig_exc, QueryLimitExceeded)
@@ -0,0 +1,106 @@
+"""Instant queries at each step of a range query give its result"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from promsql.query import query, query_range
+
+LABELS = ["host", "job", "code"]
+
+
+def assert_parity(q, end, steps=5, step=60):
+    start = end - datetime.timedelta(seconds=step * (steps - 1))
+    ranged = query_range(q, start, end, step)
+    assert len(ranged), q
+    for index in range(steps):
+        time = start + datetime.timedelta(seconds=step * index)
+        instant = query(q, time)
+        expected = ranged[ranged["__time__"] == time]
+        columns = [c for c in LABELS if c in expected or c in instant]
+        instant = instant.sort_values(columns).reset_index(drop=True)
+        expected = expected.sort_values(columns).reset_index(drop=True)
+        assert len(instant) == len(expected), (q, time)
+        pd.testing.assert_frame_equal(
+            instant[columns], expected[columns], check_dtype=False
+        )
+        np.testing.assert_allclose(
+            instant["__value__"], expected["__value__"], rtol=1e-9, err_msg=q
+        )
+
+
+@pytest.mark.parametrize(
+    "q",
+    [
+        "max_over_time(rate(counter[2m])[10m:1m])",
+        "avg_over_time((gauge * 2)[5m:30s])",
+        "sum_over_time((-gauge)[3m:1m] offset 1m)",
+        "max_over_time(deriv(rate(counter[2m])[5m:1m])[10m:2m])",
+        "count_over_time(sum by (job) (gauge)[4m:45s])",
+    ],
+)
+def test_subqueries_of_expressions(configs, end, q):
+    # off the steps of the subqueries, too
+    assert_parity(q, end)
+    assert_parity(q, end - datetime.timedelta(seconds=7))
+
+
+@pytest.mark.parametrize(
+    "q",
+    [
+        "avg_over_time(gauge[5m:1m])",
+        "max_over_time(gauge[10m:2m] offset 1m)",
+        "rate(counter[5m:30s])",
+    ],
+)
+def test_subqueries_of_selectors(configs, end, q):
+    # the samples of the subquery are the latest raw sample at each step,
+    # not the average of a bucket
+    assert_parity(q, end)
+    assert_parity(q, end - datetime.timedelta(seconds=7))
+
+
+def test_subquery_takes_latest_sample(configs, end):
+    # gauge changes at every sample, so the averages of 1m buckets differ
+    instant = query("gauge[3m:1m]", end)
+    latest = query("gauge", end - datetime.timedelta(minutes=1))
+    at_step = instant[instant["__time__"] == end - datetime.timedelta(minutes=1)]
+    assert sorted(at_step["__value__"]) == sorted(latest["__value__"])
+
+
+@pytest.mark.parametrize(
+    "q",
+    [
+        "rate(counter[5m])",
+        "increase(counter[2m])",
+        "deriv(gauge[5m])",
+        "deriv(counter[3m])",
+        "count_over_time(gauge[2m])",
+        "avg_over_time(gauge[2m])",
+        "max_over_time(gauge[5m] offset 1m)",
+        "sum_over_time(status[1m])",
+    ],
+)
+def test_range_functions(configs, end, q):
+    assert_parity(q, end)
+    assert_parity(q, end - datetime.timedelta(seconds=7))
+
+
+@pytest.mark.parametrize(
+    "q",
+    [
+        "gauge * 2",
+        "-gauge",
+        "gauge - on(host, job) counter",
+        "gauge > 20",
+        "gauge > bool 20",
+        "sum by (job) (gauge) / 2",
+        "sum by (host) (rate(counter[5m])) / on(host) sum by (host) (gauge)",
+        "max(gauge) - min(gauge)",
+    ],
+)
+def test_binary_operators(configs, end, q):
+    assert_parity(q, end)
+    assert_parity(q, end - datetime.timedelta(seconds=7))
@@ -0,0 +1,148 @@
+"""The LALR parser gives the trees of the Earley parser, with the precedence
+and associativity of PromQL, and caches them"""
+
+import pytest
+from lark import Token, Tree
+
+from promsql.parser import PromSqlParser
+from promsql.query import parse_query
+from promsql.transformer import PromSqlTransformer
+
+QUERIES = [
+    "a - b - c",
+    "a / b * c",
+    "a + b * c",
+    "a * b + c",
+    "2 ^ 3 ^ 2",
+    "-a ^ 2",
+    "-a * b",
+    "- -a",
+    "a and b or c unless d",
+    "a or b and c",
+    "a unless b and c",
+    "a > bool b + c",
+    "a == b or c != d",
+    "a + on(host) group_left(job) b",
+    "a / ignoring(code) b - c",
+    'http_requests_total{job="api", code=~"5..", host!="a", path!~"/x"}',
+    '{__name__=~"gauge|counter"}',
+    "rate(counter[5m] offset 1m)",
+    "sum by (job) (rate(counter[5m]))",
+    "sum(rate(counter[5m])) without (host, code)",
+    "topk(3, gauge) by (job)",
+    "quantile by (job) (0.9, gauge)",
+    'count_values("value", gauge)',
+    "max_over_time(rate(counter[2m])[10m:1m] offset 5m)",
+    "avg_over_time((gauge * 2)[5m:])",
+    "abs(-gauge) % 3",
+    "(a + b) * c",
+    "1 + 2 * 3 - 4 / 5",
+    "sum by (by, on, offset) (gauge)",
+]
+
+
+def shape(node):
+    """The rules of a tree and the text of its tokens
+
+    The lexers may tag an identifier with either of the terminals the
+    grammar accepts there (e.g. IDENTIFIER or METRIC_IDENTIFIER for a
+    label), which the transformer does not tell apart.
+    """
+    if isinstance(node, Tree):
+        return (node.data, tuple(shape(child) for child in node.children))
+    if isinstance(node, Token):
+        return str(node)
+    return node
+
+
+@pytest.fixture(scope="module")
+def parsers():
+    return PromSqlParser(), PromSqlParser(parser="earley", query_cache_size=0)
+
+
+@pytest.mark.parametrize("q", QUERIES)
+def test_lalr_and_earley(parsers, q):
+    lalr, earley = parsers
+    assert shape(lalr.parse(q)) == shape(earley.parse(q))
+
+
+def evaluate(q: str, parser: PromSqlParser) -> float:
+    return PromSqlTransformer().transform(parser.parse(q))
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    [
+        # left associative
+        ("10 - 4 - 3", 3.0),
+        ("8 / 2 / 2", 2.0),
+        ("10 % 4 * 2", 4.0),
+        # right associative
+        ("2 ^ 3 ^ 2", 512.0),
+        # ^ binds tighter than unary minus, which binds tighter than *
+        ("-2 ^ 2", -4.0),
+        ("2 ^ -1", 0.5),
+        ("-2 * 3 + 1", -5.0),
+        ("1 + 2 * 3", 7.0),
+        ("(1 + 2) * 3", 9.0),
+        ("1 + 2 < bool 4", 1.0),
+    ],
+)
+def test_scalar_precedence(parsers, q, expected):
+    for parser in parsers:
+        assert evaluate(q, parser) == expected
+
+
+def operators(node):
+    """The operators of a node tree, nested like the tree"""
+    if hasattr(node, "left_expr"):
+        return (operators(node.left_expr), node.op, operators(node.right_expr))
+    if hasattr(node, "name"):
+        return node.name
+    return node
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    [
+        ("a - b - c", (("a", "-", "b"), "-", "c")),
+        ("a ^ b ^ c", ("a", "^", ("b", "^", "c"))),
+        # and and unless bind tighter than or, all left associative
+        ("a and b or c unless d", (("a", "and", "b"), "or", ("c", "unless", "d"))),
+        ("a or b unless c", ("a", "or", ("b", "unless", "c"))),
+        ("a unless b or c", (("a", "unless", "b"), "or", "c")),
+        ("a or b and c", ("a", "or", ("b", "and", "c"))),
+        ("a and b unless c", (("a", "and", "b"), "unless", "c")),
+        ("a or b or c", (("a", "or", "b"), "or", "c")),
+        # comparisons bind looser than arithmetic, tighter than and
+        ("a > b + c and d", (("a", ">", ("b", "+", "c")), "and", "d")),
+    ],
+)
+def test_vector_precedence(parsers, q, expected):
+    for parser in parsers:
+        assert operators(parse_query(q, parser)) == expected, parser.options.parser
+
+
+def test_repeated_queries_hit_the_cache():
+    parser = PromSqlParser()
+    q = "sum by (job) (rate(counter[5m]))"
+    tree = parser.parse(q)
+    hits = parser._cached_parse.cache_info().hits
+    assert parser.parse(q) is tree
+    assert parser._cached_parse.cache_info().hits == hits + 1
+    parser.clear_query_cache()
+    assert parser.parse(q) is not tree
+    assert parser.parse(q) == tree
+
+    uncached = PromSqlParser(query_cache_size=0)
+    assert uncached.parse(q) is not uncached.parse(q)
+
+
+def test_cached_trees_give_fresh_nodes():
+    # the node trees are built from the shared parse tree at every query
+    parser = PromSqlParser()
+    q = "rate(counter[5m])"
+    first = parse_query(q, parser)
+    second = parse_query(q, parser)
+    assert first is not second
+    assert first.args[0] is not second.args[0]
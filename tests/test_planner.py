@@ -0,0 +1,46 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from promsql.query import query, query_range
+
+
+def instant_and_range(q, end):
+    """Returns the instant result at end and the range result at its last step"""
+    instant = query(q, end)
+    ranged = query_range(q, end - datetime.timedelta(minutes=10), end, 60)
+    return instant, ranged[ranged["__time__"] == end]
+
+
+def assert_same(left, right):
+    columns = [c for c in left.columns if c not in ("__value__", "__time__")]
+    left = left.sort_values(columns).reset_index(drop=True)
+    right = right.sort_values(columns).reset_index(drop=True)
+    pd.testing.assert_frame_equal(left[columns], right[columns])
+    np.testing.assert_allclose(left["__value__"], right["__value__"])
+
+
+def test_over_time_window_is_left_open(configs, end):
+    instant, ranged = instant_and_range("count_over_time(gauge[1m])", end)
+    # four samples 15s apart in (end - 1m, end]
+    assert list(instant["__value__"]) == [4.0, 4.0, 4.0]
+    assert_same(instant, ranged)
+
+
+def test_division_by_zero_is_infinite(configs, end):
+    instant, ranged = instant_and_range("gauge / (gauge - gauge)", end)
+    assert np.isinf(instant["__value__"]).all()
+    assert_same(instant, ranged)
+
+
+def test_many_to_many_matching_is_refused(configs, end):
+    with pytest.raises(ValueError, match="many-to-many"):
+        query("gauge / ignoring(host) counter", end)
+
+
+def test_one_to_one_matching(configs, end):
+    instant, ranged = instant_and_range("gauge - on(host, job) counter", end)
+    assert len(instant) == 3
+    assert_same(instant, ranged)
@@ -0,0 +1,27 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from promsql.query import query, query_range
+
+# seconds between two samples, see conftest.metric_frames
+INTERVAL = 15
+
+
+def values_by_host(df):
+    return {host: value for host, value in zip(df["host"], df["__value__"])}
+
+
+@pytest.mark.parametrize("name", ["deriv", "rate"])
+def test_slope_of_linear_series(configs, end, name):
+    # the counter grows by 1 per sample, and by 2 for host b
+    expected = {"a": 1 / INTERVAL, "b": 2 / INTERVAL, "c": 1 / INTERVAL}
+    instant = values_by_host(query(f"{name}(counter[5m])", end))
+    ranged = query_range(
+        f"{name}(counter[5m])", end - datetime.timedelta(minutes=10), end, 60
+    )
+    for host, value in expected.items():
+        assert instant[host] == pytest.approx(value, rel=1e-9)
+        series = ranged[ranged["host"] == host]["__value__"].to_numpy()
+        np.testing.assert_allclose(series, value, rtol=1e-9)
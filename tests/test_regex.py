@@ -0,0 +1,194 @@
+"""Regex label matchers select whole values, in the database or from the
+label index, and the series without the label when "" matches"""
+
+import datetime
+import re
+import shutil
+
+import pandas as pd
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from promsql.catalog import label_index
+from promsql.query import query, query_range
+from promsql.sql_miscs import get_where_clauses, matches_missing, metric_catalog
+
+# the value of each series of status, see conftest.metric_frames
+STATUS = {"200": 0.0, "500": 1.0, "NULL": 2.0}
+
+
+def hosts(q, end):
+    return sorted(query(q, end)["host"]) if len(query(q, end)) else []
+
+
+def status_codes(q, end):
+    values = query(q, end)["__value__"] if len(query(q, end)) else []
+    return sorted(code for code, value in STATUS.items() if value in set(values))
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    [
+        ('gauge{host=~"a|b"}', ["a", "b"]),
+        ('gauge{host!~"a"}', ["b", "c"]),
+        ('gauge{host=~"[bc]", job="api"}', ["b", "c"]),
+        # anchored at both ends
+        ('gauge{job=~"ap"}', []),
+        ('gauge{job=~"ap.*"}', ["a", "b", "c"]),
+        ('gauge{host=~".|x"}', ["a", "b", "c"]),
+        ('gauge{job!~"ap"}', ["a", "b", "c"]),
+        # every series has a host
+        ('gauge{host=~""}', []),
+        ('gauge{host!~""}', ["a", "b", "c"]),
+        ('gauge{host=~"d"}', []),
+    ],
+)
+def test_string_labels(configs, end, q, expected):
+    assert hosts(q, end) == expected
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    [
+        # the series with a NULL code has no code label
+        ('status{code=~""}', ["NULL"]),
+        ('status{code!~""}', ["200", "500"]),
+        ('status{code!~"|x"}', ["200", "500"]),
+        ('status{code=~"5.."}', ["500"]),
+        ('status{code=~"2.*|"}', ["200", "NULL"]),
+        ('status{code!~"200"}', ["500", "NULL"]),
+        ('status{code!~"200|"}', ["500"]),
+        ('status{code=~".*"}', ["200", "500", "NULL"]),
+        ('status{code=~".+"}', ["200", "500"]),
+    ],
+)
+def test_null_labels(configs, end, q, expected):
+    assert status_codes(q, end) == sorted(expected)
+
+
+@pytest.mark.parametrize("q", ['sum(status{code=~"5..|"})', 'gauge{host!~"b"}'])
+def test_range_queries(configs, end, q):
+    ranged = query_range(q, end - datetime.timedelta(minutes=5), end, 60)
+    instant = query(q, end)
+    last = ranged[ranged["__time__"] == end].reset_index(drop=True)
+    pd.testing.assert_frame_equal(last, instant, check_like=True)
+
+
+@pytest.mark.parametrize(
+    "op, regex, expected",
+    [
+        ("=~", "", True),
+        ("=~", ".*", True),
+        ("=~", "a|", True),
+        ("=~", "a", False),
+        ("=~", ".+", False),
+        ("!~", "", False),
+        ("!~", "a", True),
+        ("!~", "a|", False),
+    ],
+)
+def test_matches_missing(op, regex, expected):
+    assert matches_missing({"op": op, "value": regex}) is expected
+
+
+def compile_where(configs, labels):
+    table = sqlalchemy.table(
+        "status",
+        sqlalchemy.column("created", sqlalchemy.DateTime),
+        sqlalchemy.column("code"),
+    )
+    select = sqlalchemy.select(table.c.code).where(
+        *get_where_clauses(table, configs, labels)
+    )
+    return select.compile(dialect=postgresql.dialect())
+
+
+def test_regex_strategy(configs):
+    configs = {**configs, "REGEX_MATCH_STRATEGY": "regex", "DIALECT": "postgresql"}
+    compiled = compile_where(configs, {"code": {"op": "=~", "value": "2..|"}})
+    sql = str(compiled)
+    assert "code ~ %(label_" in sql
+    assert "code IS NULL" in sql
+    assert "^(?:2..|)$" in compiled.params.values()
+
+    compiled = compile_where(configs, {"code": {"op": "!~", "value": "5.."}})
+    sql = str(compiled)
+    assert "NOT (status.code ~ %(label_" in sql
+    assert "code IS NULL" in sql
+    assert "^(?:5..)$" in compiled.params.values()
+
+
+def test_in_list_strategy(configs):
+    configs = {**configs, "REGEX_MATCH_STRATEGY": "in_list", "TABLE_NAME": "status"}
+    configs["DB"] = sqlalchemy.create_engine(configs["DB"])
+    compiled = compile_where(configs, {"code": {"op": "=~", "value": "[25]00"}})
+    assert " IN (__[POSTCOMPILE_label_" in str(compiled)
+    assert [200, 500] in compiled.params.values()
+    compiled = compile_where(configs, {"code": {"op": "!~", "value": "2.*"}})
+    sql = str(compiled)
+    assert " NOT IN (__[POSTCOMPILE_label_" in sql
+    assert "code IS NULL" in sql
+    assert [200] in compiled.params.values()
+    # NOT IN leaves NULL out, even when no value matches
+    compiled = compile_where(configs, {"code": {"op": "!~", "value": ""}})
+    assert "code IS NOT NULL" in str(compiled)
+    assert [] in compiled.params.values()
+    configs["DB"].dispose()
+
+
+def test_invalid_regex(configs, end):
+    with pytest.raises(ValueError, match="invalid regex"):
+        query('gauge{host=~"("}', end)
+
+
+@pytest.fixture
+def copied_database(configs, database, tmp_path, monkeypatch):
+    """An engine of a copy of the database, which the configs point at"""
+    path = tmp_path / "labels.db"
+    shutil.copy(database[len("sqlite:///") :], path)
+    monkeypatch.setitem(configs, "DB", f"sqlite:///{path}")
+    metric_catalog.reload()
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    yield engine
+    engine.dispose()
+
+
+def add_sample(engine, host, created):
+    df = pd.DataFrame({"host": [host], "job": ["api"], "created": [created]})
+    df["origin"] = 1.0
+    with engine.begin() as connection:
+        df.to_sql("gauge", connection, if_exists="append", index=False)
+
+
+def test_label_index_refresh(copied_database):
+    engine = copied_database
+    regex = re.compile("[a-z]")
+
+    def find(refresh_interval):
+        return label_index.find_values(
+            engine, "gauge", "created", "host", regex, refresh_interval
+        )
+
+    end = datetime.datetime(2026, 1, 1, 12, 0, 0)
+    assert find(None) == ["a", "b", "c"]
+    add_sample(engine, "d", end + datetime.timedelta(seconds=15))
+    # not read again before the refresh interval
+    assert find(None) == ["a", "b", "c"]
+    assert find(0) == ["a", "b", "c", "d"]
+    # only the rows after the latest timestamp read are read again...
+    add_sample(engine, "e", end - datetime.timedelta(hours=1))
+    assert find(0) == ["a", "b", "c", "d"]
+    # ...until the index is invalidated
+    label_index.invalidate(engine, "gauge")
+    assert find(0) == ["a", "b", "c", "d", "e"]
+
+
+def test_new_label_values_are_queried(configs, copied_database, monkeypatch):
+    end = datetime.datetime(2026, 1, 1, 12, 1, 0)
+    monkeypatch.setitem(configs, "LABEL_INDEX_REFRESH_INTERVAL", 0)
+    metric_catalog.reload()
+    assert hosts('gauge{host=~"c|d"}', end) == ["c"]
+    add_sample(copied_database, "d", end)
+    # the cached statement binds the values of the refreshed index
+    assert hosts('gauge{host=~"c|d"}', end) == ["c", "d"]
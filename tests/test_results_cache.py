@@ -0,0 +1,78 @@
+"""Range results are cached per database and configs, and the on-disk store
+drops expired and least recently used results"""
+
+import datetime
+import os
+import shutil
+import time
+
+import numpy as np
+import sqlalchemy
+
+import promsql.results_cache
+from promsql.clock import utc_now
+from promsql.query import query_range
+from promsql.results_cache import ResultsCache, results_cache
+from promsql.series import SeriesSet
+from promsql.sql_miscs import metric_catalog
+
+
+def test_databases_do_not_share_results(configs, database, end, tmp_path, monkeypatch):
+    path = tmp_path / "other.db"
+    shutil.copy(database[len("sqlite:///") :], path)
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE gauge SET origin = origin + 1000")
+    engine.dispose()
+
+    start = end - datetime.timedelta(minutes=10)
+    first = query_range("sum(gauge)", start, end, 60)
+    monkeypatch.setitem(configs, "DB", f"sqlite:///{path}")
+    metric_catalog.reload()
+    hits = results_cache.hits
+    other = query_range("sum(gauge)", start, end, 60)
+    assert results_cache.hits == hits
+    np.testing.assert_allclose(other["__value__"], first["__value__"] + 3000)
+    # as do other lookbacks, which change the samples instant selectors take
+    monkeypatch.setitem(configs, "LOOK_BEHIND_DURATION", 60)
+    metric_catalog.reload()
+    query_range("sum(gauge)", start, end, 60)
+    assert results_cache.hits == hits
+
+
+def test_expired_files_are_removed(tmp_path, monkeypatch):
+    cache = ResultsCache(directory=str(tmp_path), ttl=60)
+    now = utc_now()
+    cache.put("recent", SeriesSet.empty(), now - datetime.timedelta(minutes=1))
+    cache.put("old", SeriesSet.empty(), now - datetime.timedelta(days=1))
+    assert len(os.listdir(tmp_path)) == 2
+
+    later = now + datetime.timedelta(minutes=2)
+    monkeypatch.setattr(promsql.results_cache, "utc_now", lambda: later)
+    # another process, which only has the files
+    cache = ResultsCache(directory=str(tmp_path), ttl=60)
+    assert cache.get("recent") is None
+    assert cache.get("old") is not None
+    assert os.listdir(tmp_path) == [os.path.basename(cache._path("old"))]
+
+
+def test_directory_is_bounded(tmp_path):
+    result = SeriesSet.empty().with_values(np.zeros(1000))
+    cache = ResultsCache(directory=str(tmp_path))
+    old = utc_now() - datetime.timedelta(days=1)
+    cache.put("a", result, old)
+    size = os.path.getsize(cache._path("a"))
+    cache.max_disk_bytes = 2 * size
+    for key in ["b", "a", "c"]:
+        # apart by more than the resolution of the modification times
+        time.sleep(0.05)
+        if key == "a":
+            cache.clear()
+            assert cache.get("a") is not None
+        else:
+            cache.put(key, result, old)
+    # b was used the least recently
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(cache._path(key)) for key in ["a", "c"]
+    )
+    assert cache.disk_bytes == 2 * size
@@ -0,0 +1,152 @@
+"""Rollups give the results of the raw samples, within the tolerances of the
+rollups module docstring, and are built incrementally"""
+
+import datetime
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+
+from promsql import tracing
+from promsql.query import query, query_range
+from promsql.rollups import get_rollup_table_name, update_rollups
+from promsql.sql_miscs import get_metric_configs, metric_catalog
+
+RESOLUTIONS = [60, 300]
+LABELS = ["host", "job"]
+
+
+@pytest.fixture
+def rollup_configs(configs, database, tmp_path, monkeypatch):
+    """Configs pointing at a copy of the database, which rollups are built
+    in; ROLLUP_RESOLUTIONS is left unset"""
+    path = tmp_path / "rollups.db"
+    shutil.copy(database[len("sqlite:///") :], path)
+    monkeypatch.setitem(configs, "DB", f"sqlite:///{path}")
+    monkeypatch.setitem(configs, "ROLLUP_RESOLUTIONS", RESOLUTIONS)
+    metric_catalog.reload()
+    update_rollups("gauge")
+    monkeypatch.setitem(configs, "ROLLUP_RESOLUTIONS", None)
+    metric_catalog.reload()
+    return configs
+
+
+def use_rollups(configs, monkeypatch, enabled: bool):
+    monkeypatch.setitem(configs, "ROLLUP_RESOLUTIONS", RESOLUTIONS if enabled else None)
+    metric_catalog.reload()
+
+
+def evaluate(q, evaluation):
+    """Returns the result of q and the rollup resolutions which were read"""
+    with tracing.collect() as root:
+        df = evaluation(q)
+    resolutions = {
+        span.attributes["resolution"]
+        for span in root.walk()
+        if "resolution" in span.attributes
+    }
+    sql = " ".join(
+        str(span.attributes["sql"]) for span in root.walk() if "sql" in span.attributes
+    )
+    if "__rollup_" in sql:
+        resolutions.add("sql")
+    columns = [c for c in LABELS if c in df] + ["__time__"] * ("__time__" in df)
+    return df.sort_values(columns).reset_index(drop=True), resolutions
+
+
+def assert_same(raw, rolled, q):
+    # sums and averages may differ by floating point rounding
+    assert len(raw) == len(rolled), q
+    labels = [c for c in raw.columns if c != "__value__"]
+    pd.testing.assert_frame_equal(raw[labels], rolled[labels], check_dtype=False)
+    np.testing.assert_allclose(
+        rolled["__value__"], raw["__value__"], rtol=1e-12, err_msg=q
+    )
+
+
+FUNCTIONS = [
+    "sum_over_time",
+    "count_over_time",
+    "min_over_time",
+    "max_over_time",
+    "avg_over_time",
+    "last_over_time",
+]
+
+
+@pytest.mark.parametrize("function", FUNCTIONS)
+@pytest.mark.parametrize("offset", [0, 7, 60])
+def test_instant_queries(rollup_configs, end, monkeypatch, function, offset):
+    time = end - datetime.timedelta(seconds=offset)
+    # long enough for ROLLUP_MIN_BUCKETS buckets of one rollup or the other
+    for q in [f"{function}(gauge[30m])", f"{function}(gauge[1h] offset 2m)"]:
+        raw, _ = evaluate(q, lambda q: query(q, time))
+        use_rollups(rollup_configs, monkeypatch, True)
+        rolled, resolutions = evaluate(q, lambda q: query(q, time))
+        use_rollups(rollup_configs, monkeypatch, False)
+        assert len(raw) == 3
+        assert_same(raw, rolled, q)
+        if function != "last_over_time":
+            # pushed down to SQL reading the rollup
+            assert resolutions, q
+
+
+@pytest.mark.parametrize("function", FUNCTIONS)
+def test_range_queries(rollup_configs, end, monkeypatch, function):
+    start = end - datetime.timedelta(minutes=40)
+    for q, step in [
+        (f"{function}(gauge[5m])", 60),
+        (f"{function}(gauge[10m])", 300),
+        (f"{function}(gauge[15m] offset 5m)", 300),
+    ]:
+        raw, _ = evaluate(q, lambda q: query_range(q, start, end, step))
+        use_rollups(rollup_configs, monkeypatch, True)
+        rolled, resolutions = evaluate(q, lambda q: query_range(q, start, end, step))
+        use_rollups(rollup_configs, monkeypatch, False)
+        assert len(raw) == 3 * (40 * 60 // step + 1)
+        assert_same(raw, rolled, q)
+        assert resolutions, q
+
+
+def read_rollup(configs, resolution):
+    metric = get_metric_configs({"metric_name": "gauge"})
+    table = get_rollup_table_name(metric, resolution)
+    return pd.read_sql_table(table, sqlalchemy.create_engine(configs["DB"]))
+
+
+def test_update_appends_after_high_water(rollup_configs, end, monkeypatch):
+    use_rollups(rollup_configs, monkeypatch, True)
+    before = {
+        resolution: read_rollup(rollup_configs, resolution)
+        for resolution in RESOLUTIONS
+    }
+    # nothing was added to the raw table
+    assert update_rollups("gauge") == {resolution: 0 for resolution in RESOLUTIONS}
+
+    # ten minutes of new samples
+    times = pd.date_range(end + datetime.timedelta(seconds=15), periods=40, freq="15s")
+    new = pd.concat(
+        [
+            pd.DataFrame(
+                {"host": host, "job": "api", "created": times, "origin": 1000.0}
+            )
+            for host in ["a", "b", "c"]
+        ]
+    )
+    engine = sqlalchemy.create_engine(rollup_configs["DB"])
+    with engine.begin() as connection:
+        new.to_sql("gauge", connection, if_exists="append", index=False)
+    written = update_rollups("gauge")
+    for resolution in RESOLUTIONS:
+        after = read_rollup(rollup_configs, resolution)
+        high_water = before[resolution]["created"].max()
+        # the old buckets are left as they were
+        old = after[after["created"] <= high_water].reset_index(drop=True)
+        pd.testing.assert_frame_equal(old, before[resolution])
+        added = after[after["created"] > high_water]
+        assert len(added) == written[resolution] > 0
+        assert not added.duplicated(["host", "created"]).any()
+        # the bucket of the last sample is not complete yet
+        assert added["created"].max() < times[-1]
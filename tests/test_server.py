@@ -0,0 +1,144 @@
+import asyncio
+import datetime
+import http.client
+import json
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import pytest
+
+import promsql.server as server
+
+
+@pytest.fixture
+def api(configs):
+    """Serves the API on a free port from a thread; returns a function which
+    gets an endpoint and returns its status and decoded body"""
+    loop = asyncio.new_event_loop()
+    started = asyncio.run_coroutine_threadsafe(
+        asyncio.start_server(server.QueryServer().handle, "127.0.0.1", 0), loop
+    )
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    listener = started.result(timeout=10)
+    port = listener.sockets[0].getsockname()[1]
+
+    def get(path, **params):
+        url = f"http://127.0.0.1:{port}{path}?{urllib.parse.urlencode(params)}"
+        try:
+            with urllib.request.urlopen(url, timeout=30) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as error:
+            return error.code, json.load(error)
+
+    yield get
+    listener.close()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=10)
+    loop.close()
+
+
+def timestamp(end, seconds=0):
+    # naive times are UTC for the server
+    return str(int(end.replace(tzinfo=datetime.timezone.utc).timestamp()) + seconds)
+
+
+def test_instant_vector(api, end):
+    status, body = api("/api/v1/query", query="gauge", time=timestamp(end))
+    assert status == 200
+    assert body["data"]["resultType"] == "vector"
+    result = {item["metric"]["host"]: item["value"] for item in body["data"]["result"]}
+    assert result == {
+        "a": [int(timestamp(end)), "3"],
+        "b": [int(timestamp(end)), "16"],
+        "c": [int(timestamp(end)), "29"],
+    }
+
+
+def test_unary_minus(api, end):
+    status, body = api("/api/v1/query", query="-gauge", time=timestamp(end))
+    assert status == 200
+    values = sorted(item["value"][1] for item in body["data"]["result"])
+    assert values == ["-16", "-29", "-3"]
+    status, body = api("/api/v1/query", query="-(1 + 2)", time=timestamp(end))
+    assert body["data"] == {
+        "resultType": "scalar",
+        "result": [int(timestamp(end)), "-3"],
+    }
+
+
+def test_range_query(api, end):
+    status, body = api(
+        "/api/v1/query_range",
+        query="rate(counter[5m])",
+        start=timestamp(end, -600),
+        end=timestamp(end),
+        step="60",
+    )
+    assert status == 200
+    assert body["data"]["resultType"] == "matrix"
+    for item in body["data"]["result"]:
+        assert len(item["values"]) == 11
+        expected = 2 / 15 if item["metric"]["host"] == "b" else 1 / 15
+        values = [float(value) for _, value in item["values"]]
+        assert values == pytest.approx([expected] * 11)
+
+
+def test_series_and_labels(api, end):
+    status, body = api(
+        "/api/v1/series", **{"match[]": 'gauge{host!="a"}', "end": timestamp(end)}
+    )
+    assert status == 200
+    assert sorted(series["host"] for series in body["data"]) == ["b", "c"]
+    assert {series["__name__"] for series in body["data"]} == {"gauge"}
+    status, body = api("/api/v1/labels")
+    assert {"__name__", "host", "job", "code"} <= set(body["data"])
+    status, body = api("/api/v1/label/host/values")
+    assert body["data"] == ["a", "b", "c"]
+
+
+def test_errors(api, end):
+    status, body = api("/api/v1/query", query="rate(", time=timestamp(end))
+    assert status == 400
+    assert body["status"] == "error" and body["errorType"] == "bad_data"
+    status, body = api("/api/v1/query_range", query="gauge")
+    assert status == 400
+    status, body = api("/api/v1/nothing")
+    assert status == 404
+
+
+def test_encoding_error_before_response(api, end, monkeypatch):
+    def fail(value):
+        raise RuntimeError("cannot encode")
+
+    monkeypatch.setattr(server, "format_value", fail)
+    status, body = api("/api/v1/query", query="gauge", time=timestamp(end))
+    assert status == 500
+    assert body == {
+        "status": "error",
+        "errorType": "internal",
+        "error": "cannot encode",
+    }
+
+
+def test_encoding_error_aborts_response(api, end, monkeypatch):
+    def encode_series(series, time=None):
+        yield "["
+        raise RuntimeError("cannot encode")
+
+    monkeypatch.setattr(server, "encode_series", encode_series)
+    # the response was started, so it is cut short instead of completed
+    with pytest.raises((http.client.IncompleteRead, ConnectionError)):
+        api("/api/v1/query", query="gauge", time=timestamp(end))
+
+
+def test_matrix_selector_returns_raw_samples(api, end):
+    status, body = api("/api/v1/query", query="counter[2m]", time=timestamp(end))
+    assert status == 200
+    assert body["data"]["resultType"] == "matrix"
+    for item in body["data"]["result"]:
+        # the samples 15s apart in (end - 2m, end], at their own timestamps
+        times = [time for time, _ in item["values"]]
+        assert times == [int(timestamp(end, -105 + 15 * i)) for i in range(8)]
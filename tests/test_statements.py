@@ -0,0 +1,50 @@
+"""The selector statements are cached per engine and shared by threads"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from promsql import sql_miscs
+from promsql.sql_miscs import (
+    get_metric_configs,
+    get_selector_statement,
+    get_tag_columns,
+)
+
+
+@pytest.fixture
+def fast_switches():
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def test_statement_cache_is_reused(configs):
+    metric = get_metric_configs({"metric_name": "gauge"})
+    tags = get_tag_columns(metric)
+    labels = {"host": {"op": "=", "value": "a"}}
+    statement = get_selector_statement(metric, tags, labels)
+    other = {"host": {"op": "=", "value": "b"}}
+    assert get_selector_statement(metric, tags, other) is statement
+
+
+def test_statement_cache_under_threads(configs, monkeypatch, fast_switches):
+    # a small cache, so that the threads keep evicting each other's statements
+    monkeypatch.setattr(sql_miscs, "STATEMENT_CACHE_SIZE", 2)
+    metric = get_metric_configs({"metric_name": "gauge"})
+    tags = get_tag_columns(metric)
+    shapes = [
+        {"host": {"op": op, "value": "a"}, "job": {"op": "=", "value": "api"}}
+        for op in ("=", "!=")
+    ] + [{}, {"job": {"op": "!=", "value": "x"}}]
+
+    def select(index):
+        for round in range(200):
+            labels = shapes[(index + round) % len(shapes)]
+            get_selector_statement(metric, tags, labels, latest=index % 2 == 0)
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(select, range(32)))
+    assert len(get_selector_statement.statements[metric["DB"]]) <= 2
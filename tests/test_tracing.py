@@ -0,0 +1,168 @@
+"""Spans nest like the stages of a query, across the threads of fetches and
+sub-ranges, and record what each stage read"""
+
+import builtins
+import datetime
+import os
+import runpy
+
+import pandas as pd
+import pytest
+
+import promsql.nodes
+import promsql.transformer
+from promsql import tracing
+from promsql.query import evaluate_range, parse_query, query, query_range
+from promsql.sql_miscs import fetch_metric_data
+
+CLI = os.path.join(os.path.dirname(__file__), "..", "bin", "promsql-cli.py")
+
+
+def children(span):
+    return sorted(child.name for child in span.children)
+
+
+def find(root, name):
+    return [span for span in root.walk() if span.name == name]
+
+
+def test_range_query(configs, end):
+    q = "sum(gauge) + sum(rate(counter[5m]))"
+    start = end - datetime.timedelta(minutes=10)
+    with tracing.collect() as root:
+        df = query_range(q, start, end, 60)
+    assert root.name == "query"
+    assert root.duration is not None
+    [sub_range] = root.children
+    assert sub_range.name == "sub-range"
+    assert sub_range.attributes["steps"] == 11
+    assert sub_range.attributes["cached"] is False
+    assert children(sub_range) == ["BinaryExpression(+)", "prefetch"]
+    # the fetches ran on the threads of run_fetches
+    [prefetch] = find(root, "prefetch")
+    assert children(prefetch) == ["fetch counter", "fetch gauge"]
+    for span in prefetch.children:
+        metric = span.name.split()[1]
+        assert f"FROM {metric}" in span.attributes["sql"]
+        assert span.attributes["cache_misses"] > 0
+        assert span.attributes["cache_hits"] == 0
+        assert span.attributes["rows"] > 0
+        assert span.duration <= prefetch.duration
+    [binary] = find(root, "BinaryExpression(+)")
+    assert binary.attributes["samples"] == len(df)
+    assert children(binary) == ["AggregateExpr(sum)", "AggregateExpr(sum)"]
+    for span in root.walk():
+        assert span.duration is not None
+
+    # the same query again is read from the results cache
+    with tracing.collect() as root:
+        query_range(q, start, end, 60)
+    [sub_range] = root.children
+    assert sub_range.attributes["cached"] is True
+    assert sub_range.children == []
+
+
+def test_sub_ranges(configs, end):
+    # sub-ranges of 30 minutes, evaluated on the split threads
+    steps = pd.date_range(end - datetime.timedelta(hours=1), end, freq="5min")
+    steps = steps.as_unit("ns")
+    with tracing.collect() as root:
+        evaluate_range(parse_query("max(gauge)"), steps, 30 * 60, cache=None)
+    sub_ranges = find(root, "sub-range")
+    assert len(sub_ranges) == 3
+    assert all(span in root.children for span in sub_ranges)
+    assert sum(span.attributes["steps"] for span in sub_ranges) == len(steps)
+    for span in sub_ranges:
+        assert children(span) == ["AggregateExpr(max)", "prefetch"]
+        assert len(find(span, "fetch gauge")) == 1
+
+
+def test_instant_query(configs, end):
+    with tracing.collect() as root:
+        query("sum(gauge) + sum(rate(counter[5m]))", end)
+    assert children(root) == ["BinaryExpression(+)", "plan", "prefetch"]
+    [prefetch] = find(root, "prefetch")
+    assert children(prefetch) == ["fetch counter", "fetch sql"]
+    # sum(gauge) is pushed down to the database
+    [sql] = find(root, "fetch sql")
+    assert "sum(" in sql.attributes["sql"]
+    assert sql.attributes["rows"] == 1
+    assert len(find(root, "SqlQueryExpr()")) == 1
+
+
+def test_fetch_cache_hits(configs, end):
+    start = end - datetime.timedelta(hours=1)
+    spans = []
+    for _ in range(2):
+        with tracing.collect() as root:
+            fetch_metric_data("gauge", start_datetime=start, end_datetime=end)
+        spans.append(root.children[0])
+    first, second = spans
+    assert first.attributes["cache_hits"] == 0
+    # the chunk which goes on after the end is not complete, so not cached
+    assert second.attributes["cache_misses"] == 1
+    assert second.attributes["cache_hits"] == first.attributes["cache_misses"] - 1
+    assert first.attributes["rows"] == second.attributes["rows"] == 3 * 241
+
+
+def test_hooks(configs, end):
+    finished = []
+    hook = finished.append
+    assert not tracing.is_enabled()
+    tracing.add_hook(hook)
+    try:
+        assert tracing.is_enabled()
+        query("sum(rate(counter[5m]))", end)
+    finally:
+        tracing.remove_hook(hook)
+    names = [span.name for span in finished]
+    assert "fetch counter" in names
+    assert "AggregateExpr(sum)" in names
+    assert "plan" in names and "prefetch" in names
+    # children finish before their parents, and the root node last
+    assert names.index("Function(rate)") < names.index("AggregateExpr(sum)")
+    assert finished[-1].name == "AggregateExpr(sum)"
+    assert finished[-1].children[0].name == "Function(rate)"
+
+    finished.clear()
+    assert not tracing.is_enabled()
+    query("sum(rate(counter[5m]))", end)
+    assert finished == []
+
+
+def test_off(configs, end):
+    with tracing.trace("unused") as span:
+        assert span is None
+        assert tracing.current_span() is None
+        # nothing to record on
+        tracing.record(rows=1)
+
+
+def test_record_adds_numbers():
+    with tracing.collect() as root:
+        tracing.record(rows=2, sql="a")
+        tracing.record(rows=3, sql="b")
+    assert root.attributes == {"rows": 5, "sql": "b"}
+
+
+def test_cli_explain_analyze(configs, end, monkeypatch, capsys):
+    monkeypatch.setattr(promsql.transformer, "utc_now", lambda: end)
+    monkeypatch.setattr(promsql.nodes, "utc_now", lambda: end)
+    lines = iter(["EXPLAIN ANALYZE sum(rate(counter[5m]))"])
+
+    def read(prompt):
+        try:
+            return next(lines)
+        except StopIteration:
+            raise EOFError() from None
+
+    monkeypatch.setattr(builtins, "input", read)
+    with pytest.raises(EOFError):
+        runpy.run_path(CLI, run_name="__main__")
+    # the result, then the tree of spans
+    output = capsys.readouterr().out
+    tree = output[output.index("query  (time=") :].splitlines()
+    assert tree[1].startswith("  -> parse  (time=")
+    assert any(line.strip().startswith("-> fetch counter") for line in tree)
+    assert any(line.strip().startswith("SQL: SELECT") for line in tree)
+    assert any("Function(rate)" in line for line in tree)